@@ -1,3 +1,4 @@
+from functools import cache
 from os import environ
 
 import jwt
@@ -24,5 +25,7 @@ def decode_asf_cookie(cookie: str) -> tuple[str, str]:
     return payload['urs-user-id'], payload['urs-access-token']
 
 
+@cache
 def get_jwks_client() -> jwt.PyJWKClient:
+    """Get the client for Earthdata Login's signing keys, which is created the first time a bearer token is decoded."""
     return jwt.PyJWKClient('https://urs.earthdata.nasa.gov/.well-known/edl_ops_jwks.json')
@@ -0,0 +1,122 @@
+"""Cache of CMR granule footprints, which never change once a granule has been published."""
+
+import os
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+import botocore.exceptions
+from boto3.dynamodb.types import Binary
+from shapely import wkb
+from shapely.geometry import Polygon
+
+from dynamo.util import DYNAMODB_RESOURCE
+
+
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 50_000
+DYNAMODB_BATCH_GET_LIMIT = 100
+
+
+class GranuleMetadataCache:
+    """Two-tier name -> polygon cache for granule metadata.
+
+    The first tier is an in-process LRU that survives across invocations of a warm Lambda container. The optional
+    second tier is a DynamoDB table, shared by all containers, that stores each polygon as WKB along with an
+    `expiration_time` attribute suitable for DynamoDB Time to Live.
+    """
+
+    def __init__(
+        self, table_name: str | None = None, ttl_seconds: int = DEFAULT_TTL_SECONDS, max_size: int = DEFAULT_MAX_SIZE
+    ) -> None:
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, Polygon]] = OrderedDict()
+        self.stats = {'memory_hits': 0, 'dynamodb_hits': 0, 'misses': 0}
+
+    def get(self, granules: Iterable[str]) -> dict[str, Polygon]:
+        granules = list(granules)
+        now = time.time()
+        found = {}
+        for granule in granules:
+            polygon = self._get_from_memory(granule, now)
+            if polygon is not None:
+                found[granule] = polygon
+        self.stats['memory_hits'] += len(found)
+
+        remaining = [granule for granule in granules if granule not in found]
+        if remaining and self.table_name:
+            from_dynamodb = self._get_from_dynamodb(remaining, now)
+            self.stats['dynamodb_hits'] += len(from_dynamodb)
+            for granule, (expiration_time, polygon) in from_dynamodb.items():
+                self._put_in_memory(granule, polygon, expiration_time)
+                found[granule] = polygon
+
+        self.stats['misses'] += len(set(granules) - found.keys())
+        return found
+
+    def put(self, granule_metadata: list[dict]) -> None:
+        expiration_time = time.time() + self.ttl_seconds
+        for granule in granule_metadata:
+            self._put_in_memory(granule['name'], granule['polygon'], expiration_time)
+        if granule_metadata and self.table_name:
+            self._put_in_dynamodb(granule_metadata, int(expiration_time))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.stats = {key: 0 for key in self.stats}
+
+    def _get_from_memory(self, granule: str, now: float) -> Polygon | None:
+        entry = self._entries.get(granule)
+        if entry is None:
+            return None
+        expiration_time, polygon = entry
+        if expiration_time <= now:
+            del self._entries[granule]
+            return None
+        self._entries.move_to_end(granule)
+        return polygon
+
+    def _put_in_memory(self, granule: str, polygon: Polygon, expiration_time: float) -> None:
+        self._entries[granule] = (expiration_time, polygon)
+        self._entries.move_to_end(granule)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get_from_dynamodb(self, granules: list[str], now: float) -> dict[str, tuple[float, Polygon]]:
+        found: dict[str, tuple[float, Polygon]] = {}
+        try:
+            for i in range(0, len(granules), DYNAMODB_BATCH_GET_LIMIT):
+                keys = [{'granule_name': granule} for granule in granules[i : i + DYNAMODB_BATCH_GET_LIMIT]]
+                response = DYNAMODB_RESOURCE.batch_get_item(RequestItems={self.table_name: {'Keys': keys}})
+                # Unprocessed keys are treated as misses and will be fetched from CMR
+                for item in response['Responses'].get(self.table_name, []):
+                    # DynamoDB deletes expired items lazily, so check the expiration time ourselves
+                    if item['expiration_time'] > now:
+                        polygon: Polygon = wkb.loads(bytes(item['polygon']))  # type: ignore[assignment]
+                        found[item['granule_name']] = (float(item['expiration_time']), polygon)
+        except botocore.exceptions.ClientError as e:
+            print(f'Granule metadata cache lookup failed: {e}')
+        return found
+
+    def _put_in_dynamodb(self, granule_metadata: list[dict], expiration_time: int) -> None:
+        table = DYNAMODB_RESOURCE.Table(self.table_name)
+        try:
+            with table.batch_writer(overwrite_by_pkeys=['granule_name']) as batch:
+                for granule in granule_metadata:
+                    batch.put_item(
+                        Item={
+                            'granule_name': granule['name'],
+                            'polygon': Binary(wkb.dumps(granule['polygon'])),
+                            'expiration_time': expiration_time,
+                        }
+                    )
+        except botocore.exceptions.ClientError as e:
+            print(f'Granule metadata cache update failed: {e}')
+
+
+GRANULE_METADATA_CACHE = GranuleMetadataCache(
+    table_name=os.getenv('GRANULE_METADATA_TABLE_NAME') or None,
+    ttl_seconds=int(os.getenv('GRANULE_METADATA_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+)
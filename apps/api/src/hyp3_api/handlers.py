@@ -1,12 +1,18 @@
+import json
 from http.client import responses
 
 from flask import Response, abort, jsonify, request
+from werkzeug.exceptions import HTTPException
 
 import dynamo
 from dynamo.exceptions import (
     AccessCodeError,
     CustomPrefixForDefaultBucketError,
+    IdempotencyKeyInProgressError,
+    IdempotencyKeyReusedError,
     InsufficientCreditsError,
+    JobIdInUseError,
+    PartialJobSubmissionError,
     UnexpectedApplicationStatusError,
     UpdateJobForDifferentUserError,
     UpdateJobNotFoundError,
@@ -23,8 +29,51 @@ def problem_format(status: int, message: str) -> Response:
     return response
 
 
-def post_jobs(body: dict, user: str) -> dict:
+def post_jobs(body: dict, user: str, idempotency_key: str | None = None) -> dict:
     print(body)
+    if idempotency_key is None or body.get('validate_only'):
+        try:
+            return _submit_jobs(body, user)
+        except PartialJobSubmissionError as e:
+            abort(problem_format(503, str(e)))
+
+    try:
+        stored_response = dynamo.idempotency.start_request(
+            user, idempotency_key, dynamo.idempotency.get_request_hash(body)
+        )
+    except IdempotencyKeyInProgressError as e:
+        abort(problem_format(409, str(e)))
+    except IdempotencyKeyReusedError as e:
+        abort(problem_format(422, str(e)))
+    if stored_response is not None:
+        print(f'Returning the stored response for idempotency key {idempotency_key}')
+        return stored_response
+
+    job_ids = [dynamo.idempotency.get_job_id(user, idempotency_key, i) for i in range(len(body['jobs']))]
+    try:
+        response = _submit_jobs(body, user, job_ids)
+    except PartialJobSubmissionError as e:
+        # The job IDs are derived from the key, so a retry with the key submits only the jobs that weren't written
+        dynamo.idempotency.cancel_request(user, idempotency_key)
+        abort(problem_format(503, str(e)))
+    except HTTPException:
+        # Raised only for errors found before any job was written, so the request can be retried with the same key
+        dynamo.idempotency.cancel_request(user, idempotency_key)
+        raise
+    # Any other error may have been raised after jobs were written, so the key is left in progress until it expires
+    _complete_request(user, idempotency_key, response)
+    return response
+
+
+def _complete_request(user: str, idempotency_key: str, response: dict) -> None:
+    try:
+        dynamo.idempotency.complete_request(user, idempotency_key, response)
+    except Exception as e:
+        # The jobs were written, so the response is returned anyway, and the key is left in progress until it expires
+        print(f'Failed to store the response for idempotency key {idempotency_key}: {e}')
+
+
+def _submit_jobs(body: dict, user: str, job_ids: list[str] | None = None) -> dict:
     try:
         validate_jobs(body['jobs'])
     except CmrError as e:
@@ -32,16 +81,38 @@ def post_jobs(body: dict, user: str) -> dict:
     except (ValidationError, MultiBurstValidationError) as e:
         abort(problem_format(400, str(e)))
     try:
-        body['jobs'] = dynamo.jobs.put_jobs(user, body['jobs'], dry_run=bool(body.get('validate_only')))
+        try:
+            body['jobs'] = dynamo.jobs.put_jobs(
+                user, body['jobs'], dry_run=bool(body.get('validate_only')), job_ids=job_ids
+            )
+        except JobIdInUseError:
+            if job_ids is None:
+                raise
+            body['jobs'] = _resume_jobs(user, body['jobs'], job_ids)
     except UnexpectedApplicationStatusError as e:
         abort(problem_format(403, str(e)))
     except InsufficientCreditsError as e:
         abort(problem_format(400, str(e)))
     except CustomPrefixForDefaultBucketError as e:
         abort(problem_format(400, str(e)))
+    except JobIdInUseError as e:
+        abort(problem_format(409, str(e)))
     return body
 
 
+def _resume_jobs(user: str, jobs: list[dict], job_ids: list[str]) -> list[dict]:
+    """Submit those of the jobs that an earlier attempt of the request didn't, and return all of them."""
+    submitted_jobs = dynamo.jobs.get_jobs_by_id(job_ids)
+    missing_indexes = [i for i, job_id in enumerate(job_ids) if job_id not in submitted_jobs]
+    print(f'Resuming a partly submitted request with {len(missing_indexes)} of {len(jobs)} jobs left to submit')
+    if missing_indexes:
+        new_jobs = dynamo.jobs.put_jobs(
+            user, [jobs[i] for i in missing_indexes], job_ids=[job_ids[i] for i in missing_indexes]
+        )
+        submitted_jobs.update({job['job_id']: job for job in new_jobs})
+    return [submitted_jobs[job_id] for job_id in job_ids]
+
+
 def get_jobs(
     user: str,
     start: str | None = None,
@@ -50,12 +121,15 @@ def get_jobs(
     name: str | None = None,
     job_type: str | None = None,
     start_token: str | None = None,
+    page_size: int | None = None,
 ) -> dict:
     try:
         start_key = util.deserialize(start_token) if start_token else None
     except util.TokenDeserializeError:
         abort(problem_format(400, 'Invalid start_token value'))
-    jobs, last_evaluated_key = dynamo.jobs.query_jobs(user, start, end, status_code, name, job_type, start_key)
+    jobs, last_evaluated_key = dynamo.jobs.query_jobs(
+        user, start, end, status_code, name, job_type, start_key, page_size
+    )
     payload: dict = {'jobs': jobs}
     if last_evaluated_key is not None:
         next_token = util.serialize(last_evaluated_key)
@@ -72,6 +146,34 @@ def get_job_by_id(job_id: str) -> dict:
     return job
 
 
+def post_submissions(body: bytes, user: str) -> dict:
+    jobs = []
+    try:
+        lines = body.decode().splitlines()
+    except UnicodeDecodeError:
+        abort(problem_format(400, 'The submission is not UTF-8 encoded'))
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError:
+            abort(problem_format(400, f'Line {line_number} is not valid JSON'))
+        if not isinstance(job, dict):
+            abort(problem_format(400, f'Line {line_number} is not a JSON object'))
+        jobs.append(job)
+    if not jobs:
+        abort(problem_format(400, 'The submission has no jobs'))
+    submission = dynamo.submissions.put_submission(user, jobs)
+    print(f'Created submission {submission["submission_id"]} of {len(jobs)} jobs')
+    return submission
+
+
+def get_submission_by_id(submission_id: str, user: str) -> dict:
+    submission = dynamo.submissions.get_submission(submission_id)
+    if submission is None or submission['user_id'] != user:
+        abort(problem_format(404, f'submission_id does not exist: {submission_id}'))
+    return submission
+
+
 def patch_job_by_id(body: dict, job_id: str, user: str) -> dict:
     return _patch_job(job_id, body['name'], user)
 
@@ -119,10 +221,12 @@ def get_user(user: str) -> dict:
 
 
 def _user_response(user_record: dict) -> dict:
-    # TODO: count this as jobs are submitted, not every time `/user` is queried
-    job_names = _get_names_for_user(user_record['user_id'])
     payload = {key: user_record[key] for key in user_record if not key.startswith('_')}
-    payload['job_names'] = job_names
+    if dynamo.jobs.is_backfill_complete():
+        payload['job_names'] = dynamo.job_names.get_job_names(user_record['user_id'])
+    else:
+        # The job names table lacks the names of older jobs until the backfill has counted them
+        payload['job_names'] = _get_names_for_user(user_record['user_id'])
     return payload
 
 
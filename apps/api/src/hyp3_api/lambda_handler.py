@@ -4,6 +4,7 @@ from hyp3_api import app
 
 
 serverless_wsgi.TEXT_MIME_TYPES.append('application/problem+json')
+serverless_wsgi.TEXT_MIME_TYPES.append('application/x-ndjson')
 
 
 def handler(event: dict, context: object) -> dict:
@@ -10,23 +10,22 @@ import yaml
 from flask import Response, abort, g, jsonify, make_response, redirect, render_template, request
 from flask.json.provider import JSONProvider
 from flask_cors import CORS
-from openapi_core import OpenAPI
+from openapi_core import Config, OpenAPI
 from openapi_core.contrib.flask.decorators import FlaskOpenAPIViewDecorator
 from openapi_core.contrib.flask.handlers import FlaskOpenAPIErrorsHandler
 
 import dynamo
 from hyp3_api import app, auth, handlers
-from hyp3_api.openapi import get_spec_yaml
 
 
-api_spec_file = Path(__file__).parent / 'api-spec' / 'openapi-spec.yml'
-api_spec_dict = get_spec_yaml(api_spec_file)
-api_spec = OpenAPI.from_dict(api_spec_dict)
+# Resolved and validated by render_cf.py at build time, rather than on every cold start
+api_spec_file = Path(__file__).parent / 'api-spec' / 'openapi-spec.json'
+api_spec_dict = json.loads(api_spec_file.read_text())
+api_spec = OpenAPI.from_dict(api_spec_dict, config=Config(spec_validator_cls=None))  # type: ignore[arg-type]
 CORS(app, origins=r'https?://([-\w]+\.)*asf\.alaska\.edu', supports_credentials=True)
 
 
-JWKS_CLIENT = auth.get_jwks_client()
-AUTHENTICATED_ROUTES = ['/jobs', '/user']
+AUTHENTICATED_ROUTES = ['/jobs', '/submissions', '/user']
 
 
 @app.before_request
@@ -44,7 +43,9 @@ def authenticate_user() -> None:
     if any([request.path.startswith(route) for route in AUTHENTICATED_ROUTES]) and request.method != 'OPTIONS':
         try:
             if request.authorization and request.authorization.type == 'bearer':
-                g.user, g.edl_access_token = auth.decode_edl_bearer_token(str(request.authorization.token), JWKS_CLIENT)
+                g.user, g.edl_access_token = auth.decode_edl_bearer_token(
+                    str(request.authorization.token), auth.get_jwks_client()
+                )
             elif 'asf-urs' in request.cookies:
                 g.user, g.edl_access_token = auth.decode_asf_cookie(request.cookies['asf-urs'])
             else:
@@ -53,6 +54,11 @@ def authenticate_user() -> None:
             abort(handlers.problem_format(401, str(e)))
 
 
+@app.teardown_request
+def log_http_latency_metrics(_: BaseException | None) -> None:
+    dynamo.http_session.log_http_latency_metrics()
+
+
 @app.route('/')
 def redirect_to_ui() -> werkzeug.wrappers.response.Response:
     return redirect('/ui/')
@@ -142,7 +148,7 @@ def costs_get() -> Response:
 @app.route('/jobs', methods=['POST'])
 @openapi
 def jobs_post() -> Response:
-    return jsonify(handlers.post_jobs(request.get_json(), g.user))
+    return jsonify(handlers.post_jobs(request.get_json(), g.user, request.headers.get('Idempotency-Key')))
 
 
 @app.route('/jobs', methods=['PATCH'])
@@ -167,10 +173,35 @@ def jobs_get() -> Response:
             parameters.get('name'),
             parameters.get('job_type'),
             parameters.get('start_token'),
+            parameters.get('page_size'),
         )
     )
 
 
+@app.route('/jobs/export', methods=['GET'])
+@openapi
+def jobs_export_get() -> Response:
+    parameters = request.openapi.parameters.query  # type: ignore[attr-defined]
+    start = parameters.get('start')
+    end = parameters.get('end')
+    # Lambda responses are buffered and capped at 6 MB, so each page is a single DynamoDB read of at most 1 MB
+    payload = handlers.get_jobs(
+        parameters.get('user_id') or g.user,
+        start.isoformat(timespec='seconds') if start else None,
+        end.isoformat(timespec='seconds') if end else None,
+        parameters.get('status_code'),
+        parameters.get('name'),
+        parameters.get('job_type'),
+        parameters.get('start_token'),
+    )
+    response = Response(
+        ''.join(json.dumps(job, cls=CustomEncoder) + '\n' for job in payload['jobs']), mimetype='application/x-ndjson'
+    )
+    if 'next' in payload:
+        response.headers['Link'] = f'<{payload["next"]}>; rel="next"'
+    return response
+
+
 @app.route('/jobs/<job_id>', methods=['GET'])
 @openapi
 def jobs_get_by_job_id(job_id: str) -> Response:
@@ -183,6 +214,18 @@ def jobs_patch_by_job_id(job_id: str) -> Response:
     return jsonify(handlers.patch_job_by_id(request.get_json(), job_id, g.user))
 
 
+@app.route('/submissions', methods=['POST'])
+@openapi
+def submissions_post() -> Response:
+    return make_response(jsonify(handlers.post_submissions(request.get_data(), g.user)), 202)
+
+
+@app.route('/submissions/<submission_id>', methods=['GET'])
+@openapi
+def submissions_get_by_submission_id(submission_id: str) -> Response:
+    return jsonify(handlers.get_submission_by_id(submission_id, g.user))
+
+
 @app.route('/user', methods=['PATCH'])
 @openapi
 def user_patch() -> Response:
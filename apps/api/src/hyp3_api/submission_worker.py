@@ -0,0 +1,159 @@
+"""Background worker that submits the jobs of bulk submissions, one chunk at a time."""
+
+import json
+import time
+from pathlib import Path
+
+import botocore.exceptions
+from jsonschema.exceptions import best_match
+from openapi_schema_validator import OAS30Validator
+
+import dynamo
+from dynamo.exceptions import (
+    CustomPrefixForDefaultBucketError,
+    InsufficientCreditsError,
+    JobIdInUseError,
+    PartialJobSubmissionError,
+    UnexpectedApplicationStatusError,
+)
+from hyp3_api.multi_burst_validation import MultiBurstValidationError
+from hyp3_api.validation import CmrError, ValidationError, validate_jobs
+
+
+api_spec_file = Path(__file__).parent / 'api-spec' / 'openapi-spec.json'
+NEW_JOB_VALIDATOR = OAS30Validator(
+    json.loads(api_spec_file.read_text())['components']['schemas']['list_of_new_jobs']['items']
+)
+
+# Stop taking new chunks well before the worker Lambda's 15 minute timeout, leaving time for the chunk in progress
+TIME_BUDGET_SECONDS = 600
+
+
+def lambda_handler(event: dict, context: object) -> None:
+    if 'Records' not in event:
+        # Invoked on a schedule to restart the submissions of workers that stopped without releasing them
+        print(f'Reclaimed {dynamo.submissions.reclaim_expired_leases()} submissions with expired leases')
+        return
+
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+    try:
+        for record in event['Records']:
+            process_submission(record['dynamodb']['Keys']['submission_id']['S'], deadline)
+    finally:
+        dynamo.http_session.log_http_latency_metrics()
+
+
+def process_submission(submission_id: str, deadline: float) -> None:
+    """Submit the remaining chunks of a pending submission.
+
+    When the deadline passes, or a chunk fails for a reason that may be temporary, the submission is returned to
+    pending, which invokes the worker again to continue from the next chunk. A chunk that failed may have been partly
+    submitted, so after a failed attempt the first chunk is resumed rather than submitted from scratch.
+    """
+    submission = dynamo.submissions.start_processing(submission_id)
+    if submission is None:
+        print(f'Submission {submission_id} is not pending')
+        return
+
+    if submission['attempts'] >= dynamo.submissions.SUBMISSION_ATTEMPTS:
+        dynamo.submissions.finish_submission(
+            submission_id, dynamo.submissions.FAILED, 'Jobs could not be submitted. Please try again later.'
+        )
+        return
+
+    error_count = len(submission['errors'])
+    first_chunk = int(submission['next_chunk'])
+    for chunk_index in range(first_chunk, int(submission['chunk_count'])):
+        if time.monotonic() > deadline:
+            print(f'Continuing submission {submission_id} from chunk {chunk_index} in a new invocation')
+            dynamo.submissions.release_submission(submission_id, failed_attempt=False)
+            return
+
+        jobs = dynamo.submissions.get_submission_chunk(submission_id, chunk_index)
+        first_line = chunk_index * dynamo.submissions.SUBMISSION_CHUNK_SIZE + 1
+        try:
+            submitted_count, errors = submit_chunk(
+                submission_id,
+                submission['user_id'],
+                jobs,
+                first_line,
+                resumed=chunk_index == first_chunk and submission['attempts'] > 0,
+            )
+        except (CmrError, botocore.exceptions.ClientError) as e:
+            print(f'Failed to submit chunk {chunk_index} of submission {submission_id}: {e}')
+            dynamo.submissions.release_submission(submission_id, failed_attempt=True)
+            return
+
+        errors = errors[: max(dynamo.submissions.MAX_SUBMISSION_ERRORS - error_count, 0)]
+        error_count += len(errors)
+        dynamo.submissions.record_chunk(submission_id, chunk_index, len(jobs), submitted_count, errors)
+
+    dynamo.submissions.finish_submission(submission_id, dynamo.submissions.SUCCEEDED)
+
+
+def submit_chunk(
+    submission_id: str, user_id: str, jobs: list[dict], first_line: int, resumed: bool = False
+) -> tuple[int, list[dict]]:
+    """Validate and submit a chunk of jobs.
+
+    Returns the number of jobs submitted and an error for each job that wasn't, identified by its line number in the
+    submission. A job that fails validation doesn't stop the rest of the chunk from being submitted.
+
+    Each job's ID is derived from its line, so a job is never submitted or charged for twice. When `resumed` is true,
+    the chunk may have been partly submitted by an earlier attempt, and the jobs that were are counted as submitted.
+    """
+    job_ids = {
+        line: dynamo.submissions.get_job_id(submission_id, line) for line in range(first_line, first_line + len(jobs))
+    }
+    existing_job_ids = dynamo.jobs.get_existing_job_ids(list(job_ids.values())) if resumed else set()
+
+    errors = []
+    valid_jobs = []
+    for line, job in enumerate(jobs, start=first_line):
+        if job_ids[line] in existing_job_ids:
+            continue
+        error = best_match(NEW_JOB_VALIDATOR.iter_errors(job))
+        if error is not None:
+            errors.append({'line': line, 'detail': error.message})
+        else:
+            valid_jobs.append((line, job))
+
+    if not valid_jobs:
+        return len(existing_job_ids), errors
+
+    try:
+        validate_jobs([job for _, job in valid_jobs])
+    except (ValidationError, MultiBurstValidationError):
+        # Find the jobs that failed by validating them one at a time, which reuses the cached granule metadata
+        valid_jobs, candidate_jobs = [], valid_jobs
+        for line, job in candidate_jobs:
+            try:
+                validate_jobs([job])
+            except (ValidationError, MultiBurstValidationError) as e:
+                errors.append({'line': line, 'detail': str(e)})
+            else:
+                valid_jobs.append((line, job))
+
+    submitted_count = 0
+    if valid_jobs:
+        try:
+            submitted_count = len(
+                dynamo.jobs.put_jobs(
+                    user_id, [job for _, job in valid_jobs], job_ids=[job_ids[line] for line, _ in valid_jobs]
+                )
+            )
+        except (InsufficientCreditsError, UnexpectedApplicationStatusError, CustomPrefixForDefaultBucketError) as e:
+            errors.extend({'line': line, 'detail': str(e)} for line, _ in valid_jobs)
+        except JobIdInUseError as e:
+            if not resumed:
+                # An earlier attempt submitted some of the chunk's jobs without recording it, so skip those jobs
+                return submit_chunk(submission_id, user_id, jobs, first_line, resumed=True)
+            errors.extend({'line': line, 'detail': str(e)} for line, _ in valid_jobs)
+        except PartialJobSubmissionError as e:
+            submitted_count = len(e.submitted_jobs)
+            errors.extend(
+                {'line': line, 'detail': 'The job could not be submitted. Please submit it again.'}
+                for line, _ in valid_jobs[submitted_count:]
+            )
+
+    return len(existing_job_ids) + submitted_count, sorted(errors, key=lambda error: error['line'])
@@ -1,18 +1,27 @@
 import json
 import sys
-from collections.abc import Iterable
+from collections import defaultdict
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from pathlib import Path
 
 import requests
 import yaml
+from shapely import STRtree, prepare
 from shapely.geometry import MultiPolygon, Polygon, shape
 
+from dynamo.http_session import HTTP_SESSION
 from hyp3_api import CMR_URL, multi_burst_validation
+from hyp3_api.granule_cache import GRANULE_METADATA_CACHE
 from hyp3_api.util import get_granules
 
 
-DEM_COVERAGE = None
+DEM_COVERAGE: STRtree | None = None
+
+CMR_CHUNK_SIZE = 100
+CMR_PAGE_SIZE = 2000
+CMR_MAX_WORKERS = 8
 
 
 class InternalValidationError(Exception):
@@ -35,18 +44,62 @@ with (Path(__file__).parent / 'job_validation_map.yml').open() as job_validation
     JOB_VALIDATION_MAP = yaml.safe_load(job_validation_map_file.read())
 
 
-def _has_sufficient_coverage(granule: Polygon) -> bool:
+def _get_dem_coverage() -> STRtree:
     global DEM_COVERAGE
     if DEM_COVERAGE is None:
-        DEM_COVERAGE = _get_multipolygon_from_geojson('dem_coverage_map_cop30.geojson')
+        coverage = _get_multipolygon_from_geojson('dem_coverage_map_cop30.geojson')
+        polygons = list(coverage.geoms)
+        prepare(polygons)
+        DEM_COVERAGE = STRtree(polygons)
+    return DEM_COVERAGE
 
-    return granule.intersects(DEM_COVERAGE)
+
+def _get_granules_with_coverage(granules: list[Polygon]) -> set[int]:
+    """Return the indices of the granules that intersect the DEM coverage map, using a single bulk query."""
+    if not granules:
+        return set()
+    granule_indices, _ = _get_dem_coverage().query(granules, predicate='intersects')
+    return set(granule_indices.tolist())
+
+
+def _has_sufficient_coverage(granule: Polygon) -> bool:
+    return bool(_get_granules_with_coverage([granule]))
 
 
 def _get_cmr_metadata(granules: Iterable[str]) -> list[dict]:
     if not granules:
         return []
 
+    cached_polygons = GRANULE_METADATA_CACHE.get(granules)
+    granule_metadata = [{'name': name, 'polygon': polygon} for name, polygon in cached_polygons.items()]
+
+    uncached_granules = [granule for granule in granules if granule not in cached_polygons]
+    if uncached_granules:
+        try:
+            cmr_granule_metadata = _query_cmr(uncached_granules)
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            print(f'CMR search failed: {e}')
+            return []
+        GRANULE_METADATA_CACHE.put(cmr_granule_metadata)
+        granule_metadata.extend(cmr_granule_metadata)
+
+    _make_sure_granules_exist(granules, granule_metadata)
+
+    return granule_metadata
+
+
+def _query_cmr(granules: Iterable[str]) -> list[dict]:
+    granules = list(granules)
+    chunks = [granules[i : i + CMR_CHUNK_SIZE] for i in range(0, len(granules), CMR_CHUNK_SIZE)]
+    if len(chunks) == 1:
+        return _query_cmr_chunk(chunks[0])
+
+    with ThreadPoolExecutor(max_workers=min(CMR_MAX_WORKERS, len(chunks))) as executor:
+        results = list(executor.map(_query_cmr_chunk, chunks))
+    return [granule for result in results for granule in result]
+
+
+def _query_cmr_chunk(granules: list[str]) -> list[dict]:
     cmr_parameters = {
         'provider': 'ASF',
         'options[granule_ur][pattern]': 'true',
@@ -59,27 +112,26 @@ def _get_cmr_metadata(granules: Iterable[str]) -> list[dict]:
             'SENTINEL-1?_RAW',
             'SENTINEL-1_BURSTS',
         ],
-        'page_size': 2000,
+        'page_size': CMR_PAGE_SIZE,
     }
-    response = requests.post(CMR_URL, data=cmr_parameters)
-
-    try:
+    granule_metadata: list[dict] = []
+    headers: dict[str, str] = {}
+    while True:
+        response = HTTP_SESSION.post(CMR_URL, data=cmr_parameters, headers=headers)
         response.raise_for_status()
-    except requests.HTTPError as e:
-        print(f'CMR search failed: {e}')
-        return []
-
-    granule_metadata = [
-        {
-            'name': entry.get('producer_granule_id', entry.get('title')),
-            'polygon': Polygon(_format_points(entry['polygons'][0][0])),
-        }
-        for entry in response.json()['feed']['entry']
-    ]
-
-    _make_sure_granules_exist(granules, granule_metadata)
-
-    return granule_metadata
+        entries = response.json()['feed']['entry']
+        granule_metadata.extend(
+            {
+                'name': entry.get('producer_granule_id', entry.get('title')),
+                'polygon': Polygon(_format_points(entry['polygons'][0][0])),
+            }
+            for entry in entries
+        )
+        # https://cmr.earthdata.nasa.gov/search/site/docs/search/api.html#search-after
+        search_after = response.headers.get('CMR-Search-After')
+        if not search_after or len(entries) < CMR_PAGE_SIZE:
+            return granule_metadata
+        headers = {'CMR-Search-After': search_after}
 
 
 def _is_third_party_granule(granule: str) -> bool:
@@ -102,7 +154,8 @@ def check_cmr_query_succeeded(job: dict, granule_metadata: list[dict]) -> None:
 
 
 def check_dem_coverage(_, granule_metadata: list[dict]) -> None:
-    bad_granules = [g['name'] for g in granule_metadata if not _has_sufficient_coverage(g['polygon'])]
+    covered = _get_granules_with_coverage([g['polygon'] for g in granule_metadata])
+    bad_granules = [g['name'] for i, g in enumerate(granule_metadata) if i not in covered]
     if bad_granules:
         raise ValidationError(f'Some requested scenes do not have DEM coverage: {", ".join(bad_granules)}')
 
@@ -269,13 +322,39 @@ def _validate_date_during_s1(date_name: str, date_value: date) -> None:
         )
 
 
+def _get_job_validators(job_validation_map: dict[str, list[str]]) -> dict[str, list[Callable]]:
+    module = sys.modules[__name__]
+    return {
+        job_type: [getattr(module, validator_name) for validator_name in validator_names]
+        for job_type, validator_names in job_validation_map.items()
+    }
+
+
+JOB_VALIDATORS = _get_job_validators(JOB_VALIDATION_MAP)
+
+
+def _index_granule_metadata(granule_metadata: list[dict]) -> dict[str, list[tuple[int, dict]]]:
+    index = defaultdict(list)
+    for position, granule in enumerate(granule_metadata):
+        index[granule['name']].append((position, granule))
+    return index
+
+
+def _get_granule_metadata_for_job(job: dict, granule_metadata_index: dict[str, list[tuple[int, dict]]]) -> list[dict]:
+    # Preserve the order of the CMR response, which is the order the validators have always received
+    entries = [entry for granule in get_granules([job]) for entry in granule_metadata_index.get(granule, [])]
+    return [granule for _, granule in sorted(entries, key=lambda entry: entry[0])]
+
+
 def validate_jobs(jobs: list[dict]) -> None:
     granules = get_granules(jobs)
     granule_metadata = _get_cmr_metadata(granules)
+    granule_metadata_index = _index_granule_metadata(granule_metadata)
 
     for job in jobs:
-        for validator_name in JOB_VALIDATION_MAP[job['job_type']]:
-            job_granule_metadata = [granule for granule in granule_metadata if granule['name'] in get_granules([job])]
-            module = sys.modules[__name__]
-            validator = getattr(module, validator_name)
+        validators = JOB_VALIDATORS[job['job_type']]
+        if not validators:
+            continue
+        job_granule_metadata = _get_granule_metadata_for_job(job, granule_metadata_index)
+        for validator in validators:
             validator(job, job_granule_metadata)
@@ -1,44 +1,120 @@
 import os
+import time
 import urllib.parse
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from datetime import time as dt_time
+from functools import cache
 from os import environ
 from pathlib import Path
 
 import boto3
+import botocore.exceptions
+from botocore.config import Config
 
 import dynamo
 
 
-S3_CLIENT = boto3.client('s3')
+MAX_CONCURRENT_REQUESTS = 16
+
+S3_CLIENT = boto3.client('s3', config=Config(max_pool_connections=MAX_CONCURRENT_REQUESTS))
+
+# HyP3's 100th birthday; 100 years since first non-ASF job
+# https://hyp3-api.asf.alaska.edu/jobs/969ab836-aa95-4613-8673-2a0415949afa
+NO_EXPIRATION_TIME = '2120-10-21T00:00:00+00:00'
+
+# Lifecycle rules are read once per bucket and reused by later jobs in the same warm Lambda instance, so that most
+# expiration times are computed without any request
+LIFECYCLE_CACHE_SECONDS = 3600
+LIFECYCLE_RULES_BY_BUCKET: dict[str, tuple[float, list[dict] | None]] = {}
+
+
+@cache
+def get_bucket_region(bucket: str) -> str:
+    # A bucket's region never changes, so it is looked up once per warm Lambda instance
+    return S3_CLIENT.head_bucket(Bucket=bucket)['BucketRegion']
 
 
 def get_download_url(bucket: str, key: str) -> str:
     if (bucket == environ['BUCKET']) and (distribution_url := os.getenv('DISTRIBUTION_URL')):
         return urllib.parse.urljoin(distribution_url, key)
 
-    region = S3_CLIENT.head_bucket(Bucket=bucket)['BucketRegion']
+    region = get_bucket_region(bucket)
     return f'https://{bucket}.s3.{region}.amazonaws.com/{key}'
 
 
 def get_expiration_time(bucket: str, key: str) -> str:
-    s3_object = S3_CLIENT.get_object(Bucket=bucket, Key=key)
+    s3_object = S3_CLIENT.head_object(Bucket=bucket, Key=key)
     expiration = s3_object.get('Expiration')
     if expiration is None:
-        # HyP3's 100th birthday; 100 years since first non-ASF job
-        # https://hyp3-api.asf.alaska.edu/jobs/969ab836-aa95-4613-8673-2a0415949afa
-        return '2120-10-21T00:00:00+00:00'
+        return NO_EXPIRATION_TIME
 
     expiration_string = s3_object['Expiration'].split('"')[1]
     expiration_datetime = datetime.strptime(expiration_string, '%a, %d %b %Y %H:%M:%S %Z')
     return expiration_datetime.isoformat(timespec='seconds') + '+00:00'
 
 
-def get_object_file_type(bucket: str, key: str) -> str | None:
+def get_lifecycle_rules(bucket: str) -> list[dict] | None:
+    """Get the bucket's lifecycle rules, or None if they can't be read."""
+    cached = LIFECYCLE_RULES_BY_BUCKET.get(bucket)
+    if cached is not None and time.monotonic() - cached[0] < LIFECYCLE_CACHE_SECONDS:
+        return cached[1]
+
+    rules: list[dict] | None
+    try:
+        rules = S3_CLIENT.get_bucket_lifecycle_configuration(Bucket=bucket)['Rules']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+            print(f'Unable to read the lifecycle configuration of bucket {bucket}: {e}')
+            rules = None
+        else:
+            rules = []
+    LIFECYCLE_RULES_BY_BUCKET[bucket] = (time.monotonic(), rules)
+    return rules
+
+
+def get_lifecycle_expiration_time(rules: list[dict], s3_object: dict, tags: dict[str, str]) -> str | None:
+    """Compute when the lifecycle rules expire the object, or return None if a rule can't be evaluated here.
+
+    S3 expires an object at the first midnight UTC after the object's age reaches a rule's number of days.
+    """
+    expiration_times = []
+    for rule in rules:
+        if rule['Status'] != 'Enabled' or not rule.get('Expiration', {}).keys() & {'Days', 'Date'}:
+            continue
+        applies = _lifecycle_filter_applies(rule.get('Filter', {'Prefix': rule.get('Prefix', '')}), s3_object, tags)
+        if applies is None:
+            return None
+        if not applies:
+            continue
+        if 'Date' in rule['Expiration']:
+            expiration_times.append(rule['Expiration']['Date'].astimezone(UTC))
+        else:
+            expiration_date = (s3_object['LastModified'] + timedelta(days=rule['Expiration']['Days'])).date()
+            expiration_times.append(datetime.combine(expiration_date + timedelta(days=1), dt_time(), tzinfo=UTC))
+
+    if not expiration_times:
+        return NO_EXPIRATION_TIME
+    return min(expiration_times).isoformat(timespec='seconds')
+
+
+def _lifecycle_filter_applies(lifecycle_filter: dict, s3_object: dict, tags: dict[str, str]) -> bool | None:
+    conditions = lifecycle_filter.get('And', lifecycle_filter)
+    if not conditions.keys() <= {'Prefix', 'Tag', 'Tags', 'ObjectSizeGreaterThan', 'ObjectSizeLessThan'}:
+        return None
+
+    required_tags = conditions.get('Tags', []) + ([conditions['Tag']] if 'Tag' in conditions else [])
+    return (
+        s3_object['Key'].startswith(conditions.get('Prefix', ''))
+        and all(tags.get(tag['Key']) == tag['Value'] for tag in required_tags)
+        and s3_object['Size'] > conditions.get('ObjectSizeGreaterThan', -1)
+        and ('ObjectSizeLessThan' not in conditions or s3_object['Size'] < conditions['ObjectSizeLessThan'])
+    )
+
+
+def get_object_tags(bucket: str, key: str) -> dict[str, str]:
     response = S3_CLIENT.get_object_tagging(Bucket=bucket, Key=key)
-    for tag in response['TagSet']:
-        if tag['Key'] == 'file_type':
-            return tag['Value']
-    return None
+    return {tag['Key']: tag['Value'] for tag in response['TagSet']}
 
 
 def visible_product(product_path: str | Path) -> bool:
@@ -65,15 +141,24 @@ def get_file_urls_by_type(file_list: list[dict], file_type: str) -> list[str]:
     return urls
 
 
+def list_objects(bucket: str, prefix: str) -> list[dict]:
+    paginator = S3_CLIENT.get_paginator('list_objects_v2')
+    return [item for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for item in page.get('Contents', [])]
+
+
 def organize_files(s3_objects: list[dict], bucket: str) -> dict:
+    keys = [item['Key'] for item in s3_objects]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        tags_by_key = dict(zip(keys, executor.map(lambda key: get_object_tags(bucket, key), keys)))
+
     all_files = []
     expiration = None
     for item in s3_objects:
-        download_url = get_download_url(bucket, item['Key'])
-        file_type = get_object_file_type(bucket, item['Key'])
+        tags = tags_by_key[item['Key']]
+        file_type = tags.get('file_type')
         all_files.append(
             {
-                'download_url': download_url,
+                'download_url': get_download_url(bucket, item['Key']),
                 'file_type': file_type,
                 'size': item['Size'],
                 'filename': Path(item['Key']).name,
@@ -84,7 +169,11 @@ def organize_files(s3_objects: list[dict], bucket: str) -> dict:
             }
         )
         if expiration is None and file_type in ['product', 'log']:
-            expiration = get_expiration_time(bucket, item['Key'])
+            rules = get_lifecycle_rules(bucket)
+            if rules is not None:
+                expiration = get_lifecycle_expiration_time(rules, item, tags)
+            if expiration is None:
+                expiration = get_expiration_time(bucket, item['Key'])
 
     return {
         'files': get_products(all_files),
@@ -96,6 +185,6 @@ def organize_files(s3_objects: list[dict], bucket: str) -> dict:
 
 
 def lambda_handler(event: dict, context: object) -> None:
-    response = S3_CLIENT.list_objects_v2(Bucket=event['bucket'], Prefix=event['bucket_prefix'])
-    files = organize_files(response['Contents'], event['bucket'])
+    s3_objects = list_objects(event['bucket'], event['bucket_prefix'])
+    files = organize_files(s3_objects, event['bucket'])
     dynamo.jobs.update_job({'job_id': event['job_id'], **files})
@@ -17,7 +17,7 @@ def lambda_handler(event: dict, _) -> None:
     assert job['job_id'] == job_id
 
     if job['status_code'] == 'PENDING':
-        updated_job = {'job_id': job_id, 'status_code': 'RUNNING'}
+        updated_job = {'job_id': job_id, 'user_id': job['user_id'], 'status_code': 'RUNNING'}
         print(f'Updating job: {updated_job}')
         dynamo.jobs.update_job(updated_job)
     else:
@@ -3,6 +3,7 @@ import json
 from pathlib import Path
 
 import jinja2
+import prance
 import yaml
 from setuptools_scm import get_version
 
@@ -190,6 +191,14 @@ def render_templates(
         template_file.with_suffix('').write_text(output)
 
 
+def render_openapi_spec(api_spec_dir: Path) -> None:
+    """Resolve the rendered OpenAPI spec into one compact JSON document, so the API doesn't resolve it at cold start."""
+    parser = prance.ResolvingParser(str((api_spec_dir / 'openapi-spec.yml').resolve()))
+    parser.parse()
+    with (api_spec_dir / 'openapi-spec.json').open('w') as f:
+        json.dump(parser.specification, f, separators=(',', ':'))
+
+
 def get_compute_environments_for_deployment(job_types: dict, compute_env_file: Path) -> dict:
     compute_envs = yaml.safe_load(compute_env_file.read_text())['compute_environments']
 
@@ -336,6 +345,7 @@ def main() -> None:
         args.openapi_spec,
         args.same_account_publishing,
     )
+    render_openapi_spec(Path('apps') / 'api' / 'src' / 'hyp3_api' / 'api-spec')
 
 
 if __name__ == '__main__':
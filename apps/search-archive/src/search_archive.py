@@ -27,11 +27,12 @@ def _get_utc_time() -> datetime:
     return datetime.now(UTC)
 
 
-def _update_job(job_id: str, product: asf.ASFProduct) -> None:
+def _update_job(job_id: str, user_id: str, product: asf.ASFProduct) -> None:
     expiration_datetime = _get_utc_time() + timedelta(weeks=1000 * 52)
     dynamo.jobs.update_job(
         {
             'job_id': job_id,
+            'user_id': user_id,
             'status_code': 'SUCCEEDED',
             'processing_times': [0],
             'credit_cost': 0,
@@ -62,7 +63,7 @@ def lambda_handler(event: SearchArchiveEvent, _) -> bool:
 
     if product := _get_product_from_archive(event['job_type'], event['job_parameters']):
         logger.info(f'Found product, updating job {event["job_id"]}')
-        _update_job(event['job_id'], product)
+        _update_job(event['job_id'], event['user_id'], product)
 
         logger.info(f'Refunding {event["credit_cost"]} credits to user {event["user_id"]}')
         try:
@@ -1,14 +1,34 @@
 import json
 import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 from pathlib import Path
 
 import boto3
+import botocore.exceptions
+from botocore.config import Config
 
 import dynamo
 from lambda_logging import log_exceptions, logger
 
 
-STEP_FUNCTION = boto3.client('stepfunctions')
+MAX_JOBS_PER_INVOCATION = 500
+
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+THROTTLING_BACKOFF_SECONDS = 0.5
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+# Leaves time to query the pending jobs within the 55 second Lambda timeout
+SUBMISSION_TIME_BUDGET_SECONDS = 45.0
+
+# Throttling is handled by adapting the number of concurrent submissions, so botocore should not retry on its own
+STEP_FUNCTION = boto3.client(
+    'stepfunctions',
+    config=Config(retries={'mode': 'standard', 'max_attempts': 1}, max_pool_connections=MAX_CONCURRENCY),
+)
 
 batch_params_file = Path(__file__).parent / 'batch_params_by_job_type.json'
 if batch_params_file.exists():
@@ -34,22 +54,198 @@ def get_batch_job_parameters(job: dict) -> dict[str, str]:
     }
 
 
-def submit_jobs(jobs: list[dict]) -> None:
+def get_available_tokens(dispatch_limit: dict, now: float) -> float:
+    """Refill a user's dispatch token bucket for the time since it was last saved."""
+    jobs_per_minute = float(dispatch_limit['_dispatch_jobs_per_minute'])
+    capacity = float(dispatch_limit.get('_dispatch_burst', jobs_per_minute))
+    if '_dispatch_tokens_time' not in dispatch_limit:
+        return capacity
+
+    elapsed_seconds = max(0.0, now - float(dispatch_limit['_dispatch_tokens_time']))
+    return min(capacity, float(dispatch_limit['_dispatch_tokens']) + elapsed_seconds * jobs_per_minute / 60)
+
+
+def select_jobs(jobs: list[dict], allowances: dict[str, int], limit: int) -> list[dict]:
+    """Take one job from each user in turn, up to each user's allowance, until the limit is reached.
+
+    Each user's jobs keep their order, and users take turns in order of their first job. Users without an allowance
+    are not limited.
+    """
+    jobs_by_user: dict[str, list[dict]] = {}
+    for job in jobs:
+        jobs_by_user.setdefault(job['user_id'], []).append(job)
+
+    queues = {
+        user_id: deque(user_jobs[: allowances.get(user_id, len(user_jobs))])
+        for user_id, user_jobs in jobs_by_user.items()
+    }
+    selected_jobs: list[dict] = []
+    while queues and len(selected_jobs) < limit:
+        for user_id in list(queues):
+            if not queues[user_id]:
+                del queues[user_id]
+                continue
+            selected_jobs.append(queues[user_id].popleft())
+            if len(selected_jobs) == limit:
+                break
+    return selected_jobs
+
+
+def dispatch_jobs(
+    jobs: list[dict], limit: int = MAX_JOBS_PER_INVOCATION, now: float | None = None
+) -> tuple[list[dict], dict[str, int]]:
+    """Choose which pending jobs to submit, sharing submissions fairly between users, and claim them.
+
+    Returns the claimed jobs and the number claimed for each user. Users with a dispatch limit in the users table spend
+    one token per claimed job, so jobs claimed by an overlapping invocation cost nothing. If another invocation saved
+    a user's tokens since they were read, that user's jobs are released rather than submitted.
+    """
+    now = time.time() if now is None else now
+    dispatch_limits = dynamo.user.get_dispatch_limits(list(dict.fromkeys(job['user_id'] for job in jobs)))
+    available_tokens = {
+        user_id: get_available_tokens(dispatch_limit, now) for user_id, dispatch_limit in dispatch_limits.items()
+    }
+    selected_jobs = select_jobs(jobs, {user_id: int(tokens) for user_id, tokens in available_tokens.items()}, limit)
+    claimed_jobs = dynamo.jobs.claim_jobs(selected_jobs)
+    logger.info(f'Claimed {len(claimed_jobs)} of {len(selected_jobs)} jobs')
+    counts = Counter(job['user_id'] for job in claimed_jobs)
+
+    for user_id, dispatch_limit in dispatch_limits.items():
+        if counts[user_id] == 0:
+            continue
+        saved = dynamo.user.update_dispatch_tokens(
+            user_id,
+            tokens=Decimal(f'{available_tokens[user_id] - counts[user_id]:.3f}'),
+            tokens_time=Decimal(f'{now:.3f}'),
+            previous_tokens_time=dispatch_limit.get('_dispatch_tokens_time'),
+        )
+        if not saved:
+            logger.info(f'Dispatch tokens for user {user_id} were spent by another invocation')
+            dynamo.jobs.release_jobs([job for job in claimed_jobs if job['user_id'] == user_id])
+            claimed_jobs = [job for job in claimed_jobs if job['user_id'] != user_id]
+            del counts[user_id]
+
+    dispatch_counts = {user_id: count for user_id, count in counts.items() if count > 0}
+    logger.info(f'Jobs dispatched per user: {dispatch_counts}')
+    return claimed_jobs, dispatch_counts
+
+
+def refund_dispatch_tokens(jobs: list[dict]) -> None:
+    """Return the dispatch tokens spent on jobs that were not submitted, for users with a dispatch limit."""
+    for user_id, count in Counter(job['user_id'] for job in jobs).items():
+        dynamo.user.add_dispatch_tokens(user_id, count)
+
+
+def submit_jobs(jobs: list[dict], time_budget_seconds: float = SUBMISSION_TIME_BUDGET_SECONDS) -> dict[str, int]:
+    """Start a step function execution for each job, as many at a time as Step Functions allows.
+
+    Jobs are submitted in rounds of concurrent requests. The number of concurrent requests grows by one after each
+    round without throttling and is halved after a round with throttling, in which case the throttled jobs are
+    retried. The jobs must have been claimed with `dispatch_jobs`; jobs that fail, or that are not submitted within the
+    time budget, are released for the next invocation and their dispatch tokens are refunded.
+    """
     step_function_arn = os.environ['STEP_FUNCTION_ARN']
     logger.info(f'Step function ARN: {step_function_arn}')
-    for job in jobs:
-        job['batch_job_parameters'] = get_batch_job_parameters(job)
+
+    start_time = time.monotonic()
+    counts = {'submitted': 0, 'failed': 0, 'throttled': 0, 'unsubmitted': 0}
+    concurrency = INITIAL_CONCURRENCY
+    remaining_jobs = list(jobs)
+    failed_jobs: list[dict] = []
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        while remaining_jobs and time.monotonic() - start_time < time_budget_seconds:
+            round_jobs, remaining_jobs = remaining_jobs[:concurrency], remaining_jobs[concurrency:]
+            results = list(executor.map(lambda job: _submit_job(job, step_function_arn), round_jobs))
+
+            throttled_jobs = [job for job, result in zip(round_jobs, results) if result == 'throttled']
+            failed_jobs.extend(job for job, result in zip(round_jobs, results) if result == 'failed')
+            counts['submitted'] += results.count('submitted')
+            counts['failed'] += results.count('failed')
+            counts['throttled'] += len(throttled_jobs)
+
+            if throttled_jobs:
+                concurrency = max(1, concurrency // 2)
+                remaining_jobs = throttled_jobs + remaining_jobs
+                time.sleep(THROTTLING_BACKOFF_SECONDS)
+            else:
+                concurrency = min(MAX_CONCURRENCY, concurrency + 1)
+
+    counts['unsubmitted'] = len(remaining_jobs)
+    if failed_jobs or remaining_jobs:
+        dynamo.jobs.release_jobs(failed_jobs + remaining_jobs)
+        refund_dispatch_tokens(failed_jobs + remaining_jobs)
+    _log_metrics(counts, time.monotonic() - start_time)
+    return counts
+
+
+def _submit_job(job: dict, step_function_arn: str) -> str:
+    job['batch_job_parameters'] = get_batch_job_parameters(job)
+    try:
         STEP_FUNCTION.start_execution(
             stateMachineArn=step_function_arn,
             input=json.dumps(job, sort_keys=True),
             name=job['job_id'],
         )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in THROTTLING_ERROR_CODES:
+            return 'throttled'
+        logger.warning(f'Failed to start execution for job {job["job_id"]}: {e}')
+        return 'failed'
+    except Exception:
+        logger.exception(f'Failed to start execution for job {job["job_id"]}')
+        return 'failed'
+    return 'submitted'
+
+
+def _log_metrics(counts: dict[str, int], elapsed_seconds: float) -> None:
+    throughput = counts['submitted'] / elapsed_seconds if elapsed_seconds > 0 else 0.0
+    logger.info(f'Submission results: {counts} in {elapsed_seconds:.1f} seconds ({throughput:.1f} jobs/second)')
+
+    # Printed rather than logged so that the line is parsed as CloudWatch embedded metric format
+    metrics = {
+        'JobsSubmitted': ('Count', counts['submitted']),
+        'JobsFailed': ('Count', counts['failed']),
+        'JobsThrottled': ('Count', counts['throttled']),
+        'JobsUnsubmitted': ('Count', counts['unsubmitted']),
+        'SubmissionThroughput': ('Count/Second', throughput),
+    }
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'start-execution')
+    print(
+        json.dumps(
+            {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [
+                        {
+                            'Namespace': 'HyP3',
+                            'Dimensions': [['FunctionName']],
+                            'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in metrics.items()],
+                        }
+                    ],
+                },
+                'FunctionName': function_name,
+                **{name: value for name, (_, value) in metrics.items()},
+            }
+        )
+    )
 
 
 @log_exceptions
 def lambda_handler(event: dict, context: object) -> None:
-    pending_jobs = dynamo.jobs.get_jobs_waiting_for_execution(limit=500)
+    if 'Records' in event:
+        # Invoked by the jobs table stream, so only the newly submitted jobs need to be started
+        pending_jobs = dynamo.jobs.get_jobs_from_stream_records(event['Records'])
+    else:
+        # Invoked by the schedule, which also picks up any jobs the stream missed or failed to start
+        released = dynamo.jobs.release_expired_claims()
+        if released:
+            logger.warning(f'Released {released} jobs whose claim expired before their execution started')
+        # Each user's jobs are read separately, so that other users' jobs can be interleaved with those of a user who
+        # has submitted many jobs at once
+        pending_jobs = dynamo.jobs.get_jobs_waiting_for_execution(limit=MAX_JOBS_PER_INVOCATION)
     pending_jobs = dynamo.util.convert_decimals_to_numbers(pending_jobs)
     logger.info(f'Got {len(pending_jobs)} pending jobs')
 
-    submit_jobs(pending_jobs)
+    claimed_jobs, _ = dispatch_jobs(pending_jobs)
+    submit_jobs(claimed_jobs)
@@ -1,23 +1,110 @@
+import heapq
+import io
+import itertools
 import json
+import queue
+import threading
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import boto3
 from botocore.config import Config
 
+import s3_objects
+
 
 config = Config(retries={'max_attempts': 2, 'mode': 'standard'})
 CLOUDWATCH = boto3.client('logs', config=config)
 S3 = boto3.client('s3')
 
+# Logs are uploaded in parts of this size as they are read, so memory use doesn't grow with the size of the log.
+# S3 requires every part but the last to be at least 5 MiB.
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
 
-def get_log_stream(result: dict) -> str | None:
-    if 'Error' in result:
-        result = json.loads(result['Cause'])
-    return result['Container'].get('LogStreamName')
+# The log streams of a job's attempts are read concurrently, each by at most this many pages ahead of the upload
+LOG_PAGES_READ_AHEAD = 4
+_END_OF_LOG_STREAM = object()
 
 
-def get_log_content(log_group: str, log_stream: str) -> str:
+def get_log_streams(result: dict) -> list[tuple[str | None, str | None]]:
+    """Get the log stream of every Batch attempt of a processing step, in the order the attempts ran.
+
+    Each log stream is returned with a label naming its attempt, or None if the step ran only once. The log stream of
+    an attempt that didn't start is None.
+    """
+    if 'Error' in result:
+        result = json.loads(result['Cause'])
+    attempts = result.get('Attempts') or [result]
+    return [
+        (
+            f'attempt {i} of {len(attempts)}' if len(attempts) > 1 else None,
+            attempt.get('Container', {}).get('LogStreamName'),
+        )
+        for i, attempt in enumerate(attempts, start=1)
+    ]
+
+
+def _get_step_index(step: str) -> int:
+    # Steps are keyed `step_0`, `step_1`, ..., `step_10`, which don't sort as strings
+    return int(step.removeprefix('step_'))
+
+
+@contextmanager
+def read_log_streams(
+    log_group: str, log_streams: Sequence[tuple[str | None, str]]
+) -> Iterator[tuple[Iterator[str], set[str]]]:
+    """Read several log streams, merged into one log in order of event timestamp.
+
+    Yields the messages of the log and the names of the streams that don't exist. Each stream is read ahead by its own
+    thread, by at most `LOG_PAGES_READ_AHEAD` pages, so memory use doesn't grow with the size of the logs. Each message
+    is prefixed with the label of its stream, if it has one. The threads are stopped on exit.
+    """
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(len(log_streams), 1))
+    try:
+        queues: list[queue.Queue] = []
+        for _, log_stream in log_streams:
+            pages: queue.Queue = queue.Queue(maxsize=LOG_PAGES_READ_AHEAD)
+            executor.submit(_read_log_pages, log_group, log_stream, pages, stop)
+            queues.append(pages)
+
+        first_pages = [pages.get() for pages in queues]
+        missing_log_streams = set()
+        for (_, log_stream), page in zip(log_streams, first_pages):
+            if isinstance(page, Exception):
+                if not _is_missing_log_stream(page):
+                    raise page
+                missing_log_streams.add(log_stream)
+
+        streams = [
+            _get_log_events(pages, page, f'[{label}] ' if label is not None else '')
+            for (label, _), pages, page in zip(log_streams, queues, first_pages)
+        ]
+        # Each stream's events are in timestamp order, so this is a k-way merge that holds one event per stream.
+        # Ties keep the order of the streams, which is the order the attempts ran.
+        yield (message for _, message in heapq.merge(*streams, key=lambda event: event[0])), missing_log_streams
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def _get_log_events(pages: queue.Queue, page: object, prefix: str) -> Iterator[tuple[int, str]]:
+    while page is not _END_OF_LOG_STREAM:
+        if isinstance(page, Exception):
+            if not _is_missing_log_stream(page):
+                raise page
+            # Only a stream's first page can be missing
+            return
+        assert isinstance(page, list)
+        for timestamp, message in page:
+            yield timestamp, f'{prefix}{message}'
+        page = pages.get()
+
+
+def _get_log_pages(log_group: str, log_stream: str) -> Iterator[list[tuple[int, str]]]:
     response = CLOUDWATCH.get_log_events(logGroupName=log_group, logStreamName=log_stream, startFromHead=True)
-    messages = [event['message'] for event in response['events']]
+    yield [(event['timestamp'], event['message']) for event in response['events']]
 
     next_token = None
     while response['nextForwardToken'] != next_token:
@@ -25,9 +112,34 @@ def get_log_content(log_group: str, log_stream: str) -> str:
         response = CLOUDWATCH.get_log_events(
             logGroupName=log_group, logStreamName=log_stream, startFromHead=True, nextToken=next_token
         )
-        messages.extend([event['message'] for event in response['events']])
+        yield [(event['timestamp'], event['message']) for event in response['events']]
+
+
+def _read_log_pages(log_group: str, log_stream: str, pages: queue.Queue, stop: threading.Event) -> None:
+    item: object = _END_OF_LOG_STREAM
+    try:
+        for page in _get_log_pages(log_group, log_stream):
+            if not _put_unless_stopped(pages, page, stop):
+                return
+    except Exception as e:
+        item = e
+    _put_unless_stopped(pages, item, stop)
 
-    return '\n'.join(messages)
+
+def _put_unless_stopped(pages: queue.Queue, item: object, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _is_missing_log_stream(e: Exception) -> bool:
+    return isinstance(e, CLOUDWATCH.exceptions.ResourceNotFoundException) and (
+        'specified log stream does not exist' in str(e)
+    )
 
 
 def get_log_content_from_failed_attempts(cause: dict) -> str:
@@ -43,36 +155,68 @@ def get_log_content_from_failed_attempts(cause: dict) -> str:
     return content
 
 
-def write_log_to_s3(job_id: str, bucket: str, prefix: str, content: str) -> None:
-    key = f'{prefix}/{job_id}.log'
-    S3.put_object(Bucket=bucket, Key=key, Body=content, ContentType='text/plain')
-    tag_set = {
-        'TagSet': [
-            {
-                'Key': 'file_type',
-                'Value': 'log',
-            },
-        ],
-    }
-    S3.put_object_tagging(Bucket=bucket, Key=key, Tagging=tag_set)
+def write_log_to_s3(job_id: str, bucket: str, prefix: str, messages: Iterable[str]) -> None:
+    upload_lines(bucket, f'{prefix}/{job_id}.log', messages, 'log')
+
+
+def upload_lines(bucket: str, key: str, lines: Iterable[str], file_type: str) -> None:
+    """Upload the lines to S3 as one text object tagged with its file type.
+
+    Lines are uploaded in parts as they are consumed. An object smaller than one part is uploaded with a single
+    `put_object`.
+    """
+    buffer = io.BytesIO()
+    upload_id = None
+    parts: list[dict] = []
+    try:
+        for i, line in enumerate(lines):
+            buffer.write(f'\n{line}'.encode() if i else line.encode())
+            if buffer.tell() >= UPLOAD_PART_SIZE:
+                if upload_id is None:
+                    upload_id = S3.create_multipart_upload(
+                        Bucket=bucket,
+                        Key=key,
+                        ContentType='text/plain',
+                        Tagging=s3_objects.get_file_type_tagging(file_type),
+                    )['UploadId']
+                _upload_part(bucket, key, upload_id, parts, buffer)
+
+        if upload_id is None:
+            s3_objects.put_object_with_file_type(
+                S3, bucket, key, buffer.getvalue(), file_type, ContentType='text/plain'
+            )
+        else:
+            if buffer.tell():
+                _upload_part(bucket, key, upload_id, parts, buffer)
+            S3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        if upload_id is not None:
+            S3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+def _upload_part(bucket: str, key: str, upload_id: str, parts: list[dict], buffer: io.BytesIO) -> None:
+    part_number = len(parts) + 1
+    response = S3.upload_part(
+        Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=buffer.getvalue()
+    )
+    parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+    buffer.seek(0)
+    buffer.truncate()
 
 
 def lambda_handler(event: dict, context: object) -> None:
     results_dict = event['processing_results']
-    result = results_dict[max(results_dict.keys())]
-
-    log_content = None
-
-    log_stream = get_log_stream(result)
-    if log_stream is not None:
-        try:
-            log_content = get_log_content(event['log_group'], log_stream)
-        except CLOUDWATCH.exceptions.ResourceNotFoundException as e:
-            if 'specified log stream does not exist' not in str(e):
-                raise
-
-    if log_content is None:
-        assert 'Error' in result
-        log_content = get_log_content_from_failed_attempts(json.loads(result['Cause']))
-
-    write_log_to_s3(event['job_id'], event['bucket'], event['bucket_prefix'], log_content)
+    result = results_dict[max(results_dict, key=_get_step_index)]
+
+    log_streams = get_log_streams(result)
+    existing_log_streams = [(label, log_stream) for label, log_stream in log_streams if log_stream is not None]
+    with read_log_streams(event['log_group'], existing_log_streams) as (log_messages, missing_log_streams):
+        last_log_stream = log_streams[-1][1]
+        if last_log_stream is None or last_log_stream in missing_log_streams:
+            # The last attempt left no log, so the log ends with the reasons the attempts failed
+            assert 'Error' in result
+            failure_reasons = get_log_content_from_failed_attempts(json.loads(result['Cause']))
+            log_messages = itertools.chain(log_messages, [failure_reasons])
+
+        write_log_to_s3(event['job_id'], event['bucket'], event['bucket_prefix'], log_messages)
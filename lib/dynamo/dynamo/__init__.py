@@ -1,9 +1,13 @@
-from dynamo import jobs, user
+from dynamo import http_session, idempotency, job_names, jobs, submissions, user
 from dynamo.util import DYNAMODB_RESOURCE
 
 
 __all__ = [
     'DYNAMODB_RESOURCE',
+    'http_session',
+    'idempotency',
+    'job_names',
     'jobs',
+    'submissions',
     'user',
 ]
@@ -0,0 +1,87 @@
+"""One-off maintenance of the jobs table, run by hand with `python -m dynamo.backfill` and not used by the Lambdas."""
+
+from os import environ
+
+import botocore.exceptions
+from boto3.dynamodb.conditions import Attr
+
+import dynamo.job_names
+import dynamo.jobs
+import dynamo.user
+from dynamo.util import DYNAMODB_RESOURCE, current_utc_time
+
+
+def backfill_index_keys() -> None:
+    """Add the index keys to jobs submitted before the filter and dispatch indexes existed.
+
+    Jobs without the keys are missing from those indexes. Intended to be run once, after deploying the version that
+    adds the keys to new jobs. Queries don't use the indexes until it has completed and written its marker, and it can
+    be run again if it doesn't complete. The users of waiting jobs are registered for dispatch, and the names of named
+    jobs are counted in the job names table along with their name keys.
+    """
+    table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+    # A job whose status changed after the keys were added to new jobs has its status key, but may lack the others
+    missing_keys = Attr(dynamo.jobs.FILTER_INDEXES['status_code']).not_exists()
+    for attribute in ('name', 'job_type'):
+        missing_keys |= Attr(attribute).exists() & Attr(dynamo.jobs.FILTER_INDEXES[attribute]).not_exists()
+    missing_keys |= (
+        Attr('status_code').eq('PENDING')
+        & Attr('execution_started').ne(True)
+        & Attr(dynamo.jobs.DISPATCH_PRIORITY).not_exists()
+    )
+    params = {
+        'ProjectionExpression': 'job_id, user_id, request_time, status_code, execution_started, priority, #name, job_type, '
+        + dynamo.jobs.FILTER_INDEXES['name'],
+        'ExpressionAttributeNames': {'#name': 'name'},
+        'FilterExpression': Attr('user_id').exists() & missing_keys,
+    }
+    registered_users: set[str] = set()
+    while True:
+        response = table.scan(**params)
+        for job in response['Items']:
+            index_keys = dynamo.jobs.get_index_keys(job)
+            if dynamo.jobs.DISPATCH_PRIORITY in index_keys and job['user_id'] not in registered_users:
+                dynamo.user.register_for_dispatch({'user_id': job['user_id']})
+                registered_users.add(job['user_id'])
+            values = {f':{key}': value for key, value in index_keys.items()}
+            # The keys are only valid for the job as it was read
+            conditions = ['status_code = :status_code']
+            values[':status_code'] = job['status_code']
+            if 'name' in job:
+                conditions.append('#name = :name')
+                values[':name'] = job['name']
+            else:
+                conditions.append('attribute_not_exists(#name)')
+            if dynamo.jobs.DISPATCH_PRIORITY in index_keys:
+                # The dispatch key is removed when the execution starts, and must not be added back
+                conditions.append('execution_started <> :started')
+                values[':started'] = True
+            name_items = []
+            if 'name' in job and dynamo.jobs.FILTER_INDEXES['name'] not in job:
+                # The API counts the names of jobs that have their name key, so the name is counted with the key
+                conditions.append(f'attribute_not_exists({dynamo.jobs.FILTER_INDEXES["name"]})')
+                name_items = dynamo.job_names.get_add_job_names_items(job['user_id'], [job['name']])
+            update = {
+                'TableName': table.name,
+                'Key': {'job_id': job['job_id']},
+                'UpdateExpression': 'SET {}'.format(','.join(f'{key}=:{key}' for key in index_keys)),
+                'ConditionExpression': ' AND '.join(conditions),
+                'ExpressionAttributeNames': {'#name': 'name'},
+                'ExpressionAttributeValues': values,
+            }
+            try:
+                DYNAMODB_RESOURCE.meta.client.transact_write_items(TransactItems=[{'Update': update}, *name_items])
+            except botocore.exceptions.ClientError as e:
+                # A job that changed since it was read had its keys added by that change
+                reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+                if reasons[:1] != ['ConditionalCheckFailed']:
+                    raise
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    table.put_item(Item={'job_id': dynamo.jobs.BACKFILL_MARKER_JOB_ID, 'completion_time': current_utc_time()})
+
+
+if __name__ == '__main__':
+    backfill_index_keys()
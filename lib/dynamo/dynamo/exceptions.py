@@ -13,10 +13,39 @@ class AccessCodeError(Exception):
     """Raised when a user application includes an invalid or expired access code."""
 
 
+class IdempotencyKeyInProgressError(Exception):
+    """Raised when a request reuses the idempotency key of a request that is still in progress."""
+
+
+class IdempotencyKeyReusedError(Exception):
+    """Raised when a request reuses the idempotency key of a different request."""
+
+
 class InsufficientCreditsError(Exception):
     """Raised when trying to submit jobs whose total cost exceeds the user's remaining credits."""
 
 
+class JobIdInUseError(Exception):
+    """Raised when jobs can't be submitted because their IDs belong to existing jobs."""
+
+    def __init__(self, job_ids: list[str]) -> None:
+        self.job_ids = job_ids
+        super().__init__(f'Job IDs already in use: {", ".join(job_ids)}')
+
+
+class PartialJobSubmissionError(Exception):
+    """Raised when only some of the jobs in a submission could be written to the database."""
+
+    def __init__(self, submitted_jobs: list[dict], failed_jobs: list[dict]) -> None:
+        self.submitted_jobs = submitted_jobs
+        self.failed_jobs = failed_jobs
+        super().__init__(
+            f'Only {len(submitted_jobs)} of {len(submitted_jobs) + len(failed_jobs)} jobs were submitted; you were not'
+            f' charged for the other {len(failed_jobs)}, which can be submitted again.'
+            f' Submitted job IDs: {", ".join(job["job_id"] for job in submitted_jobs)}'
+        )
+
+
 class UpdateJobNotFoundError(Exception):
     """Raised when a user attempts to update a job that doesn't exist."""
 
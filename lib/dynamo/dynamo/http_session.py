@@ -0,0 +1,117 @@
+"""Shared HTTP session for outbound requests, with timeouts, retries and per-host latency metrics."""
+
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping
+from typing import Any
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Outbound HTTP calls are made while serving API requests, so the connect and read timeouts of every attempt, plus the
+# backoff between retries, must fit within API Gateway's 29 second integration timeout
+API_GATEWAY_TIMEOUT_SECONDS = 29
+HTTP_TIMEOUT_SECONDS = (3.05, 10)
+HTTP_RETRIES = 1
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_POOL_MAXSIZE = 10
+HTTP_LATENCY_BY_HOST: dict[str, dict] = {}
+_http_latency_lock = threading.Lock()
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout: tuple[float, float], **kwargs: Any) -> None:  # noqa: ANN401
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: float | tuple[float, float] | tuple[float, None] | None = None,
+        verify: bool | str = True,
+        cert: bytes | str | tuple[bytes | str, bytes | str] | None = None,
+        proxies: Mapping[str, str] | None = None,
+    ) -> requests.Response:
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+
+
+def _record_latency(response: requests.Response, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+    host = urlparse(response.url).netloc
+    seconds = response.elapsed.total_seconds()
+    with _http_latency_lock:
+        metrics = HTTP_LATENCY_BY_HOST.setdefault(host, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        metrics['count'] += 1
+        metrics['total_seconds'] += seconds
+        metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+
+def get_http_session() -> requests.Session:
+    """Build a keep-alive session that retries connection errors, throttling, and server errors.
+
+    `allowed_methods=None` retries every method, including POST, which is only safe because the POST requests made
+    with this session, CMR granule searches, are reads.
+    """
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = _TimeoutHTTPAdapter(
+        timeout=HTTP_TIMEOUT_SECONDS, max_retries=retry, pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_record_latency)
+    return session
+
+
+HTTP_SESSION = get_http_session()
+
+
+def log_http_latency_metrics() -> None:
+    """Print the HTTP latencies recorded since the last call as CloudWatch embedded metrics, one line per host.
+
+    The recorded latencies are cleared, so each invocation or request reports only its own requests.
+    """
+    with _http_latency_lock:
+        latency_by_host = dict(HTTP_LATENCY_BY_HOST)
+        HTTP_LATENCY_BY_HOST.clear()
+
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    for host, metrics in latency_by_host.items():
+        print(
+            json.dumps(
+                {
+                    '_aws': {
+                        'Timestamp': int(time.time() * 1000),
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': 'HyP3',
+                                'Dimensions': [['FunctionName', 'Host']],
+                                'Metrics': [
+                                    {'Name': 'HttpRequests', 'Unit': 'Count'},
+                                    {'Name': 'HttpLatencyAverage', 'Unit': 'Seconds'},
+                                    {'Name': 'HttpLatencyMax', 'Unit': 'Seconds'},
+                                ],
+                            }
+                        ],
+                    },
+                    'FunctionName': function_name,
+                    'Host': host,
+                    'HttpRequests': metrics['count'],
+                    'HttpLatencyAverage': metrics['total_seconds'] / metrics['count'],
+                    'HttpLatencyMax': metrics['max_seconds'],
+                }
+            )
+        )
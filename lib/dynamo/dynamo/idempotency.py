@@ -0,0 +1,107 @@
+"""Idempotency keys for job submissions, so that a retried request returns the stored response of the original one."""
+
+import hashlib
+import json
+import time
+import zlib
+from os import environ
+from uuid import UUID, uuid5
+
+import botocore.exceptions
+from boto3.dynamodb.types import Binary, TypeDeserializer
+
+from dynamo.exceptions import IdempotencyKeyInProgressError, IdempotencyKeyReusedError
+from dynamo.util import DYNAMODB_RESOURCE, convert_decimals_to_numbers
+
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETED = 'COMPLETED'
+
+# Longer than the API Lambda timeout, so that a request that died without completing or cancelling its key doesn't
+# hold it for long
+IN_PROGRESS_SECONDS = 60
+COMPLETED_SECONDS = 24 * 60 * 60
+
+
+# Namespace of the job IDs derived from idempotency keys
+JOB_ID_NAMESPACE = UUID('9b7e3c2a-5f1d-4e8b-a6c4-2d0f8e1b7a93')
+
+
+def get_job_id(user_id: str, idempotency_key: str, index: int) -> str:
+    """Get the ID of the job at an index of a request, which is the same every time the request is retried."""
+    return str(uuid5(JOB_ID_NAMESPACE, json.dumps([user_id, idempotency_key, index])))
+
+
+def get_request_hash(body: dict) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def start_request(user_id: str, idempotency_key: str, request_hash: str) -> dict | None:
+    """Record that a request with the given idempotency key is in progress.
+
+    Returns the stored response if a request with the same key has already completed, or None if this request should
+    proceed. Raises IdempotencyKeyInProgressError if a request with the same key is still in progress, and
+    IdempotencyKeyReusedError if the key was used for a different request.
+    """
+    table = DYNAMODB_RESOURCE.Table(environ['IDEMPOTENCY_KEYS_TABLE_NAME'])
+    now = int(time.time())
+    try:
+        table.put_item(
+            Item={
+                'user_id': user_id,
+                'idempotency_key': idempotency_key,
+                'request_hash': request_hash,
+                'status': IN_PROGRESS,
+                'expiration_time': now + IN_PROGRESS_SECONDS,
+            },
+            # DynamoDB deletes expired items lazily, so an expired key is treated as unused
+            ConditionExpression='attribute_not_exists(user_id) OR expiration_time < :now',
+            ExpressionAttributeValues={':now': now},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        deserializer = TypeDeserializer()
+        item = {key: deserializer.deserialize(value) for key, value in e.response['Item'].items()}
+        if item['request_hash'] != request_hash:
+            raise IdempotencyKeyReusedError(
+                f'Idempotency key {idempotency_key} has already been used for a different request'
+            )
+        if item['status'] != COMPLETED:
+            raise IdempotencyKeyInProgressError(
+                f'A request with idempotency key {idempotency_key} is still in progress'
+            )
+        return json.loads(zlib.decompress(bytes(item['response'])))
+    return None
+
+
+def complete_request(user_id: str, idempotency_key: str, response: dict) -> None:
+    """Store the response of a request, to be returned to requests that reuse its idempotency key."""
+    table = DYNAMODB_RESOURCE.Table(environ['IDEMPOTENCY_KEYS_TABLE_NAME'])
+    table.update_item(
+        Key={'user_id': user_id, 'idempotency_key': idempotency_key},
+        UpdateExpression='SET #status = :completed, #response = :response, expiration_time = :expiration_time',
+        ExpressionAttributeNames={'#status': 'status', '#response': 'response'},
+        ExpressionAttributeValues={
+            ':completed': COMPLETED,
+            # Compressed to keep the responses of large submissions well within the DynamoDB item size limit
+            ':response': Binary(zlib.compress(json.dumps(convert_decimals_to_numbers(response)).encode())),
+            ':expiration_time': int(time.time()) + COMPLETED_SECONDS,
+        },
+    )
+
+
+def cancel_request(user_id: str, idempotency_key: str) -> None:
+    """Release the idempotency key of a request that failed, so that it can be retried."""
+    table = DYNAMODB_RESOURCE.Table(environ['IDEMPOTENCY_KEYS_TABLE_NAME'])
+    try:
+        table.delete_item(
+            Key={'user_id': user_id, 'idempotency_key': idempotency_key},
+            ConditionExpression='#status = :in_progress',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':in_progress': IN_PROGRESS},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
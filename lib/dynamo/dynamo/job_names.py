@@ -0,0 +1,74 @@
+"""Per-user index of job names, so that a user's job names can be listed without reading all of their jobs."""
+
+from collections import Counter
+from collections.abc import Iterable
+from os import environ
+
+import botocore.exceptions
+from boto3.dynamodb.conditions import Key
+
+from dynamo.util import DYNAMODB_RESOURCE
+
+
+def get_job_names(user_id: str) -> list[str]:
+    table = DYNAMODB_RESOURCE.Table(environ['JOB_NAMES_TABLE_NAME'])
+    params = {
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'ProjectionExpression': '#name',
+        'ExpressionAttributeNames': {'#name': 'name'},
+    }
+    response = table.query(**params)
+    names = [item['name'] for item in response['Items']]
+
+    while 'LastEvaluatedKey' in response:
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        response = table.query(**params)
+        names.extend(item['name'] for item in response['Items'])
+
+    return sorted(names)
+
+
+def get_add_job_names_items(user_id: str, names: Iterable[str]) -> list[dict]:
+    """Get TransactWriteItems items that count the job names, one per distinct name.
+
+    The items are written in the same transaction as the jobs, so that the counts can't drift from the jobs table.
+    """
+    return [
+        {
+            'Update': {
+                'TableName': environ['JOB_NAMES_TABLE_NAME'],
+                'Key': {'user_id': user_id, 'name': name},
+                'UpdateExpression': 'ADD job_count :delta',
+                'ExpressionAttributeValues': {':delta': count},
+            }
+        }
+        for name, count in Counter(names).items()
+    ]
+
+
+def rename_job(user_id: str, old_name: str | None, new_name: str | None) -> None:
+    if old_name == new_name:
+        return
+    if new_name is not None:
+        _update_job_count(user_id, new_name, 1)
+    if old_name is not None:
+        _update_job_count(user_id, old_name, -1)
+
+
+def _update_job_count(user_id: str, name: str, delta: int) -> None:
+    table = DYNAMODB_RESOURCE.Table(environ['JOB_NAMES_TABLE_NAME'])
+    key = {'user_id': user_id, 'name': name}
+    job_count = table.update_item(
+        Key=key,
+        UpdateExpression='ADD job_count :delta',
+        ExpressionAttributeValues={':delta': delta},
+        ReturnValues='UPDATED_NEW',
+    )['Attributes']['job_count']
+
+    if job_count <= 0:
+        try:
+            # Another request may have reused the name since our update
+            table.delete_item(Key=key, ConditionExpression='job_count <= :zero', ExpressionAttributeValues={':zero': 0})
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
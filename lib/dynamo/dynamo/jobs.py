@@ -1,25 +1,38 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
 from decimal import Decimal
 from os import environ
 from pathlib import Path
 from uuid import uuid4
 
 import botocore.exceptions
-from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.conditions import Attr, ConditionBase, Key
+from boto3.dynamodb.types import TypeDeserializer
 
+import dynamo.job_names
 import dynamo.user
 from dynamo.exceptions import (
     CustomPrefixForDefaultBucketError,
     InsufficientCreditsError,
     InvalidApplicationStatusError,
+    JobIdInUseError,
     NotStartedApplicationError,
+    PartialJobSubmissionError,
     PendingApplicationError,
     RejectedApplicationError,
     UpdateJobForDifferentUserError,
     UpdateJobNotFoundError,
 )
 from dynamo.user import APPLICATION_APPROVED, APPLICATION_NOT_STARTED, APPLICATION_PENDING, APPLICATION_REJECTED
-from dynamo.util import DYNAMODB_RESOURCE, convert_floats_to_decimals, current_utc_time, get_request_time_expression
+from dynamo.util import (
+    DYNAMODB_RESOURCE,
+    convert_floats_to_decimals,
+    current_utc_time,
+    format_time,
+    get_request_time_expression,
+)
 
 
 costs_file = Path(__file__).parent / 'costs.json'
@@ -32,23 +45,91 @@ else:
     # Allows mocking with unittest.mock.patch
     DEFAULT_PARAMS_BY_JOB_TYPE = {}
 
-
-def put_jobs(user_id: str, jobs: list[dict], dry_run: bool = False) -> list[dict]:
-    table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+# Sort key of the user_id_dispatch index, present only until a job's execution starts, so that the index holds exactly
+# each user's jobs waiting to be started, highest priority and then oldest first
+DISPATCH_PRIORITY = 'dispatch_priority'
+MAX_PRIORITY = 9999
+
+# A claimed job's dispatch key is replaced by the expiration time of its claim, which sorts after every unclaimed key,
+# so that claimed jobs are not dispatched again and claims that expire before the execution starts can be found
+CLAIMED_PREFIX = 'CLAIMED#'
+CLAIM_LEASE_SECONDS = 300
+CLAIM_CONCURRENCY = 16
+
+# Filters that have an index partitioned by the user and the filter value, in order of preference when several are
+# given. Each index's partition key is an attribute of the same name, and its sort key is the request time.
+FILTER_INDEXES = {
+    'name': 'user_id_name',
+    'status_code': 'user_id_status_code',
+    'job_type': 'user_id_job_type',
+}
+
+INDEX_KEY_ATTRIBUTES = {
+    'user_id': ('user_id', 'request_time'),
+    **{index_name: (index_name, 'request_time') for index_name in FILTER_INDEXES.values()},
+}
+
+# Indexes added to the jobs table after it was created, in the order they are deployed. DynamoDB creates only one index
+# per table update, so JOBS_TABLE_INDEXES is the number of them deployed so far, and queries fall back to the original
+# indexes until theirs exists and the backfill has added its keys to the older jobs.
+STAGED_INDEXES = ('user_id_dispatch', 'user_id_status_code', 'user_id_name', 'user_id_job_type')
+
+# Written by dynamo.backfill once every job has its index keys. It has none of the attributes the indexes are keyed on,
+# so no query reads it, and the job ID format accepted by the API can't reach it.
+BACKFILL_MARKER_JOB_ID = '#backfill'
+BACKFILL_CHECK_SECONDS = 60
+BACKFILL_STATUS: dict[str, float] = {}
+
+# DynamoDB's limit on the number of items written in one transaction
+TRANSACT_WRITE_ITEMS_LIMIT = 100
+TRANSACTION_ATTEMPTS = 3
+TRANSACTION_RETRY_SECONDS = 0.1
+RETRYABLE_CANCELLATION_REASONS = {'TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded'}
+
+# Bounds the follow-up queries made to fill a page, well within the API Gateway integration timeout
+QUERY_JOBS_TIME_BUDGET_SECONDS = 5.0
+
+
+def put_jobs(user_id: str, jobs: list[dict], dry_run: bool = False, job_ids: list[str] | None = None) -> list[dict]:
+    """Submit the jobs, charging the user for them.
+
+    Each job is given a new random ID unless `job_ids` gives the IDs of the jobs. A job whose ID is already in use
+    fails the transaction that would insert it, so that resubmitting a job with the same ID never inserts it or charges
+    for it twice.
+    """
+    user_record, from_cache = dynamo.user.get_user_for_submission(user_id)
+    credit_reset = dynamo.user.get_pending_credit_reset(user_record)
+    try:
+        return _put_jobs(user_record, credit_reset, jobs, dry_run, job_ids)
+    except InsufficientCreditsError:
+        # The cached record may be out of date, and so may the monthly credit reset, if another request performed it
+        if not from_cache and credit_reset is None:
+            raise
+    user_record, _ = dynamo.user.get_user_for_submission(user_id, use_cache=False)
+    return _put_jobs(user_record, dynamo.user.get_pending_credit_reset(user_record), jobs, dry_run, job_ids)
+
+
+def _put_jobs(
+    user_record: dict,
+    credit_reset: tuple[Decimal, str] | None,
+    jobs: list[dict],
+    dry_run: bool,
+    job_ids: list[str] | None = None,
+) -> list[dict]:
     request_time = current_utc_time()
+    user_id = user_record['user_id']
 
-    user_record = dynamo.user.get_or_create_user(user_id)
+    _raise_for_application_status(user_record['application_status'], user_id)
 
-    _raise_for_application_status(user_record['application_status'], user_record['user_id'])
-
-    remaining_credits = user_record['remaining_credits']
+    remaining_credits = user_record['remaining_credits'] if credit_reset is None else credit_reset[0]
     priority_override = user_record.get('priority_override')
 
     total_cost = Decimal('0.0')
     prepared_jobs = []
-    for job in jobs:
+    for i, job in enumerate(jobs):
         prepared_job = _prepare_job_for_database(
             job=job,
+            job_id=str(uuid4()) if job_ids is None else job_ids[i],
             user_id=user_id,
             request_time=request_time,
             remaining_credits=remaining_credits,
@@ -65,15 +146,180 @@ def put_jobs(user_id: str, jobs: list[dict], dry_run: bool = False) -> list[dict
 
     assert prepared_jobs[-1]['priority'] >= 0
     if not dry_run:
-        if remaining_credits is not None:
-            dynamo.user.decrement_credits(user_id, total_cost)
-        with table.batch_writer() as batch:
-            for prepared_job in prepared_jobs:
-                batch.put_item(Item=convert_floats_to_decimals(prepared_job))
+        try:
+            _write_jobs(
+                user_id,
+                prepared_jobs,
+                cost=total_cost if remaining_credits is not None else None,
+                credit_reset=credit_reset,
+                registration_time=dynamo.user.get_dispatch_registration_time(user_record),
+            )
+        finally:
+            if credit_reset is not None:
+                dynamo.user.invalidate_cached_user(user_id)
 
     return prepared_jobs
 
 
+def _write_jobs(
+    user_id: str,
+    jobs: list[dict],
+    cost: Decimal | None,
+    credit_reset: tuple[Decimal, str] | None = None,
+    registration_time: str | None = None,
+) -> None:
+    """Debit the cost of the jobs from the user's credits, insert the jobs and count their names.
+
+    The debit is written in the same transaction as the first jobs, so that it is never applied without them, and a
+    submission that fits in one transaction is all-or-nothing. The remaining jobs of a larger submission are written in
+    further transactions; if one of those fails, the cost of the jobs that were not inserted is refunded and
+    PartialJobSubmissionError reports which jobs were submitted. A failed transaction may still have been applied, as
+    when its response times out, so its jobs are looked up first and, if they exist, the submission carries on; if they
+    can't be looked up, the error is raised without a refund. JobIdInUseError is raised if the first transaction fails
+    because a job's ID belongs to an existing job.
+
+    A `cost` of None means the user has infinite credits. A `credit_reset` that is due is performed by the debit. A
+    `registration_time` registers the user for dispatch in the first transaction, by the debit if there is one, so that
+    the registration is never written without the jobs it stands for, nor they without it.
+    """
+    if cost is not None:
+        user_items = [dynamo.user.get_decrement_credits_item(user_id, cost, credit_reset, registration_time)]
+    elif registration_time is not None:
+        user_items = [dynamo.user.get_register_for_dispatch_item(user_id, registration_time)]
+    else:
+        user_items = []
+    chunks = _get_transaction_chunks(jobs, reserved_items=len(user_items))
+
+    try:
+        _transact_write_items(user_items + _get_transaction_items(user_id, chunks[0]))
+    except botocore.exceptions.ClientError as e:
+        reasons = _get_cancellation_reasons(e)
+        if cost is not None and reasons[:1] == ['ConditionalCheckFailed']:
+            raise InsufficientCreditsError(
+                f'These jobs would cost {cost} credits, which is more than you have remaining.'
+            )
+        job_reasons = reasons[len(user_items) : len(user_items) + len(chunks[0])]
+        job_ids_in_use = [
+            job['job_id'] for job, reason in zip(chunks[0], job_reasons) if reason == 'ConditionalCheckFailed'
+        ]
+        if job_ids_in_use:
+            raise JobIdInUseError(job_ids_in_use)
+        raise
+
+    submitted_count = len(chunks[0])
+    for chunk in chunks[1:]:
+        try:
+            _transact_write_items(_get_transaction_items(user_id, chunk))
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError):
+            # A transaction is all-or-nothing, so if all of its jobs exist, it was applied
+            chunk_job_ids = {job['job_id'] for job in chunk}
+            if get_existing_job_ids(list(chunk_job_ids)) == chunk_job_ids:
+                submitted_count += len(chunk)
+                continue
+            failed_jobs = jobs[submitted_count:]
+            refund = sum((job['credit_cost'] for job in failed_jobs), Decimal('0.0'))
+            if cost is not None and refund > Decimal(0):
+                dynamo.user.add_credits(user_id, refund)
+            raise PartialJobSubmissionError(jobs[:submitted_count], failed_jobs)
+        submitted_count += len(chunk)
+
+
+def _get_transaction_chunks(jobs: list[dict], reserved_items: int) -> list[list[dict]]:
+    """Split the jobs into transactions that fit DynamoDB's limit on the number of items.
+
+    Each transaction writes one item per job and one per distinct job name among its jobs. The first transaction also
+    writes `reserved_items` other items, such as the debit.
+    """
+    chunks: list[list[dict]] = []
+    chunk: list[dict] = []
+    names: set[str] = set()
+    item_count = reserved_items
+    for job in jobs:
+        new_names = {job['name']} - names if 'name' in job else set()
+        if chunk and item_count + 1 + len(new_names) > TRANSACT_WRITE_ITEMS_LIMIT:
+            chunks.append(chunk)
+            chunk, names, item_count = [], set(), 0
+            new_names = {job['name']} if 'name' in job else set()
+        chunk.append(job)
+        names.update(new_names)
+        item_count += 1 + len(new_names)
+    chunks.append(chunk)
+    return chunks
+
+
+def _get_transaction_items(user_id: str, jobs: list[dict]) -> list[dict]:
+    names = [job['name'] for job in jobs if 'name' in job]
+    return [_get_put_job_item(job) for job in jobs] + dynamo.job_names.get_add_job_names_items(user_id, names)
+
+
+def get_existing_job_ids(job_ids: list[str]) -> set[str]:
+    """Get those of the job IDs that belong to a job, with strongly consistent reads."""
+    return {job['job_id'] for job in _batch_get_jobs(job_ids, projection_expression='job_id')}
+
+
+def get_jobs_by_id(job_ids: list[str]) -> dict[str, dict]:
+    """Get those of the jobs that exist by their IDs, with strongly consistent reads."""
+    return {job['job_id']: _remove_index_keys(job) for job in _batch_get_jobs(job_ids)}
+
+
+def _batch_get_jobs(job_ids: list[str], projection_expression: str | None = None) -> list[dict]:
+    table_name = environ['JOBS_TABLE_NAME']
+    jobs: list[dict] = []
+    for i in range(0, len(job_ids), dynamo.user.DYNAMODB_BATCH_GET_LIMIT):
+        keys_and_attributes: dict = {
+            'Keys': [{'job_id': job_id} for job_id in job_ids[i : i + dynamo.user.DYNAMODB_BATCH_GET_LIMIT]],
+            'ConsistentRead': True,
+        }
+        if projection_expression is not None:
+            keys_and_attributes['ProjectionExpression'] = projection_expression
+        request_items: dict | None = {table_name: keys_and_attributes}
+        while request_items:
+            response = DYNAMODB_RESOURCE.batch_get_item(RequestItems=request_items)
+            jobs.extend(response['Responses'].get(table_name, []))
+            request_items = response.get('UnprocessedKeys')
+    return jobs
+
+
+def _get_put_job_item(job: dict) -> dict:
+    return {
+        'Put': {
+            'TableName': environ['JOBS_TABLE_NAME'],
+            'Item': convert_floats_to_decimals(_add_index_keys(job)),
+            'ConditionExpression': 'attribute_not_exists(job_id)',
+        }
+    }
+
+
+def _transact_write_items(items: list[dict]) -> None:
+    """Write the items in one transaction, retrying conflicts.
+
+    Every attempt uses the same client request token, so an attempt that succeeded without our knowing it is not
+    applied again.
+    """
+    client_request_token = str(uuid4())
+    for attempt in range(1, TRANSACTION_ATTEMPTS + 1):
+        try:
+            DYNAMODB_RESOURCE.meta.client.transact_write_items(
+                TransactItems=items, ClientRequestToken=client_request_token
+            )
+            return
+        except botocore.exceptions.ClientError as e:
+            if attempt == TRANSACTION_ATTEMPTS or not _is_retryable_transaction_error(e):
+                raise
+        time.sleep(TRANSACTION_RETRY_SECONDS * attempt)
+
+
+def _is_retryable_transaction_error(error: botocore.exceptions.ClientError) -> bool:
+    if error.response['Error']['Code'] == 'TransactionInProgressException':
+        return True
+    reasons = set(_get_cancellation_reasons(error))
+    return bool(reasons & RETRYABLE_CANCELLATION_REASONS) and 'ConditionalCheckFailed' not in reasons
+
+
+def _get_cancellation_reasons(error: botocore.exceptions.ClientError) -> list[str]:
+    return [reason.get('Code', 'None') for reason in error.response.get('CancellationReasons', [])]
+
+
 def _raise_for_application_status(application_status: str, user_id: str) -> None:
     if application_status == APPLICATION_NOT_STARTED:
         raise NotStartedApplicationError(user_id)
@@ -108,6 +354,7 @@ def _handle_content_bucket(job: dict) -> dict:
 
 def _prepare_job_for_database(
     job: dict,
+    job_id: str,
     user_id: str,
     request_time: str,
     remaining_credits: Decimal | None,
@@ -121,7 +368,7 @@ def _prepare_job_for_database(
     else:
         priority = min(round(remaining_credits - running_cost), 9999)
     prepared_job = {
-        'job_id': str(uuid4()),
+        'job_id': job_id,
         'user_id': user_id,
         'status_code': 'PENDING',
         'execution_started': False,
@@ -199,6 +446,54 @@ def _get_cost_parameter_value(job: dict, cost_parameter: str) -> str:
     return cost_parameter_value
 
 
+def _has_index(index_name: str) -> bool:
+    """Check whether a staged index is deployed and holds every job that it should."""
+    is_deployed = STAGED_INDEXES.index(index_name) < int(environ.get('JOBS_TABLE_INDEXES', 0))
+    return is_deployed and is_backfill_complete()
+
+
+def is_backfill_complete() -> bool:
+    """Check whether the backfill has added the index keys to every job, at most once a minute until it has."""
+    now = time.monotonic()
+    if not BACKFILL_STATUS.get('complete') and now >= BACKFILL_STATUS.get('next_check_time', 0):
+        table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+        marker = table.get_item(Key={'job_id': BACKFILL_MARKER_JOB_ID}).get('Item')
+        BACKFILL_STATUS.update(complete=marker is not None, next_check_time=now + BACKFILL_CHECK_SECONDS)
+    return bool(BACKFILL_STATUS.get('complete'))
+
+
+def _get_filter_index_key(user_id: str, value: str) -> str:
+    return f'{user_id}#{value}'
+
+
+def get_index_keys(job: dict) -> dict:
+    """Get the keys of the filter and dispatch indexes that the job belongs to."""
+    index_keys = {
+        index_name: _get_filter_index_key(job['user_id'], job[attribute])
+        for attribute, index_name in FILTER_INDEXES.items()
+        if job.get(attribute) is not None
+    }
+    if job.get('status_code') == 'PENDING' and not job.get('execution_started') and 'priority' in job:
+        index_keys[DISPATCH_PRIORITY] = _get_dispatch_priority(job)
+    return index_keys
+
+
+def _add_index_keys(job: dict) -> dict:
+    return {**job, **get_index_keys(job)}
+
+
+def _get_dispatch_priority(job: dict) -> str:
+    priority = max(0, min(int(job['priority']), MAX_PRIORITY))
+    return f'{MAX_PRIORITY - priority:04d}#{job["request_time"]}'
+
+
+def _remove_index_keys(job: dict) -> dict:
+    for index_name in FILTER_INDEXES.values():
+        job.pop(index_name, None)
+    job.pop(DISPATCH_PRIORITY, None)
+    return job
+
+
 def query_jobs(
     user: str,
     start: str | None = None,
@@ -207,50 +502,117 @@ def query_jobs(
     name: str | None = None,
     job_type: str | None = None,
     start_key: dict | None = None,
+    page_size: int | None = None,
 ) -> tuple[list[dict], dict | None]:
+    """Query a user's jobs, newest first.
+
+    Without a page size, a single page of results is read from DynamoDB, which may contain few or no jobs when
+    filters are given. With a page size, follow-up queries are made until the page is full, no jobs remain, or
+    `QUERY_JOBS_TIME_BUDGET_SECONDS` elapses, and the returned key continues from the last job returned.
+    """
     table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
 
-    key_expression = Key('user_id').eq(user)
+    params = _get_query_params(user, start, end, status_code, name, job_type)
+    if start_key is not None:
+        params['ExclusiveStartKey'] = start_key
+
+    deadline = time.monotonic() + QUERY_JOBS_TIME_BUDGET_SECONDS
+    jobs: list[dict] = []
+    while True:
+        response = table.query(**params)
+        jobs.extend(response['Items'])
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if page_size is None or last_evaluated_key is None or len(jobs) >= page_size or time.monotonic() >= deadline:
+            break
+        params['ExclusiveStartKey'] = last_evaluated_key
+
+    if page_size is not None and len(jobs) > page_size:
+        jobs = jobs[:page_size]
+        last_evaluated_key = _get_start_key(jobs[-1], params['IndexName'])
+
+    return [_remove_index_keys(job) for job in jobs], last_evaluated_key
+
+
+def _get_start_key(job: dict, index_name: str) -> dict:
+    return {attribute: job[attribute] for attribute in ('job_id', *INDEX_KEY_ATTRIBUTES[index_name])}
+
+
+def _get_query_params(
+    user: str,
+    start: str | None = None,
+    end: str | None = None,
+    status_code: str | None = None,
+    name: str | None = None,
+    job_type: str | None = None,
+) -> dict:
+    """Plan a query that reads only the jobs it returns wherever possible.
+
+    The first of the given filters whose index is deployed becomes a key condition, along with the user and time
+    range. Any remaining filters are applied to the items read from that index.
+    """
+    filters = {'name': name, 'status_code': status_code, 'job_type': job_type}
+    key_attribute = next(
+        (
+            attribute
+            for attribute, index_name in FILTER_INDEXES.items()
+            if filters[attribute] is not None and _has_index(index_name)
+        ),
+        None,
+    )
+
+    if key_attribute is None:
+        index_name = 'user_id'
+        key_expression = Key('user_id').eq(user)
+    else:
+        key_value = filters[key_attribute]
+        assert key_value is not None
+        index_name = FILTER_INDEXES[key_attribute]
+        key_expression = Key(index_name).eq(_get_filter_index_key(user, key_value))
     if start is not None or end is not None:
         key_expression &= get_request_time_expression(start, end)
 
     filter_expression = Attr('job_id').exists()
-    if status_code is not None:
-        filter_expression &= Attr('status_code').eq(status_code)
-    if name is not None:
-        filter_expression &= Attr('name').eq(name)
-    if job_type is not None:
-        filter_expression &= Attr('job_type').eq(job_type)
+    for attribute, value in filters.items():
+        if attribute != key_attribute and value is not None:
+            filter_expression &= Attr(attribute).eq(value)
 
-    params = {
-        'IndexName': 'user_id',
+    return {
+        'IndexName': index_name,
         'KeyConditionExpression': key_expression,
         'FilterExpression': filter_expression,
         'ScanIndexForward': False,
     }
-    if start_key is not None:
-        params['ExclusiveStartKey'] = start_key
-
-    response = table.query(**params)
-    jobs = response['Items']
-    return jobs, response.get('LastEvaluatedKey')
 
 
 def get_job(job_id: str) -> dict:
     table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
     response = table.get_item(Key={'job_id': job_id})
-    return response.get('Item')
+    job = response.get('Item')
+    if job is not None:
+        _remove_index_keys(job)
+    return job
 
 
 def update_job(job: dict) -> None:
-    """Update the job as it progresses through its execution."""
+    """Update the job as it progresses through its execution.
+
+    A new status code also updates the job's status code index key, which includes the job's user ID. Callers that
+    know the user ID should include it in the job, to save reading it from the table.
+    """
     table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
     primary_key = 'job_id'
     key = {'job_id': job[primary_key]}
 
     prepared_job = convert_floats_to_decimals(job)
+    user_id = prepared_job.pop('user_id', None)
+    if 'status_code' in prepared_job:
+        if user_id is None:
+            user_id = table.get_item(Key=key, ProjectionExpression='user_id')['Item']['user_id']
+        prepared_job[FILTER_INDEXES['status_code']] = _get_filter_index_key(user_id, prepared_job['status_code'])
     update_expression = 'SET {}'.format(','.join(f'{k}=:{k}' for k in prepared_job if k != primary_key))
     expression_attribute_values = {f':{k}': v for k, v in prepared_job.items() if k != primary_key}
+    if prepared_job.get('execution_started'):
+        update_expression += f' REMOVE {DISPATCH_PRIORITY}'
 
     table.update_item(
         Key=key,
@@ -262,21 +624,21 @@ def update_job(job: dict) -> None:
 def update_job_for_user(job_id: str, name: str | None, user_id: str) -> dict:
     """Update the user's job at their request."""
     if name is not None:
-        update_expression = 'SET #name = :name'
-        name_value = {':name': name}
+        update_expression = f'SET #name = :name, {FILTER_INDEXES["name"]} = :name_key'
+        name_value = {':name': name, ':name_key': _get_filter_index_key(user_id, name)}
     else:
-        update_expression = 'REMOVE #name'
+        update_expression = f'REMOVE #name, {FILTER_INDEXES["name"]}'
         name_value = {}
 
     table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
     try:
-        job = table.update_item(
+        old_job = table.update_item(
             Key={'job_id': job_id},
             UpdateExpression=update_expression,
             ConditionExpression='user_id = :user_id',  # Also implicitly checks that job exists
             ExpressionAttributeValues={':user_id': user_id, **name_value},
             ExpressionAttributeNames={'#name': 'name'},
-            ReturnValues='ALL_NEW',
+            ReturnValues='ALL_OLD',
             ReturnValuesOnConditionCheckFailure='ALL_OLD',
         )['Attributes']
     except botocore.exceptions.ClientError as e:
@@ -290,23 +652,205 @@ def update_job_for_user(job_id: str, name: str | None, user_id: str) -> dict:
                 )
         raise
 
+    # The backfill counts the names of jobs submitted before the job names table existed when it adds their name keys
+    old_name = old_job.get('name') if FILTER_INDEXES['name'] in old_job else None
+    dynamo.job_names.rename_job(user_id, old_name, name)
+
+    job = _remove_index_keys({key: value for key, value in old_job.items() if key != 'name'})
+    if name is not None:
+        job['name'] = name
     return job
 
 
-def get_jobs_waiting_for_execution(limit: int) -> list[dict]:
+def get_jobs_waiting_for_execution(limit: int, now: datetime | None = None) -> list[dict]:
+    """Get about `limit` jobs whose execution has not started, shared between users, by priority and then age.
+
+    The jobs of each user registered for dispatch are queried separately, so that a user with many waiting jobs can't
+    crowd out the others. Each user is first read an equal share of the limit, and the capacity left by users with
+    fewer waiting jobs is then shared between those who may have more. At most one job per user is read beyond the
+    limit, so the cost of a call doesn't grow with the number of users times the limit. Users with no jobs left waiting
+    or claimed are unregistered. Until the user_id_dispatch index is deployed and backfilled, up to `limit` jobs are read
+    from the status code index in no particular order, including jobs submitted before dispatch keys existed.
+    """
+    if not _has_index('user_id_dispatch'):
+        params = {
+            'IndexName': 'status_code',
+            'KeyConditionExpression': Key('status_code').eq('PENDING'),
+            'FilterExpression': Attr('execution_started').ne(True)
+            & (Attr(DISPATCH_PRIORITY).not_exists() | Attr(DISPATCH_PRIORITY).lt(CLAIMED_PREFIX)),
+        }
+        return [_remove_index_keys(job) for job in _query_jobs_table(params, limit)]
+
+    # Claimed jobs sort after waiting jobs, and are read only to tell whether the user can be unregistered
+    registrations = dynamo.user.get_dispatch_registrations()
+    jobs_by_user: dict[str, list[dict]] = {user_id: [] for user_id in registrations}
+    start_keys: dict[str, dict | None] = {user_id: None for user_id in registrations}
+    users_to_read = list(registrations)
+    remaining = limit
+    while users_to_read and remaining > 0:
+        limit_per_user = max(1, remaining // len(users_to_read))
+        with ThreadPoolExecutor(max_workers=CLAIM_CONCURRENCY) as executor:
+            pages = list(
+                executor.map(
+                    lambda user_id: _query_dispatch_index(user_id, limit_per_user, start_keys[user_id]),
+                    users_to_read,
+                )
+            )
+
+        more_to_read = []
+        for user_id, (user_jobs, start_key) in zip(users_to_read, pages):
+            waiting_jobs = [job for job in user_jobs if job[DISPATCH_PRIORITY] < CLAIMED_PREFIX]
+            jobs_by_user[user_id].extend(user_jobs)
+            start_keys[user_id] = start_key
+            remaining -= len(waiting_jobs)
+            # Only a user whose share was filled with waiting jobs may have more of them
+            if start_key is not None and len(waiting_jobs) == len(user_jobs):
+                more_to_read.append(user_id)
+        users_to_read = more_to_read
+
+    jobs: list[dict] = []
+    for (user_id, registration_time), user_jobs in zip(registrations.items(), jobs_by_user.values()):
+        if not user_jobs:
+            dynamo.user.unregister_for_dispatch(user_id, registration_time, now)
+        jobs.extend(job for job in user_jobs if job[DISPATCH_PRIORITY] < CLAIMED_PREFIX)
+    jobs.sort(key=lambda job: job[DISPATCH_PRIORITY])
+    return [_remove_index_keys(job) for job in jobs]
+
+
+def _query_dispatch_index(user_id: str, limit: int, start_key: dict | None) -> tuple[list[dict], dict | None]:
+    """Read up to `limit` more of the user's jobs from the user_id_dispatch index, continuing from `start_key`."""
+    table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+    params: dict = {'IndexName': 'user_id_dispatch', 'KeyConditionExpression': Key('user_id').eq(user_id)}
+    items: list[dict] = []
+    while len(items) < limit:
+        if start_key is not None:
+            params['ExclusiveStartKey'] = start_key
+        response = table.query(**params, Limit=limit - len(items))
+        items.extend(response['Items'])
+        start_key = response.get('LastEvaluatedKey')
+        if start_key is None:
+            break
+    return items, start_key
+
+
+def _query_jobs_table(params: dict, limit: int | None = None) -> list[dict]:
     table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+    params = params if limit is None else {**params, 'Limit': limit}
+    items: list[dict] = []
+    while True:
+        response = table.query(**params)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response or (limit is not None and len(items) >= limit):
+            return items[:limit]
+        params = {**params, 'ExclusiveStartKey': response['LastEvaluatedKey']}
+        if limit is not None:
+            params['Limit'] = limit - len(items)
+
+
+def get_jobs_from_stream_records(records: list[dict]) -> list[dict]:
+    """Get the newly submitted jobs from a batch of jobs table stream records."""
+    deserializer = TypeDeserializer()
+    jobs = []
+    for record in records:
+        if record['eventName'] != 'INSERT':
+            continue
+        job = {key: deserializer.deserialize(value) for key, value in record['dynamodb']['NewImage'].items()}
+        if job.get('status_code') == 'PENDING' and not job.get('execution_started'):
+            jobs.append(_remove_index_keys(job))
+    return jobs
+
+
+def claim_jobs(jobs: list[dict], now: datetime | None = None) -> list[dict]:
+    """Claim pending jobs for execution, returning the jobs that were claimed.
+
+    A job can only be claimed while it is waiting in the dispatch index, so of several overlapping invocations only one
+    claims each job. The claim is a lease: if the job's execution has not started when it expires,
+    `release_expired_claims` returns the job to the dispatch index. A job's user remains registered for dispatch while
+    the job is claimed. Jobs submitted before dispatch keys existed are claimed while their execution hasn't started.
+    """
+    now = datetime.now(tz=UTC) if now is None else now
+    claimed_priority = f'{CLAIMED_PREFIX}{format_time(now + timedelta(seconds=CLAIM_LEASE_SECONDS))}'
+    not_yet_keyed = Attr(DISPATCH_PRIORITY).not_exists() & Attr('status_code').eq('PENDING')
+    not_yet_keyed &= Attr('execution_started').ne(True)
+    with ThreadPoolExecutor(max_workers=CLAIM_CONCURRENCY) as executor:
+        claimed = list(
+            executor.map(
+                lambda job: _set_dispatch_priority(
+                    job['job_id'],
+                    claimed_priority,
+                    Attr(DISPATCH_PRIORITY).eq(_get_dispatch_priority(job)) | not_yet_keyed,
+                ),
+                jobs,
+            )
+        )
+    return [job for job, is_claimed in zip(jobs, claimed) if is_claimed]
+
+
+def release_jobs(jobs: list[dict]) -> None:
+    """Return claimed jobs whose execution did not start to the dispatch index."""
+    with ThreadPoolExecutor(max_workers=CLAIM_CONCURRENCY) as executor:
+        list(
+            executor.map(
+                lambda job: _set_dispatch_priority(
+                    job['job_id'], _get_dispatch_priority(job), Attr(DISPATCH_PRIORITY).begins_with(CLAIMED_PREFIX)
+                ),
+                jobs,
+            )
+        )
 
-    params = {
-        'IndexName': 'status_code',
-        'KeyConditionExpression': Key('status_code').eq('PENDING'),
-        'FilterExpression': Attr('execution_started').ne(True),
-    }
-    response = table.query(**params)
-    jobs = response['Items']
 
-    while 'LastEvaluatedKey' in response and len(jobs) < limit:
-        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
-        response = table.query(**params)
-        jobs.extend(response['Items'])
+def release_expired_claims(now: datetime | None = None) -> int:
+    """Return jobs whose claim expired before their execution started to the dispatch index.
+
+    Returns the number of jobs released.
+    """
+    now = datetime.now(tz=UTC) if now is None else now
+    expired_range = (CLAIMED_PREFIX, f'{CLAIMED_PREFIX}{format_time(now)}')
+    if _has_index('user_id_dispatch'):
+        with ThreadPoolExecutor(max_workers=CLAIM_CONCURRENCY) as executor:
+            jobs = [
+                job
+                for user_jobs in executor.map(
+                    lambda user_id: _query_jobs_table(
+                        {
+                            'IndexName': 'user_id_dispatch',
+                            'KeyConditionExpression': Key('user_id').eq(user_id)
+                            & Key(DISPATCH_PRIORITY).between(*expired_range),
+                        }
+                    ),
+                    dynamo.user.get_dispatch_registrations(),
+                )
+                for job in user_jobs
+            ]
+    else:
+        jobs = _query_jobs_table(
+            {
+                'IndexName': 'status_code',
+                'KeyConditionExpression': Key('status_code').eq('PENDING'),
+                'FilterExpression': Attr(DISPATCH_PRIORITY).between(*expired_range),
+            }
+        )
+
+    # The claim is checked again, in case the execution started since the query
+    return sum(
+        _set_dispatch_priority(
+            job['job_id'], _get_dispatch_priority(job), Attr(DISPATCH_PRIORITY).eq(job[DISPATCH_PRIORITY])
+        )
+        for job in jobs
+    )
+
 
-    return jobs[:limit]
+def _set_dispatch_priority(job_id: str, dispatch_priority: str, condition: ConditionBase) -> bool:
+    table = DYNAMODB_RESOURCE.Table(environ['JOBS_TABLE_NAME'])
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression=f'SET {DISPATCH_PRIORITY} = :dispatch_priority',
+            ConditionExpression=condition,
+            ExpressionAttributeValues={':dispatch_priority': dispatch_priority},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
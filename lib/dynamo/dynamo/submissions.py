@@ -0,0 +1,222 @@
+"""Bulk job submissions, which are stored in chunks and submitted in the background."""
+
+import json
+import time
+import zlib
+from os import environ
+from uuid import UUID, uuid4, uuid5
+
+import botocore.exceptions
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import Binary
+
+from dynamo.util import DYNAMODB_RESOURCE, current_utc_time
+
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+SUCCEEDED = 'SUCCEEDED'
+FAILED = 'FAILED'
+
+# Matches the maximum number of jobs in one POST /jobs request
+SUBMISSION_CHUNK_SIZE = 200
+
+# Keeps the submission record well within the DynamoDB item size limit
+MAX_SUBMISSION_ERRORS = 100
+
+SUBMISSION_ATTEMPTS = 3
+SUBMISSION_EXPIRATION_SECONDS = 30 * 24 * 60 * 60
+
+# A running submission is leased to the worker processing it, and the lease is renewed after every chunk. It outlasts
+# the worker Lambda's 15 minute timeout, so a submission whose lease has expired is no longer being processed and is
+# returned to pending by reclaim_expired_leases.
+SUBMISSION_LEASE_SECONDS = 16 * 60
+
+# Sort key of the lease_expiration index, present only while a submission is running, so that the index holds exactly
+# the running submissions by when their leases expire
+LEASE_EXPIRATION = 'lease_expiration_time'
+
+# Attributes used only by the submission worker, which are not returned to users
+INTERNAL_ATTRIBUTES = ('chunk_count', 'next_chunk', 'attempts', 'expiration_time', LEASE_EXPIRATION)
+
+
+def put_submission(user_id: str, jobs: list[dict]) -> dict:
+    """Store the jobs of a bulk submission and create its record.
+
+    The chunks are written before the record, because creating the record is what starts the submission worker.
+    """
+    submission_id = str(uuid4())
+    expiration_time = int(time.time()) + SUBMISSION_EXPIRATION_SECONDS
+    chunks = [jobs[i : i + SUBMISSION_CHUNK_SIZE] for i in range(0, len(jobs), SUBMISSION_CHUNK_SIZE)]
+
+    chunks_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSION_CHUNKS_TABLE_NAME'])
+    with chunks_table.batch_writer() as batch:
+        for chunk_index, chunk in enumerate(chunks):
+            batch.put_item(
+                Item={
+                    'submission_id': submission_id,
+                    'chunk_index': chunk_index,
+                    # Compressed to keep large chunks within the DynamoDB item size limit
+                    'jobs': Binary(zlib.compress(json.dumps(chunk).encode())),
+                    'expiration_time': expiration_time,
+                }
+            )
+
+    submission = {
+        'submission_id': submission_id,
+        'user_id': user_id,
+        'request_time': current_utc_time(),
+        'status_code': PENDING,
+        'job_count': len(jobs),
+        'processed_count': 0,
+        'submitted_count': 0,
+        'failed_count': 0,
+        'errors': [],
+        'chunk_count': len(chunks),
+        'next_chunk': 0,
+        'attempts': 0,
+        'expiration_time': expiration_time,
+    }
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    submissions_table.put_item(Item=submission)
+    return _remove_internal_attributes(submission)
+
+
+def get_submission(submission_id: str) -> dict | None:
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    submission = submissions_table.get_item(Key={'submission_id': submission_id}).get('Item')
+    if submission is None:
+        return None
+    return _remove_internal_attributes(submission)
+
+
+def get_job_id(submission_id: str, line: int) -> str:
+    """Get the ID of the job on a line of a submission, which is the same every time the line is submitted."""
+    return str(uuid5(UUID(submission_id), str(line)))
+
+
+def get_submission_chunk(submission_id: str, chunk_index: int) -> list[dict]:
+    chunks_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSION_CHUNKS_TABLE_NAME'])
+    item = chunks_table.get_item(Key={'submission_id': submission_id, 'chunk_index': chunk_index})['Item']
+    return json.loads(zlib.decompress(bytes(item['jobs'])))
+
+
+def start_processing(submission_id: str) -> dict | None:
+    """Claim a pending submission for processing, or return None if it isn't pending."""
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    try:
+        return submissions_table.update_item(
+            Key={'submission_id': submission_id},
+            UpdateExpression='SET status_code = :running, #lease_expiration = :lease_expiration_time',
+            ConditionExpression='status_code = :pending',
+            ExpressionAttributeNames={'#lease_expiration': LEASE_EXPIRATION},
+            ExpressionAttributeValues={
+                ':pending': PENDING,
+                ':running': RUNNING,
+                ':lease_expiration_time': int(time.time()) + SUBMISSION_LEASE_SECONDS,
+            },
+            ReturnValues='ALL_NEW',
+        )['Attributes']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+
+
+def record_chunk(
+    submission_id: str, chunk_index: int, job_count: int, submitted_count: int, errors: list[dict]
+) -> None:
+    """Record the outcome of submitting a chunk, appending its errors to those of the previous chunks.
+
+    Also renews the submission's lease.
+    """
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    submissions_table.update_item(
+        Key={'submission_id': submission_id},
+        UpdateExpression=(
+            'SET next_chunk = :next_chunk, #errors = list_append(#errors, :errors),'
+            ' #lease_expiration = :lease_expiration_time'
+            ' ADD processed_count :processed_count, submitted_count :submitted_count, failed_count :failed_count'
+        ),
+        ConditionExpression='status_code = :running AND next_chunk = :chunk_index',
+        ExpressionAttributeNames={'#errors': 'errors', '#lease_expiration': LEASE_EXPIRATION},
+        ExpressionAttributeValues={
+            ':running': RUNNING,
+            ':chunk_index': chunk_index,
+            ':next_chunk': chunk_index + 1,
+            ':lease_expiration_time': int(time.time()) + SUBMISSION_LEASE_SECONDS,
+            ':errors': errors,
+            ':processed_count': job_count,
+            ':submitted_count': submitted_count,
+            ':failed_count': job_count - submitted_count,
+        },
+    )
+
+
+def release_submission(submission_id: str, failed_attempt: bool) -> None:
+    """Return a running submission to pending, which starts the submission worker again."""
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    submissions_table.update_item(
+        Key={'submission_id': submission_id},
+        UpdateExpression='SET status_code = :pending REMOVE #lease_expiration ADD attempts :attempts',
+        ConditionExpression='status_code = :running',
+        ExpressionAttributeNames={'#lease_expiration': LEASE_EXPIRATION},
+        ExpressionAttributeValues={':pending': PENDING, ':running': RUNNING, ':attempts': int(failed_attempt)},
+    )
+
+
+def reclaim_expired_leases(now: int | None = None) -> int:
+    """Return the running submissions whose lease has expired to pending, counting a failed attempt for each.
+
+    A submission's lease expires when the worker processing it stopped without releasing it, such as when it timed out.
+    Returns the number of submissions reclaimed.
+    """
+    if now is None:
+        now = int(time.time())
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    params = {
+        'IndexName': 'lease_expiration',
+        'KeyConditionExpression': Key('status_code').eq(RUNNING) & Key(LEASE_EXPIRATION).lt(now),
+    }
+    response = submissions_table.query(**params)
+    submission_ids = [item['submission_id'] for item in response['Items']]
+    while 'LastEvaluatedKey' in response:
+        response = submissions_table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **params)
+        submission_ids.extend(item['submission_id'] for item in response['Items'])
+
+    reclaimed_count = 0
+    for submission_id in submission_ids:
+        try:
+            submissions_table.update_item(
+                Key={'submission_id': submission_id},
+                UpdateExpression='SET status_code = :pending REMOVE #lease_expiration ADD attempts :attempts',
+                ConditionExpression='status_code = :running AND #lease_expiration < :now',
+                ExpressionAttributeNames={'#lease_expiration': LEASE_EXPIRATION},
+                ExpressionAttributeValues={':pending': PENDING, ':running': RUNNING, ':attempts': 1, ':now': now},
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            continue
+        reclaimed_count += 1
+    return reclaimed_count
+
+
+def finish_submission(submission_id: str, status_code: str, detail: str | None = None) -> None:
+    submissions_table = DYNAMODB_RESOURCE.Table(environ['SUBMISSIONS_TABLE_NAME'])
+    update_expression = 'SET status_code = :status_code'
+    expression_attribute_values = {':status_code': status_code, ':running': RUNNING}
+    if detail is not None:
+        update_expression += ', detail = :detail'
+        expression_attribute_values[':detail'] = detail
+    submissions_table.update_item(
+        Key={'submission_id': submission_id},
+        UpdateExpression=f'{update_expression} REMOVE #lease_expiration',
+        ConditionExpression='status_code = :running',
+        ExpressionAttributeNames={'#lease_expiration': LEASE_EXPIRATION},
+        ExpressionAttributeValues=expression_attribute_values,
+    )
+
+
+def _remove_internal_attributes(submission: dict) -> dict:
+    return {key: value for key, value in submission.items() if key not in INTERNAL_ATTRIBUTES}
@@ -1,11 +1,12 @@
 import os
-from datetime import UTC, datetime
+import time
+from collections import OrderedDict
+from datetime import UTC, datetime, timedelta
 from decimal import Decimal
 from os import environ
 from typing import Any
 
 import botocore.exceptions
-import requests
 
 import dynamo.util
 from dynamo.exceptions import (
@@ -16,6 +17,7 @@ from dynamo.exceptions import (
     InvalidApplicationStatusError,
     RejectedApplicationError,
 )
+from dynamo.http_session import HTTP_SESSION
 from dynamo.util import DYNAMODB_RESOURCE
 
 
@@ -24,6 +26,27 @@ APPLICATION_PENDING = 'PENDING'
 APPLICATION_APPROVED = 'APPROVED'
 APPLICATION_REJECTED = 'REJECTED'
 
+DISPATCH_LIMIT_ATTRIBUTES = (
+    '_dispatch_jobs_per_minute',
+    '_dispatch_burst',
+    '_dispatch_tokens',
+    '_dispatch_tokens_time',
+)
+DYNAMODB_BATCH_GET_LIMIT = 100
+
+# Users with jobs waiting to be dispatched are registered in a sparse index, so that the dispatcher can query each
+# user's jobs. A registration stands for at least this long, even if the user has no waiting jobs, so that it covers
+# jobs that are still being written.
+DISPATCH_REGISTRATION = '_dispatch_registration_time'
+DISPATCH_REGISTRATION_SECONDS = 300
+
+# User records cached for job submissions, which trust only the attributes that rarely change: application_status,
+# priority_override, credits_per_month and whether the user's credits are infinite. Only the submissions of users with
+# a priority override or infinite credits are served from it; get_or_create_user refreshes it but always reads the table.
+USER_CACHE_SECONDS = 60
+USER_CACHE_MAX_SIZE = 10_000
+USER_CACHE: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
 
 def update_user(user_id: str, edl_access_token: str, body: dict) -> dict:
     user = get_or_create_user(user_id)
@@ -67,6 +90,7 @@ def update_user(user_id: str, edl_access_token: str, body: dict) -> dict:
                 raise DatabaseConditionException(f'Failed to update record for user {user_id}')
             raise
         user = _reset_credits_if_needed(user=user, current_month=_get_current_month(), users_table=users_table)
+        invalidate_cached_user(user_id)
         return user
     if application_status == APPLICATION_REJECTED:
         raise RejectedApplicationError(user_id)
@@ -92,7 +116,7 @@ def _validate_access_code(access_code: str) -> None:
 
 def _get_edl_profile(user_id: str, edl_access_token: str) -> dict:
     url = f'https://urs.earthdata.nasa.gov/api/users/{user_id}'
-    response = requests.get(url, headers={'Authorization': f'Bearer {edl_access_token}'})
+    response = HTTP_SESSION.get(url, headers={'Authorization': f'Bearer {edl_access_token}'})
     response.raise_for_status()
     return response.json()
 
@@ -104,7 +128,9 @@ def get_or_create_user(user_id: str) -> dict:
     if user is None:
         user = _create_user(user_id, users_table)
 
-    return _reset_credits_if_needed(user=user, current_month=_get_current_month(), users_table=users_table)
+    user = _reset_credits_if_needed(user=user, current_month=_get_current_month(), users_table=users_table)
+    _cache_user(user)
+    return user
 
 
 def _get_current_month() -> str:
@@ -126,29 +152,70 @@ def _create_user(user_id: str, users_table: Any) -> dict:  # noqa: ANN401
     return user
 
 
-def _reset_credits_if_needed(user: dict, current_month: str, users_table: Any) -> dict:  # noqa: ANN401
+def get_user_for_submission(user_id: str, use_cache: bool = True) -> tuple[dict, bool]:
+    """Get a user's record for submitting jobs, and whether it came from the cache.
+
+    The cached record is used only if the priority of the user's jobs doesn't depend on their remaining credits, that
+    is, if they have a priority override or infinite credits; its `remaining_credits` may be out of date, but the
+    conditional debit of the credits catches that. A monthly credit reset that is due is not written here, but by the
+    same write that debits the credits; see get_decrement_credits_item.
+    """
+    if use_cache:
+        user = _get_cached_user(user_id)
+        if user is not None and (user.get('priority_override') or user['remaining_credits'] is None):
+            return user, True
+
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    user = users_table.get_item(Key={'user_id': user_id}).get('Item')
+    if user is None:
+        user = _create_user(user_id, users_table)
+    _cache_user(user)
+    return user, False
+
+
+def invalidate_cached_user(user_id: str) -> None:
+    USER_CACHE.pop(user_id, None)
+
+
+def _get_cached_user(user_id: str) -> dict | None:
+    cached = USER_CACHE.get(user_id)
+    if cached is None or cached[0] <= time.monotonic():
+        return None
+    return dict(cached[1])
+
+
+def _cache_user(user: dict) -> None:
+    USER_CACHE[user['user_id']] = (time.monotonic() + USER_CACHE_SECONDS, dict(user))
+    USER_CACHE.move_to_end(user['user_id'])
+    while len(USER_CACHE) > USER_CACHE_MAX_SIZE:
+        USER_CACHE.popitem(last=False)
+
+
+def get_pending_credit_reset(user: dict) -> tuple[Decimal, str] | None:
+    """Get the credits that a user's remaining credits are reset to and the current month, if their reset is due."""
+    current_month = _get_current_month()
+    reset_credits = _get_reset_credits(user, current_month)
+    if reset_credits is None:
+        return None
+    return reset_credits, current_month
+
+
+def _get_reset_credits(user: dict, current_month: str) -> Decimal | None:
     if (
         user['application_status'] == APPLICATION_APPROVED
         and user.get('_month_of_last_credit_reset', '0') < current_month
         and user['remaining_credits'] is not None
     ):
+        return user.get('credits_per_month', Decimal(os.environ['DEFAULT_CREDITS_PER_USER']))
+    return None
+
+
+def _reset_credits_if_needed(user: dict, current_month: str, users_table: Any) -> dict:  # noqa: ANN401
+    reset_credits = _get_reset_credits(user, current_month)
+    if reset_credits is not None:
         try:
             user = users_table.update_item(
-                Key={'user_id': user['user_id']},
-                UpdateExpression='SET remaining_credits = :credits, #month_of_last_credit_reset = :current_month',
-                ConditionExpression=(
-                    'application_status = :approved'
-                    ' AND (attribute_not_exists(#month_of_last_credit_reset)'
-                    '      OR #month_of_last_credit_reset < :current_month)'
-                    ' AND attribute_type(remaining_credits, :number)'
-                ),
-                ExpressionAttributeNames={'#month_of_last_credit_reset': '_month_of_last_credit_reset'},
-                ExpressionAttributeValues={
-                    ':approved': APPLICATION_APPROVED,
-                    ':credits': user.get('credits_per_month', Decimal(os.environ['DEFAULT_CREDITS_PER_USER'])),
-                    ':current_month': current_month,
-                    ':number': 'N',
-                },
+                **_get_credit_reset_params(user['user_id'], reset_credits, current_month),
                 ReturnValues='ALL_NEW',
             )['Attributes']
         except botocore.exceptions.ClientError as e:
@@ -177,27 +244,78 @@ def _reset_credits_if_needed(user: dict, current_month: str, users_table: Any) -
 
 
 def decrement_credits(user_id: str, cost: Decimal) -> None:
-    if cost <= Decimal(0):
-        raise ValueError(f'Cost {cost} <= 0')
-
     users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
     try:
-        users_table.update_item(
-            Key={'user_id': user_id},
-            UpdateExpression='ADD remaining_credits :delta',
-            ConditionExpression='remaining_credits >= :cost',
-            ExpressionAttributeValues={':cost': cost, ':delta': -cost},
-        )
+        users_table.update_item(**_get_decrement_credits_params(user_id, cost))
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
             raise DatabaseConditionException(f'Failed to decrement credits for user {user_id}')
         raise
 
 
+def get_decrement_credits_item(
+    user_id: str,
+    cost: Decimal,
+    credit_reset: tuple[Decimal, str] | None = None,
+    registration_time: str | None = None,
+) -> dict:
+    """Get a TransactWriteItems item that decrements the user's credits, on condition that they have enough.
+
+    If a `credit_reset` from get_pending_credit_reset is given, the item also performs the user's monthly credit reset,
+    on condition that it hasn't been performed yet, so that the reset doesn't need a write of its own. Likewise, a
+    `registration_time` from get_dispatch_registration_time registers the user for dispatch.
+    """
+    if credit_reset is None:
+        params = _get_decrement_credits_params(user_id, cost)
+    else:
+        reset_credits, current_month = credit_reset
+        if cost <= Decimal(0):
+            raise ValueError(f'Cost {cost} <= 0')
+        if cost > reset_credits:
+            raise ValueError(f'Cost {cost} > {reset_credits}')
+        params = _get_credit_reset_params(user_id, reset_credits - cost, current_month)
+    if registration_time is not None:
+        params = _add_dispatch_registration(params, registration_time)
+    return {'Update': {'TableName': environ['USERS_TABLE_NAME'], **params}}
+
+
+def _get_credit_reset_params(user_id: str, credits: Decimal, current_month: str) -> dict:
+    return {
+        'Key': {'user_id': user_id},
+        'UpdateExpression': 'SET remaining_credits = :credits, #month_of_last_credit_reset = :current_month',
+        'ConditionExpression': (
+            'application_status = :approved'
+            ' AND (attribute_not_exists(#month_of_last_credit_reset)'
+            '      OR #month_of_last_credit_reset < :current_month)'
+            ' AND attribute_type(remaining_credits, :number)'
+        ),
+        'ExpressionAttributeNames': {'#month_of_last_credit_reset': '_month_of_last_credit_reset'},
+        'ExpressionAttributeValues': {
+            ':approved': APPLICATION_APPROVED,
+            ':credits': credits,
+            ':current_month': current_month,
+            ':number': 'N',
+        },
+    }
+
+
+def _get_decrement_credits_params(user_id: str, cost: Decimal) -> dict:
+    if cost <= Decimal(0):
+        raise ValueError(f'Cost {cost} <= 0')
+
+    return {
+        'Key': {'user_id': user_id},
+        'UpdateExpression': 'ADD remaining_credits :delta',
+        'ConditionExpression': 'remaining_credits >= :cost',
+        'ExpressionAttributeValues': {':cost': cost, ':delta': -cost},
+    }
+
+
 def add_credits(user_id: str, value: Decimal) -> None:
     if value <= Decimal(0):
         raise ValueError(f'Cannot add credits: {value} <= 0')
 
+    invalidate_cached_user(user_id)
     users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
     try:
         users_table.update_item(
@@ -225,3 +343,177 @@ def add_credits(user_id: str, value: Decimal) -> None:
             raise DatabaseConditionException(
                 f'User {user_id} attribute remaining_credits is not a number: {e.response["Item"]["remaining_credits"]}'
             )
+
+
+def get_dispatch_limits(user_ids: list[str]) -> dict[str, dict]:
+    """Get the dispatch rate limits of the given users, for those users that have one.
+
+    A user's limit is configured with the `_dispatch_jobs_per_minute` attribute and, optionally, `_dispatch_burst`,
+    which defaults to one minute's worth of jobs. The `_dispatch_tokens` and `_dispatch_tokens_time` attributes hold
+    the state of the user's token bucket.
+    """
+    table_name = environ['USERS_TABLE_NAME']
+    limits = {}
+    for i in range(0, len(user_ids), DYNAMODB_BATCH_GET_LIMIT):
+        request_items = {
+            table_name: {
+                'Keys': [{'user_id': user_id} for user_id in user_ids[i : i + DYNAMODB_BATCH_GET_LIMIT]],
+                'ProjectionExpression': ', '.join(['user_id', *(f'#{name[1:]}' for name in DISPATCH_LIMIT_ATTRIBUTES)]),
+                'ExpressionAttributeNames': {f'#{name[1:]}': name for name in DISPATCH_LIMIT_ATTRIBUTES},
+            }
+        }
+        while request_items:
+            response = DYNAMODB_RESOURCE.batch_get_item(RequestItems=request_items)
+            for user in response['Responses'].get(table_name, []):
+                if '_dispatch_jobs_per_minute' in user:
+                    limits[user['user_id']] = user
+            request_items = response.get('UnprocessedKeys')
+    return limits
+
+
+def update_dispatch_tokens(
+    user_id: str, tokens: Decimal, tokens_time: Decimal, previous_tokens_time: Decimal | None
+) -> bool:
+    """Save the state of a user's dispatch token bucket, unless another dispatcher has saved it since it was read."""
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    if previous_tokens_time is None:
+        condition_expression = 'attribute_not_exists(#tokens_time)'
+        expression_attribute_values = {':tokens': tokens, ':tokens_time': tokens_time}
+    else:
+        condition_expression = '#tokens_time = :previous_tokens_time'
+        expression_attribute_values = {
+            ':tokens': tokens,
+            ':tokens_time': tokens_time,
+            ':previous_tokens_time': previous_tokens_time,
+        }
+    try:
+        users_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='SET #tokens = :tokens, #tokens_time = :tokens_time',
+            ConditionExpression=condition_expression,
+            ExpressionAttributeNames={'#tokens': '_dispatch_tokens', '#tokens_time': '_dispatch_tokens_time'},
+            ExpressionAttributeValues=expression_attribute_values,
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def add_dispatch_tokens(user_id: str, tokens: int) -> None:
+    """Return dispatch tokens that were spent on jobs that were not submitted to a user with a dispatch limit."""
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    try:
+        users_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='ADD #tokens :tokens',
+            ConditionExpression='attribute_exists(#tokens)',
+            ExpressionAttributeNames={'#tokens': '_dispatch_tokens'},
+            ExpressionAttributeValues={':tokens': Decimal(tokens)},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def register_for_dispatch(user: dict, now: datetime | None = None) -> None:
+    """Register the user as having jobs waiting to be dispatched, before the jobs are written.
+
+    The write is skipped if the user's record shows a registration recent enough that it will stand until the jobs
+    are written. Job submissions instead register the user in the transaction that writes the jobs; see
+    get_dispatch_registration_time.
+    """
+    registration_time = get_dispatch_registration_time(user, now)
+    if registration_time is None:
+        return
+
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    users_table.update_item(**_get_dispatch_registration_params(user['user_id'], registration_time))
+
+
+def get_dispatch_registration_time(user: dict, now: datetime | None = None) -> str | None:
+    """Get the time to register the user for dispatch with, if they need registering.
+
+    Returns None if the user's record shows a registration recent enough that it will stand until their jobs are
+    written.
+    """
+    now = datetime.now(tz=UTC) if now is None else now
+    registration_time = user.get(DISPATCH_REGISTRATION)
+    if registration_time is not None and registration_time >= dynamo.util.format_time(
+        now - timedelta(seconds=DISPATCH_REGISTRATION_SECONDS / 2)
+    ):
+        return None
+    return dynamo.util.format_time(now)
+
+
+def get_register_for_dispatch_item(user_id: str, registration_time: str) -> dict:
+    """Get a TransactWriteItems item that registers the user for dispatch, for submissions without a debit."""
+    return {
+        'Update': {
+            'TableName': environ['USERS_TABLE_NAME'],
+            **_get_dispatch_registration_params(user_id, registration_time),
+        }
+    }
+
+
+def _get_dispatch_registration_params(user_id: str, registration_time: str) -> dict:
+    return {
+        'Key': {'user_id': user_id},
+        'UpdateExpression': 'SET #registration = :registration',
+        'ExpressionAttributeNames': {'#registration': DISPATCH_REGISTRATION},
+        'ExpressionAttributeValues': {':registration': registration_time},
+    }
+
+
+def _add_dispatch_registration(params: dict, registration_time: str) -> dict:
+    """Add the user's registration for dispatch to the params of another update of their record."""
+    update_expression = params['UpdateExpression']
+    if update_expression.startswith('SET '):
+        update_expression = f'{update_expression}, #registration = :registration'
+    else:
+        update_expression = f'SET #registration = :registration {update_expression}'
+    return {
+        **params,
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeNames': {
+            **params.get('ExpressionAttributeNames', {}),
+            '#registration': DISPATCH_REGISTRATION,
+        },
+        'ExpressionAttributeValues': {**params['ExpressionAttributeValues'], ':registration': registration_time},
+    }
+
+
+def get_dispatch_registrations() -> dict[str, str]:
+    """Get the time each user with jobs waiting to be dispatched was last registered."""
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    params: dict = {'IndexName': 'dispatch_registration'}
+    registrations = {}
+    while True:
+        response = users_table.scan(**params)
+        registrations.update({user['user_id']: user[DISPATCH_REGISTRATION] for user in response['Items']})
+        if 'LastEvaluatedKey' not in response:
+            return registrations
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def unregister_for_dispatch(user_id: str, registration_time: str, now: datetime | None = None) -> bool:
+    """Remove a user's registration for dispatch, unless it is recent or the user has registered again since."""
+    now = datetime.now(tz=UTC) if now is None else now
+    if registration_time >= dynamo.util.format_time(now - timedelta(seconds=DISPATCH_REGISTRATION_SECONDS)):
+        return False
+
+    users_table = DYNAMODB_RESOURCE.Table(environ['USERS_TABLE_NAME'])
+    try:
+        users_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='REMOVE #registration',
+            ConditionExpression='#registration = :registration',
+            ExpressionAttributeNames={'#registration': DISPATCH_REGISTRATION},
+            ExpressionAttributeValues={':registration': registration_time},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
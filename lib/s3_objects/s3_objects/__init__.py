@@ -0,0 +1,25 @@
+import urllib.parse
+from typing import Any
+
+
+FILE_TYPE_TAG = 'file_type'
+
+
+def get_file_type_tagging(file_type: str) -> str:
+    """Get the `Tagging` parameter of an S3 upload that tags the object with its file type."""
+    return urllib.parse.urlencode({FILE_TYPE_TAG: file_type})
+
+
+def put_object_with_file_type(
+    s3_client: Any,  # noqa: ANN401
+    bucket: str,
+    key: str,
+    body: bytes | str,
+    file_type: str,
+    **kwargs: str,
+) -> dict:
+    """Upload an object tagged with its file type.
+
+    The tags are set by the same request as the object, so the object is never visible without them.
+    """
+    return s3_client.put_object(Bucket=bucket, Key=key, Body=body, Tagging=get_file_type_tagging(file_type), **kwargs)
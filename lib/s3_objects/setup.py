@@ -0,0 +1,13 @@
+from setuptools import find_packages, setup
+
+
+setup(
+    name='s3_objects',
+    license='BSD',
+    include_package_data=True,
+    install_requires=[
+        'boto3',
+    ],
+    python_requires='~=3.13',
+    packages=find_packages(),
+)
@@ -6,7 +6,21 @@ import pytest
 import yaml
 from moto import mock_aws
 
-from dynamo.user import APPLICATION_APPROVED
+from dynamo.jobs import BACKFILL_STATUS
+from dynamo.user import APPLICATION_APPROVED, USER_CACHE
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-benchmarks', action='store_true', help='run tests marked as benchmarks')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-benchmarks'):
+        return
+    skip_benchmark = pytest.mark.skip(reason='benchmarks only run with --run-benchmarks')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip_benchmark)
 
 
 @pytest.fixture
@@ -15,16 +29,27 @@ def table_properties():
         jobs_table = get_table_properties_from_template('JobsTable')
         users_table = get_table_properties_from_template('UsersTable')
         access_codes_table = get_table_properties_from_template('AccessCodesTable')
+        job_names_table = get_table_properties_from_template('JobNamesTable')
+        idempotency_keys_table = get_table_properties_from_template('IdempotencyKeysTable')
+        submissions_table = get_table_properties_from_template('SubmissionsTable')
+        submission_chunks_table = get_table_properties_from_template('SubmissionChunksTable')
 
     return TableProperties()
 
 
 def get_table_properties_from_template(resource_name):
     yaml.SafeLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+    # Deploy every conditional resource property, such as the jobs table's secondary indexes
+    yaml.SafeLoader.add_constructor('!If', lambda loader, node: loader.construct_object(node.value[1], deep=True))
     template_file = Path(__file__).parent / '../apps/main-cf.yml'
     with Path(template_file).open() as f:
         template = yaml.safe_load(f)
     table_properties = template['Resources'][resource_name]['Properties']
+    if 'StreamSpecification' in table_properties:
+        # CloudFormation enables a stream when one is specified, but the DynamoDB API must be told explicitly
+        table_properties['StreamSpecification']['StreamEnabled'] = True
+    # Time to Live is configured with a separate DynamoDB API call
+    table_properties.pop('TimeToLiveSpecification', None)
     return table_properties
 
 
@@ -46,8 +71,29 @@ def tables(table_properties):
                 TableName=environ['ACCESS_CODES_TABLE_NAME'],
                 **table_properties.access_codes_table,
             )
+            job_names_table = DYNAMODB_RESOURCE.create_table(
+                TableName=environ['JOB_NAMES_TABLE_NAME'],
+                **table_properties.job_names_table,
+            )
+            idempotency_keys_table = DYNAMODB_RESOURCE.create_table(
+                TableName=environ['IDEMPOTENCY_KEYS_TABLE_NAME'],
+                **table_properties.idempotency_keys_table,
+            )
+            submissions_table = DYNAMODB_RESOURCE.create_table(
+                TableName=environ['SUBMISSIONS_TABLE_NAME'],
+                **table_properties.submissions_table,
+            )
+            submission_chunks_table = DYNAMODB_RESOURCE.create_table(
+                TableName=environ['SUBMISSION_CHUNKS_TABLE_NAME'],
+                **table_properties.submission_chunks_table,
+            )
 
         tables = Tables()
+        # Cached user records would outlive the tables they were read from
+        USER_CACHE.clear()
+        # Tests start from a jobs table whose backfill is complete, without its marker among their jobs
+        BACKFILL_STATUS.clear()
+        BACKFILL_STATUS['complete'] = True
         yield tables
 
 
@@ -9,6 +9,7 @@ import pytest
 import responses
 
 from hyp3_api import CMR_URL, app
+from hyp3_api.granule_cache import GRANULE_METADATA_CACHE
 
 
 AUTH_COOKIE = 'asf-urs'
@@ -23,6 +24,11 @@ FUTURE_DATE = (date.today() + timedelta(days=1)).strftime('%Y-%m-%d')
 CMR_URL_RE = re.compile(f'{CMR_URL}.*')
 
 
+@pytest.fixture(autouse=True)
+def clear_granule_metadata_cache():
+    GRANULE_METADATA_CACHE.clear()
+
+
 @pytest.fixture
 def client():
     with app.test_client() as test_client:
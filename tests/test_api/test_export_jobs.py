@@ -0,0 +1,61 @@
+import json
+from http import HTTPStatus
+
+import dynamo
+from test_api.conftest import JOBS_URI, login, make_db_record
+
+
+EXPORT_URI = f'{JOBS_URI}/export'
+
+
+def test_export_jobs(client, tables):
+    # Large items split the jobs across several DynamoDB pages
+    padding = 'x' * 100_000
+    items = [
+        make_db_record(
+            f'{i:08d}-7636-494d-9496-03ea4a7df266',
+            request_time=f'2019-12-31T10:00:{i:02d}+00:00',
+            status_code='FAILED' if i % 3 == 0 else 'SUCCEEDED',
+            name='export',
+            files=[{'filename': padding, 'size': 1, 'url': 'https://example.com/foo.zip', 's3': {}}],
+        )
+        for i in range(30)
+    ]
+    for item in items:
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(make_db_record('job-for-other-user', user_id='foo')))
+
+    login(client)
+    exported: list[dict] = []
+    response = client.get(EXPORT_URI)
+    assert 'Link' in response.headers
+    while True:
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'application/x-ndjson'
+        exported.extend(json.loads(line) for line in response.text.splitlines())
+        if 'Link' not in response.headers:
+            break
+        next_url, rel = response.headers['Link'].split('; ')
+        assert rel == 'rel="next"'
+        response = client.get(next_url.strip('<>'))
+    assert exported == list(reversed(items))
+
+    response = client.get(EXPORT_URI, query_string={'status_code': 'FAILED', 'start': '2019-12-31T10:00:10Z'})
+    assert response.status_code == HTTPStatus.OK
+    expected = [item for item in reversed(items) if item['status_code'] == 'FAILED'][:-4]
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+    response = client.get(EXPORT_URI, query_string={'name': 'does not exist'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.text == ''
+
+    response = client.get(EXPORT_URI, query_string={'status_code': 'BAD'})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    response = client.get(EXPORT_URI, query_string={'start_token': 'BAD'})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_export_jobs_not_authenticated(client):
+    response = client.get(EXPORT_URI)
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
@@ -1,5 +1,6 @@
 from http import HTTPStatus
 
+import dynamo.jobs
 from dynamo.user import APPLICATION_APPROVED, APPLICATION_NOT_STARTED, APPLICATION_REJECTED
 from dynamo.util import current_utc_time
 from test_api.conftest import USER_URI, login, make_db_record
@@ -53,6 +54,8 @@ def test_get_user_with_jobs(client, tables):
     ]
     for item in items:
         tables.jobs_table.put_item(Item=item)
+    tables.job_names_table.put_item(Item={'user_id': user_id, 'name': 'job1', 'job_count': 2})
+    tables.job_names_table.put_item(Item={'user_id': user_id, 'name': 'job2', 'job_count': 1})
 
     login(client, 'user_with_jobs')
     response = client.get(USER_URI)
@@ -67,3 +70,15 @@ def test_get_user_with_jobs(client, tables):
             'job2',
         ],
     }
+
+
+def test_get_user_before_backfill(client, tables):
+    request_time = current_utc_time()
+    tables.jobs_table.put_item(Item=make_db_record('job1', user_id='user', request_time=request_time, name='a'))
+    tables.job_names_table.put_item(Item={'user_id': 'user', 'name': 'b', 'job_count': 1})
+    dynamo.jobs.BACKFILL_STATUS.clear()
+
+    login(client, 'user')
+    response = client.get(USER_URI)
+    assert response.status_code == HTTPStatus.OK
+    assert response.json['job_names'] == ['a']
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+from shapely.geometry import Polygon
+
+from conftest import get_table_properties_from_template
+from dynamo import DYNAMODB_RESOURCE
+from hyp3_api.granule_cache import GranuleMetadataCache
+
+
+POLYGON = Polygon([[1, 0], [3, 2], [5, 4], [7, 6]])
+
+
+@pytest.fixture
+def granule_metadata_table(tables):
+    table_properties = get_table_properties_from_template('GranuleMetadataTable')
+    return DYNAMODB_RESOURCE.create_table(TableName='hyp3-db-table-granule-metadata', **table_properties)
+
+
+def test_get_and_put():
+    cache = GranuleMetadataCache()
+    assert cache.get(['foo', 'bar']) == {}
+    assert cache.stats == {'memory_hits': 0, 'dynamodb_hits': 0, 'misses': 2}
+
+    cache.put([{'name': 'foo', 'polygon': POLYGON}])
+    assert cache.get({'foo', 'bar'}) == {'foo': POLYGON}
+    assert cache.stats == {'memory_hits': 1, 'dynamodb_hits': 0, 'misses': 3}
+
+    cache.clear()
+    assert cache.get(['foo']) == {}
+    assert cache.stats == {'memory_hits': 0, 'dynamodb_hits': 0, 'misses': 1}
+
+
+def test_expiration(monkeypatch):
+    cache = GranuleMetadataCache(ttl_seconds=10)
+    cache.put([{'name': 'foo', 'polygon': POLYGON}])
+    assert cache.get(['foo']) == {'foo': POLYGON}
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get(['foo']) == {}
+
+
+def test_max_size():
+    cache = GranuleMetadataCache(max_size=2)
+    cache.put([{'name': 'foo', 'polygon': POLYGON}, {'name': 'bar', 'polygon': POLYGON}])
+    assert cache.get(['foo']) == {'foo': POLYGON}
+
+    cache.put([{'name': 'baz', 'polygon': POLYGON}])
+    assert cache.get(['foo', 'bar', 'baz']) == {'foo': POLYGON, 'baz': POLYGON}
+
+
+def test_dynamodb_tier(granule_metadata_table):
+    writer = GranuleMetadataCache(table_name=granule_metadata_table.name)
+    writer.put([{'name': 'foo', 'polygon': POLYGON}])
+
+    item = granule_metadata_table.get_item(Key={'granule_name': 'foo'})['Item']
+    assert item['expiration_time'] > time.time()
+
+    reader = GranuleMetadataCache(table_name=granule_metadata_table.name)
+    assert reader.get(['foo', 'bar']) == {'foo': POLYGON}
+    assert reader.stats == {'memory_hits': 0, 'dynamodb_hits': 1, 'misses': 1}
+
+    assert reader.get(['foo']) == {'foo': POLYGON}
+    assert reader.stats == {'memory_hits': 1, 'dynamodb_hits': 1, 'misses': 1}
+
+
+def test_dynamodb_tier_ignores_expired_items(granule_metadata_table):
+    cache = GranuleMetadataCache(table_name=granule_metadata_table.name, ttl_seconds=-1)
+    cache.put([{'name': 'foo', 'polygon': POLYGON}])
+    cache.clear()
+    assert cache.get(['foo']) == {}
+
+
+def test_dynamodb_tier_missing_table(tables):
+    cache = GranuleMetadataCache(table_name='does-not-exist')
+    cache.put([{'name': 'foo', 'polygon': POLYGON}])
+    cache.clear()
+    assert cache.get(['foo']) == {}
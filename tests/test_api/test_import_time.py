@@ -0,0 +1,61 @@
+import subprocess
+import sys
+
+import pytest
+
+from hyp3_api import routes
+
+
+# Modules needed only to resolve the OpenAPI spec, which render_cf.py does at build time
+BUILD_TIME_MODULES = ('prance',)
+
+# Importing hyp3_api took about 4 seconds when the OpenAPI spec was resolved and validated at import, and takes about
+# 1.5 seconds with the spec resolved by render_cf.py at build time
+IMPORT_TIME_BUDGET_SECONDS = 3.0
+
+
+def get_imported_modules(module: str) -> set[str]:
+    """Import the module in a new interpreter and return the names of all the modules it imported."""
+    result = subprocess.run(
+        [sys.executable, '-c', f'import sys, {module}; print("\\n".join(sys.modules))'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(result.stdout.splitlines())
+
+
+def get_import_times(module: str) -> dict[str, int]:
+    """Import the module in a new interpreter and return the cumulative import time of each module, in microseconds."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+def test_import_hyp3_api():
+    imported_modules = get_imported_modules('hyp3_api')
+
+    assert 'hyp3_api.routes' in imported_modules
+    for module in BUILD_TIME_MODULES:
+        assert module not in imported_modules
+
+
+def test_api_spec_is_not_validated_at_import():
+    assert routes.api_spec.config.spec_validator_cls is None
+
+
+@pytest.mark.benchmark
+def test_import_time():
+    import_times = get_import_times('hyp3_api')
+
+    assert import_times['hyp3_api'] / 1_000_000 < IMPORT_TIME_BUDGET_SECONDS
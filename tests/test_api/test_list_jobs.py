@@ -2,6 +2,7 @@ from http import HTTPStatus
 from unittest import mock
 from urllib.parse import unquote
 
+import dynamo
 from conftest import list_have_same_elements
 from test_api.conftest import JOBS_URI, login, make_db_record
 
@@ -77,7 +78,7 @@ def test_list_jobs_by_name(client, tables):
         make_db_record('27836b79-e5b2-4d8f-932f-659724ea02c3', name=long_name),
     ]
     for item in items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     login(client)
     response = client.get(JOBS_URI, query_string={'name': 'item1'})
@@ -103,7 +104,7 @@ def test_list_jobs_by_type(client, tables):
         make_db_record('27836b79-e5b2-4d8f-932f-659724ea02c3', job_type='INSAR_GAMMA'),
     ]
     for item in items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     login(client)
     response = client.get(JOBS_URI, query_string={'job_type': 'RTC_GAMMA'})
@@ -124,7 +125,7 @@ def test_list_jobs_by_status(client, tables):
         make_db_record('27836b79-e5b2-4d8f-932f-659724ea02c3', status_code='SUCCEEDED'),
     ]
     for item in items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     login(client)
     response = client.get(JOBS_URI, query_string={'status_code': 'RUNNING'})
@@ -211,3 +212,38 @@ def test_list_paging(client):
 
         response = client.get(JOBS_URI, headers={'X-Forwarded-Host': 'www.foo.com'})
         assert unquote(response.json['next']) == 'http://www.foo.com/jobs?start_token=eyJmb28iOiAxLCAiYmFyIjogMn0='
+
+
+def test_list_jobs_page_size(client, tables):
+    items = [
+        make_db_record(
+            f'{i:08d}-7636-494d-9496-03ea4a7df266',
+            request_time=f'2019-12-31T10:00:{i:02d}+00:00',
+            status_code='FAILED' if i % 3 == 0 else 'SUCCEEDED',
+        )
+        for i in range(30)
+    ]
+    for item in items:
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+
+    login(client)
+    for query_string, expected in (
+        ({'page_size': 4}, list(reversed(items))),
+        (
+            {'page_size': 4, 'status_code': 'FAILED'},
+            [item for item in reversed(items) if item['status_code'] == 'FAILED'],
+        ),
+    ):
+        jobs = []
+        response = client.get(JOBS_URI, query_string=query_string)
+        while 'next' in response.json:
+            assert response.status_code == HTTPStatus.OK
+            assert len(response.json['jobs']) == 4
+            jobs.extend(response.json['jobs'])
+            response = client.get(response.json['next'])
+        jobs.extend(response.json['jobs'])
+        assert jobs == expected
+
+    for page_size in (0, 1001, 'foo'):
+        response = client.get(JOBS_URI, query_string={'page_size': page_size})
+        assert response.status_code == HTTPStatus.BAD_REQUEST
@@ -36,6 +36,7 @@ def test_patch_job(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
@@ -82,6 +83,7 @@ def test_patch_job(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'anothernewname',
+            'user_id_name': 'user1#anothernewname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
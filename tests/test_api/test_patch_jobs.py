@@ -47,12 +47,14 @@ def test_patch_jobs(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
         {
             'job_id': '40183948-48a1-42d2-a96b-ce44fbba301b',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
@@ -113,12 +115,14 @@ def test_patch_jobs(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'anothernewname',
+            'user_id_name': 'user1#anothernewname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
         {
             'job_id': '40183948-48a1-42d2-a96b-ce44fbba301b',
             'name': 'anothernewname',
+            'user_id_name': 'user1#anothernewname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
@@ -158,6 +162,7 @@ def test_job_ids_length(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'user_id': 'user1',
         },
     ]
@@ -186,6 +191,7 @@ def test_job_ids_length(client, tables):
         {
             'job_id': '33d85ea0-9342-4c21-ae59-5bec3f71612c',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'user_id': 'user1',
         },
     ]
@@ -0,0 +1,253 @@
+import json
+from http import HTTPStatus
+from unittest import mock
+
+import botocore.exceptions
+import pytest
+import responses
+
+import dynamo
+from hyp3_api import submission_worker
+from hyp3_api.validation import CmrError, ValidationError
+from test_api.conftest import DEFAULT_USERNAME, login, setup_mock_cmr_response_for_polygons
+
+
+SUBMISSIONS_URI = '/submissions'
+
+GRANULE = 'S1B_IW_SLC__1SDV_20200604T082207_20200604T082234_021881_029874_5E38'
+POLYGON = ['3.871941 -157.47052 62.278873 -156.62677 62.712959 -151.784653 64.318275 -152.353271 63.871941 -157.47052']
+
+
+def make_job(name='someName'):
+    return {'job_type': 'RTC_GAMMA', 'name': name, 'job_parameters': {'granules': [GRANULE]}}
+
+
+def post_submission(client, lines):
+    return client.post(SUBMISSIONS_URI, data='\n'.join(lines) + '\n', content_type='application/x-ndjson')
+
+
+def test_post_submission(client, tables):
+    login(client)
+    jobs = [make_job(f'job{i}') for i in range(3)]
+
+    response = post_submission(client, [json.dumps(job) for job in jobs])
+    assert response.status_code == HTTPStatus.ACCEPTED
+    submission = response.json
+    assert submission['status_code'] == 'PENDING'
+    assert submission['job_count'] == 3
+    assert submission['user_id'] == DEFAULT_USERNAME
+
+    assert dynamo.submissions.get_submission_chunk(submission['submission_id'], 0) == jobs
+
+    response = client.get(f'{SUBMISSIONS_URI}/{submission["submission_id"]}')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == submission
+
+
+def test_post_submission_invalid(client, tables):
+    login(client)
+
+    response = post_submission(client, [json.dumps(make_job()), '{"job_type": '])
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json['detail'] == 'Line 2 is not valid JSON'
+
+    response = post_submission(client, ['[]'])
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json['detail'] == 'Line 1 is not a JSON object'
+
+    response = client.post(SUBMISSIONS_URI, data='', content_type='application/x-ndjson')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    response = client.post(SUBMISSIONS_URI, data=b'\xff', content_type='application/x-ndjson')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json['detail'] == 'The submission is not UTF-8 encoded'
+
+    assert tables.submissions_table.scan()['Items'] == []
+
+
+def test_post_submission_not_authenticated(client):
+    response = post_submission(client, [json.dumps(make_job())])
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_get_submission_for_other_user(client, tables):
+    submission = dynamo.submissions.put_submission('other_user', [make_job()])
+    login(client)
+    response = client.get(f'{SUBMISSIONS_URI}/{submission["submission_id"]}')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+    response = client.get(f'{SUBMISSIONS_URI}/27836b79-e5b2-4d8f-932f-659724ea02c3')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@responses.activate
+def test_process_submission(tables, approved_user, monkeypatch):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '3')
+    monkeypatch.setattr(dynamo.submissions, 'SUBMISSION_CHUNK_SIZE', 2)
+    setup_mock_cmr_response_for_polygons([(GRANULE, [POLYGON])])
+
+    jobs = [
+        make_job('job1'),
+        {'job_type': 'RTC_GAMMA', 'job_parameters': {}},
+        make_job('job3'),
+        make_job('job4'),
+        make_job('job5'),
+    ]
+    submission_id = dynamo.submissions.put_submission(approved_user, jobs)['submission_id']
+
+    submission_worker.process_submission(submission_id, deadline=float('inf'))
+
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'SUCCEEDED'
+    assert submission['processed_count'] == 5
+    assert submission['submitted_count'] == 3
+    assert submission['failed_count'] == 2
+    assert [error['line'] for error in submission['errors']] == [2, 5]
+    assert submission['errors'][1]['detail'] == 'These jobs would cost 1.0 credits, but you have only 0.0 remaining.'
+
+    assert sorted(job['name'] for job in tables.jobs_table.scan()['Items']) == ['job1', 'job3', 'job4']
+
+
+def test_submit_chunk_validation_errors(tables, approved_user, monkeypatch):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    jobs = [make_job('good'), make_job('bad'), make_job('also good')]
+
+    def validate_jobs(jobs):
+        if any(job['name'] == 'bad' for job in jobs):
+            raise ValidationError('bad granule')
+
+    with mock.patch('hyp3_api.submission_worker.validate_jobs', side_effect=validate_jobs) as mock_validate_jobs:
+        submitted_count, errors = submission_worker.submit_chunk(
+            '27836b79-e5b2-4d8f-932f-659724ea02c3', approved_user, jobs, first_line=201
+        )
+
+    assert mock_validate_jobs.call_count == 4
+    assert submitted_count == 2
+    assert errors == [{'line': 202, 'detail': 'bad granule'}]
+    assert sorted(job['name'] for job in tables.jobs_table.scan()['Items']) == ['also good', 'good']
+
+
+def test_submit_chunk_job_id_in_use(tables, approved_user, monkeypatch):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    submission_id = '27836b79-e5b2-4d8f-932f-659724ea02c3'
+    jobs = [make_job('job1'), make_job('job2')]
+    dynamo.jobs.put_jobs(approved_user, jobs[:1], job_ids=[dynamo.submissions.get_job_id(submission_id, 1)])
+
+    # The chunk isn't known to have been partly submitted, so it is resumed when the first job's ID is found in use
+    with mock.patch('hyp3_api.submission_worker.validate_jobs'):
+        submitted_count, errors = submission_worker.submit_chunk(submission_id, approved_user, jobs, first_line=1)
+
+    assert submitted_count == 2
+    assert errors == []
+    assert sorted(job['name'] for job in tables.jobs_table.scan()['Items']) == ['job1', 'job2']
+    assert tables.users_table.get_item(Key={'user_id': approved_user})['Item']['remaining_credits'] == 8
+
+
+@responses.activate
+def test_process_submission_resumes_after_expired_lease(tables, approved_user, monkeypatch):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '3')
+    setup_mock_cmr_response_for_polygons([(GRANULE, [POLYGON])])
+    submission_id = dynamo.submissions.put_submission(approved_user, [make_job(f'job{i}') for i in range(3)])[
+        'submission_id'
+    ]
+
+    # The worker stops after submitting the chunk but before recording it, as if it timed out
+    with mock.patch('dynamo.submissions.record_chunk', side_effect=RuntimeError('timed out')):
+        with pytest.raises(RuntimeError, match='timed out'):
+            submission_worker.process_submission(submission_id, deadline=float('inf'))
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'RUNNING'
+
+    lease_expiration_time = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item'][
+        'lease_expiration_time'
+    ]
+    assert dynamo.submissions.reclaim_expired_leases(now=int(lease_expiration_time) + 1) == 1
+
+    with mock.patch('dynamo.jobs.put_jobs') as mock_put_jobs:
+        submission_worker.process_submission(submission_id, deadline=float('inf'))
+    mock_put_jobs.assert_not_called()
+
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'SUCCEEDED'
+    assert submission['submitted_count'] == 3
+    assert submission['failed_count'] == 0
+    assert len(tables.jobs_table.scan()['Items']) == 3
+    assert tables.users_table.get_item(Key={'user_id': approved_user})['Item']['remaining_credits'] == 0
+
+
+def test_process_submission_stops_at_deadline(tables, approved_user, monkeypatch):
+    monkeypatch.setattr(dynamo.submissions, 'SUBMISSION_CHUNK_SIZE', 1)
+    submission_id = dynamo.submissions.put_submission(approved_user, [make_job(), make_job()])['submission_id']
+
+    with (
+        mock.patch('time.monotonic', side_effect=[0.0, 2.0]),
+        mock.patch('hyp3_api.submission_worker.submit_chunk', return_value=(1, [])) as mock_submit_chunk,
+    ):
+        submission_worker.process_submission(submission_id, deadline=1.0)
+
+    assert mock_submit_chunk.call_count == 1
+    item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+    assert item['status_code'] == 'PENDING'
+    assert item['next_chunk'] == 1
+    assert item['attempts'] == 0
+
+
+def test_process_submission_retries(tables, approved_user):
+    submission_id = dynamo.submissions.put_submission(approved_user, [make_job()])['submission_id']
+
+    for attempt in range(1, dynamo.submissions.SUBMISSION_ATTEMPTS + 1):
+        error = CmrError('CMR is down') if attempt % 2 else botocore.exceptions.ClientError({}, 'PutItem')
+        with mock.patch('hyp3_api.submission_worker.submit_chunk', side_effect=error):
+            submission_worker.process_submission(submission_id, deadline=float('inf'))
+        item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+        assert item['status_code'] == 'PENDING'
+        assert item['attempts'] == attempt
+
+    submission_worker.process_submission(submission_id, deadline=float('inf'))
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'FAILED'
+    assert submission['detail'] == 'Jobs could not be submitted. Please try again later.'
+
+
+def test_process_submission_not_pending(tables, approved_user):
+    submission_id = dynamo.submissions.put_submission(approved_user, [make_job()])['submission_id']
+    dynamo.submissions.start_processing(submission_id)
+
+    with mock.patch('hyp3_api.submission_worker.submit_chunk') as mock_submit_chunk:
+        submission_worker.process_submission(submission_id, deadline=float('inf'))
+    mock_submit_chunk.assert_not_called()
+
+
+def test_process_submission_limits_errors(tables, approved_user, monkeypatch):
+    monkeypatch.setattr(dynamo.submissions, 'SUBMISSION_CHUNK_SIZE', 2)
+    monkeypatch.setattr(dynamo.submissions, 'MAX_SUBMISSION_ERRORS', 3)
+    submission_id = dynamo.submissions.put_submission(approved_user, [{}] * 6)['submission_id']
+
+    submission_worker.process_submission(submission_id, deadline=float('inf'))
+
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['failed_count'] == 6
+    assert [error['line'] for error in submission['errors']] == [1, 2, 3]
+
+
+def test_lambda_handler(tables, approved_user):
+    event = {'Records': [{'dynamodb': {'Keys': {'submission_id': {'S': 'submission1'}}}}]}
+    with mock.patch('hyp3_api.submission_worker.process_submission') as mock_process_submission:
+        submission_worker.lambda_handler(event, None)
+    mock_process_submission.assert_called_once_with('submission1', mock.ANY)
+    assert isinstance(mock_process_submission.call_args.args[1], float)
+
+
+def test_lambda_handler_scheduled(tables):
+    with (
+        mock.patch('dynamo.submissions.reclaim_expired_leases', return_value=2) as mock_reclaim_expired_leases,
+        mock.patch('hyp3_api.submission_worker.process_submission') as mock_process_submission,
+    ):
+        submission_worker.lambda_handler({'source': 'aws.events'}, None)
+    mock_reclaim_expired_leases.assert_called_once_with()
+    mock_process_submission.assert_not_called()
@@ -1,11 +1,17 @@
 from decimal import Decimal
 from http import HTTPStatus
+from unittest import mock
 
+import botocore.exceptions
+import pytest
 import responses
 
+import dynamo.idempotency
+import dynamo.jobs
 import hyp3_api.util
-from dynamo.user import APPLICATION_PENDING
-from dynamo.util import current_utc_time
+from dynamo.exceptions import JobIdInUseError, PartialJobSubmissionError
+from dynamo.user import APPLICATION_APPROVED, APPLICATION_PENDING
+from dynamo.util import DYNAMODB_RESOURCE, current_utc_time
 from test_api.conftest import JOBS_URI, login, setup_mock_cmr_response_for_polygons
 
 
@@ -21,7 +27,7 @@ def make_job(granules=None, name='someName', job_type='RTC_GAMMA', parameters=No
     return job
 
 
-def submit_batch(client, batch=None, validate_only=None):
+def submit_batch(client, batch=None, validate_only=None, idempotency_key=None):
     if batch is None:
         batch = [make_job()]
     payload = {
@@ -29,7 +35,8 @@ def submit_batch(client, batch=None, validate_only=None):
     }
     if validate_only is not None:
         payload['validate_only'] = validate_only
-    return client.post(JOBS_URI, json=payload)
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key is not None else {}
+    return client.post(JOBS_URI, json=payload, headers=headers)
 
 
 def setup_mock_cmr_response_for_jobs(batch):
@@ -178,6 +185,157 @@ def test_submit_exceeds_remaining_credits(client, approved_user, monkeypatch):
     assert response2.json['detail'] == 'These jobs would cost 10.0 credits, but you have only 5.0 remaining.'
 
 
+@responses.activate
+def test_submit_partial_failure(client, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job(), make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    error = PartialJobSubmissionError([{'job_id': 'job1'}], [{'job_id': 'job2'}])
+    with mock.patch('dynamo.jobs.put_jobs', side_effect=error):
+        response = submit_batch(client, batch)
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.json['detail'] == (
+        'Only 1 of 2 jobs were submitted; you were not charged for the other 1, which can be submitted again.'
+        ' Submitted job IDs: job1'
+    )
+
+
+@responses.activate
+def test_submit_job_id_in_use(client, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    with mock.patch('dynamo.jobs.put_jobs', side_effect=JobIdInUseError(['job1'])):
+        response = submit_batch(client, batch)
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert response.json['detail'] == 'Job IDs already in use: job1'
+
+
+@responses.activate
+def test_submit_idempotency_key(client, tables, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job(), make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    response1 = submit_batch(client, batch, idempotency_key='key1')
+    assert response1.status_code == HTTPStatus.OK
+    assert len(responses.calls) == 1
+
+    response2 = submit_batch(client, batch, idempotency_key='key1')
+    assert response2.status_code == HTTPStatus.OK
+    assert response2.json == response1.json
+    assert len(responses.calls) == 1
+    assert len(tables.jobs_table.scan()['Items']) == 2
+    assert tables.users_table.get_item(Key={'user_id': approved_user})['Item']['remaining_credits'] == Decimal(23)
+
+    response3 = submit_batch(client, [make_job()], idempotency_key='key1')
+    assert response3.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+    response4 = submit_batch(client, batch, idempotency_key='key2')
+    assert response4.status_code == HTTPStatus.OK
+    assert len(tables.jobs_table.scan()['Items']) == 4
+
+
+@responses.activate
+def test_submit_idempotency_key_failure(client, tables, approved_user, monkeypatch):
+    login(client, username=approved_user)
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1')
+    batch = [make_job(), make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert tables.idempotency_keys_table.scan()['Items'] == []
+
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '2')
+    response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.OK
+    assert len(tables.jobs_table.scan()['Items']) == 2
+
+
+@responses.activate
+def test_submit_idempotency_key_partial_failure(client, tables, approved_user, monkeypatch):
+    login(client, username=approved_user)
+    batch = [make_job(), make_job(), make_job(), make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    # Each transaction holds two of the jobs and their name, and the first one also holds the debit
+    monkeypatch.setattr(dynamo.jobs, 'TRANSACT_WRITE_ITEMS_LIMIT', 4)
+    transact_write_items = dynamo.jobs._transact_write_items
+
+    def fail_second_transaction(items):
+        if mock_transact_write_items.call_count == 2:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InternalServerError'}}, 'TransactWriteItems')
+        transact_write_items(items)
+
+    with mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=fail_second_transaction
+    ) as mock_transact_write_items:
+        response1 = submit_batch(client, batch, idempotency_key='key1')
+        assert response1.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        assert response1.json['detail'].startswith('Only 2 of 4 jobs were submitted')
+        assert len(tables.jobs_table.scan()['Items']) == 2
+        assert tables.users_table.get_item(Key={'user_id': approved_user})['Item']['remaining_credits'] == Decimal(23)
+
+        # The error response isn't stored, so a retry with the same key submits only the jobs that weren't written
+        assert tables.idempotency_keys_table.scan()['Items'] == []
+        response2 = submit_batch(client, batch, idempotency_key='key1')
+
+    assert response2.status_code == HTTPStatus.OK
+    job_ids = [job['job_id'] for job in response2.json['jobs']]
+    assert job_ids == [dynamo.idempotency.get_job_id(approved_user, 'key1', i) for i in range(4)]
+    assert response1.json['detail'].endswith(f'Submitted job IDs: {", ".join(job_ids[:2])}')
+    assert sorted(item['job_id'] for item in tables.jobs_table.scan()['Items']) == sorted(job_ids)
+    assert tables.users_table.get_item(Key={'user_id': approved_user})['Item']['remaining_credits'] == Decimal(21)
+
+    response3 = submit_batch(client, batch, idempotency_key='key1')
+    assert response3.json == response2.json
+    assert len(tables.jobs_table.scan()['Items']) == 4
+
+
+@responses.activate
+def test_submit_idempotency_key_unknown_error(client, tables, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    with mock.patch('dynamo.jobs.put_jobs', side_effect=RuntimeError('timed out')):
+        with pytest.raises(RuntimeError, match='timed out'):
+            submit_batch(client, batch, idempotency_key='key1')
+
+    # The jobs may have been written, so the key is not released for a retry
+    response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.CONFLICT
+
+
+@responses.activate
+def test_submit_idempotency_key_complete_request_fails(client, tables, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job()]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    with mock.patch('dynamo.idempotency.complete_request', side_effect=RuntimeError('failed')):
+        response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.OK
+    assert len(tables.jobs_table.scan()['Items']) == 1
+
+    response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert len(tables.jobs_table.scan()['Items']) == 1
+
+
+def test_submit_idempotency_key_in_progress(client, tables, approved_user):
+    login(client, username=approved_user)
+    batch = [make_job()]
+    dynamo.idempotency.start_request(approved_user, 'key1', dynamo.idempotency.get_request_hash({'jobs': batch}))
+
+    response = submit_batch(client, batch, idempotency_key='key1')
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert tables.jobs_table.scan()['Items'] == []
+
+
 @responses.activate
 def test_submit_unapproved_user(client, tables):
     tables.users_table.put_item(
@@ -485,3 +643,50 @@ def test_submit_validate_only(client, tables, approved_user):
     assert response.status_code == HTTPStatus.OK
     jobs = tables.jobs_table.scan()['Items']
     assert len(jobs) == 2
+
+
+@responses.activate
+def test_submit_job_dynamodb_calls(client, tables, approved_user):
+    tables.users_table.put_item(
+        Item={
+            'user_id': 'priority_user',
+            'remaining_credits': Decimal(0),
+            'application_status': APPLICATION_APPROVED,
+            'priority_override': 100,
+        }
+    )
+    batch = [make_job(name=None)]
+    setup_mock_cmr_response_for_jobs(batch)
+
+    calls = []
+
+    def record_call(model, **kwargs):
+        calls.append(model.name)
+
+    events = DYNAMODB_RESOURCE.meta.client.meta.events
+    events.register('before-call.dynamodb', record_call)
+    try:
+        # The priority of the approved user's jobs depends on their remaining credits, so their record is always read.
+        # Registering them for dispatch is part of the transaction's debit.
+        login(client, username=approved_user)
+        for _ in range(2):
+            calls.clear()
+            assert submit_batch(client, batch).status_code == HTTPStatus.OK
+            assert calls == ['GetItem', 'TransactWriteItems']
+
+        # The first submission of the user with a priority override performs their monthly credit reset, which drops
+        # their cached record; after the second submission, it is served from the cache
+        login(client, username='priority_user')
+        for expected_calls in (
+            ['GetItem', 'TransactWriteItems'],
+            ['GetItem', 'TransactWriteItems'],
+            ['TransactWriteItems'],
+            ['TransactWriteItems'],
+        ):
+            calls.clear()
+            assert submit_batch(client, batch).status_code == HTTPStatus.OK
+            assert calls == expected_calls
+    finally:
+        events.unregister('before-call.dynamodb', record_call)
+
+    assert tables.users_table.get_item(Key={'user_id': 'priority_user'})['Item']['remaining_credits'] == Decimal(21)
@@ -1,12 +1,19 @@
 import contextlib
 import inspect
+import json
+import random
+import time
 from unittest import mock
+from urllib.parse import parse_qs
 
 import pytest
+import requests
 import responses
 from shapely.geometry import Polygon
 
 from hyp3_api import CMR_URL, multi_burst_validation, validation
+from hyp3_api.granule_cache import GRANULE_METADATA_CACHE
+from hyp3_api.util import get_granules
 from test_api.conftest import FUTURE_DATE, setup_mock_cmr_response_for_polygons
 
 
@@ -105,6 +112,46 @@ def test_check_dem_coverage():
     assert 'covered1' not in str(e)
 
 
+def _random_footprints(count):
+    rng = random.Random(42)
+    footprints = []
+    for _ in range(count):
+        west, south = rng.uniform(-180, 179), rng.uniform(-90, 89)
+        footprints.append(rectangle(south + rng.uniform(0.1, 1), south, west + rng.uniform(0.1, 1), west))
+    return footprints
+
+
+def test_check_dem_coverage_matches_multipolygon_intersects():
+    # The indexed coverage must agree with intersecting each footprint with the coverage MultiPolygon
+    footprints = _random_footprints(1000)
+
+    coverage = validation._get_multipolygon_from_geojson('dem_coverage_map_cop30.geojson')
+    expected = {i for i, footprint in enumerate(footprints) if footprint.intersects(coverage)}
+
+    actual = validation._get_granules_with_coverage(footprints)
+
+    assert actual == expected
+    assert 0 < len(actual) < len(footprints)
+
+
+@pytest.mark.benchmark
+def test_benchmark_check_dem_coverage():
+    footprints = _random_footprints(1000)
+
+    coverage = validation._get_multipolygon_from_geojson('dem_coverage_map_cop30.geojson')
+    start = time.perf_counter()
+    expected = {i for i, footprint in enumerate(footprints) if footprint.intersects(coverage)}
+    multipolygon_seconds = time.perf_counter() - start
+
+    validation._get_dem_coverage()
+    start = time.perf_counter()
+    actual = validation._get_granules_with_coverage(footprints)
+    index_seconds = time.perf_counter() - start
+
+    print(f'MultiPolygon: {multipolygon_seconds:.3f}s, STRtree: {index_seconds:.3f}s')
+    assert actual == expected
+
+
 def test_check_multi_burst_pairs():
     with mock.patch.object(multi_burst_validation, 'validate_bursts') as mock_validate_bursts:
         validation.check_multi_burst_pairs(
@@ -289,9 +336,97 @@ def test_get_cmr_metadata():
         validation._get_cmr_metadata(['foo', 'bar', 'hello'])
 
     responses.post(CMR_URL, status=500)
+    assert [granule['name'] for granule in validation._get_cmr_metadata(['foo', 'bar'])] == ['foo', 'bar']
+
+    GRANULE_METADATA_CACHE.clear()
     assert validation._get_cmr_metadata(['foo', 'bar']) == []
 
 
+class FakeCmr:
+    """Serves CMR granule searches for a fixed set of granule names, paging with CMR-Search-After."""
+
+    def __init__(self, granules, page_size):
+        self.granules = granules
+        self.page_size = page_size
+        self.requests = []
+
+    def __call__(self, request):
+        parameters = parse_qs(request.body)
+        self.requests.append(parameters)
+        patterns = [pattern.removesuffix('*') for pattern in parameters['granule_ur']]
+        matches = [granule for granule in self.granules if any(granule.startswith(p) for p in patterns)]
+
+        offset = int(request.headers.get('CMR-Search-After', 0))
+        page = matches[offset : offset + self.page_size]
+        entries = [{'producer_granule_id': granule, 'polygons': [['0 1 2 3 4 5 6 7 0 1']]} for granule in page]
+        headers = {'CMR-Search-After': str(offset + self.page_size)} if page else {}
+        return 200, headers, json.dumps({'feed': {'entry': entries}})
+
+
+@responses.activate
+def test_query_cmr_chunks_and_pages(monkeypatch):
+    monkeypatch.setattr(validation, 'CMR_CHUNK_SIZE', 3)
+    monkeypatch.setattr(validation, 'CMR_PAGE_SIZE', 2)
+
+    granules = [f'granule{i:02}' for i in range(10)]
+    fake_cmr = FakeCmr(granules, page_size=2)
+    responses.add_callback(responses.POST, CMR_URL, callback=fake_cmr)
+
+    granule_metadata = validation._query_cmr(granules)
+
+    assert [granule['name'] for granule in granule_metadata] == granules
+    # 3 chunks of 3 granules needing 2 pages each, plus 1 chunk of 1 granule needing 1 page
+    assert len(fake_cmr.requests) == 7
+    assert all(request['page_size'] == ['2'] for request in fake_cmr.requests)
+    assert sorted(len(request['granule_ur']) for request in fake_cmr.requests) == [1, 3, 3, 3, 3, 3, 3]
+
+
+@responses.activate
+def test_query_cmr_retries():
+    entry = {'producer_granule_id': 'foo', 'polygons': [['0 1 2 3 4 5 6 7 0 1']]}
+
+    responses.post(CMR_URL, status=503)
+    responses.post(CMR_URL, json={'feed': {'entry': [entry]}})
+    assert [granule['name'] for granule in validation._query_cmr(['foo'])] == ['foo']
+    assert len(responses.calls) == 2
+
+    responses.reset()
+    responses.post(CMR_URL, status=429)
+    responses.post(CMR_URL, status=500)
+    with pytest.raises(requests.HTTPError):
+        validation._query_cmr(['foo'])
+    assert len(responses.calls) == 2
+
+    responses.reset()
+    responses.post(CMR_URL, status=400)
+    with pytest.raises(requests.HTTPError):
+        validation._query_cmr(['foo'])
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_get_cmr_metadata_only_queries_cmr_for_cache_misses():
+    def cmr_response(*names):
+        return {
+            'feed': {'entry': [{'producer_granule_id': name, 'polygons': [['0 1 2 3 4 5 6 7 0 1']]} for name in names]}
+        }
+
+    responses.post(CMR_URL, json=cmr_response('foo', 'bar'))
+    assert [granule['name'] for granule in validation._get_cmr_metadata(['foo', 'bar'])] == ['foo', 'bar']
+    assert len(responses.calls) == 1
+
+    assert [granule['name'] for granule in validation._get_cmr_metadata(['foo', 'bar'])] == ['foo', 'bar']
+    assert len(responses.calls) == 1
+
+    responses.replace(responses.POST, CMR_URL, json=cmr_response('baz'))
+    assert [granule['name'] for granule in validation._get_cmr_metadata(['foo', 'baz'])] == ['foo', 'baz']
+    assert len(responses.calls) == 2
+    assert 'granule_ur=baz%2A' in str(responses.calls[1].request.body)
+    assert 'granule_ur=foo%2A' not in str(responses.calls[1].request.body)
+
+    assert GRANULE_METADATA_CACHE.stats == {'memory_hits': 3, 'dynamodb_hits': 0, 'misses': 3}
+
+
 @responses.activate
 def test_validate_jobs():
     unknown_granule = 'unknown'
@@ -372,10 +507,105 @@ def test_validate_jobs():
     with pytest.raises(validation.ValidationError):
         validation.validate_jobs(jobs)
 
+    GRANULE_METADATA_CACHE.clear()
     responses.post(CMR_URL, status=500)
     validation.validate_jobs(jobs)
 
 
+def _multi_burst_jobs(count: int) -> tuple[list[dict], list[dict]]:
+    """Make INSAR_ISCE_MULTI_BURST jobs of 15 burst pairs each, with the CMR metadata of their granules."""
+
+    def burst(number, date):
+        return f'S1_{number:06}_IW1_{date}T000000_VV_0000-BURST'
+
+    jobs: list[dict] = [
+        {
+            'job_type': 'INSAR_ISCE_MULTI_BURST',
+            'job_parameters': {
+                'reference': [burst(i * 15 + j, '20200101') for j in range(15)],
+                'secondary': [burst(i * 15 + j, '20200113') for j in range(15)],
+            },
+        }
+        for i in range(count)
+    ]
+    granule_metadata = [
+        {'name': granule, 'polygon': None}
+        for job in jobs
+        for key in ['reference', 'secondary']
+        for granule in job['job_parameters'][key]
+    ]
+    return jobs, granule_metadata
+
+
+def test_validate_jobs_granule_metadata_per_job():
+    jobs, granule_metadata = _multi_burst_jobs(200)
+    received = []
+
+    def record_job_granules(job, granule_metadata):
+        received.append((job, granule_metadata))
+
+    with (
+        mock.patch.object(validation, '_get_cmr_metadata', return_value=granule_metadata) as mock_get_cmr_metadata,
+        mock.patch.object(
+            validation, '_index_granule_metadata', side_effect=validation._index_granule_metadata
+        ) as mock_index_granule_metadata,
+        mock.patch.object(
+            validation, '_get_granule_metadata_for_job', side_effect=validation._get_granule_metadata_for_job
+        ) as mock_get_granule_metadata_for_job,
+        mock.patch.dict(validation.JOB_VALIDATORS, {'INSAR_ISCE_MULTI_BURST': [record_job_granules] * 3}),
+    ):
+        validation.validate_jobs(jobs)
+
+    # CMR is queried and its metadata indexed once per request, and each job's metadata is looked up once per job
+    mock_get_cmr_metadata.assert_called_once()
+    mock_index_granule_metadata.assert_called_once_with(granule_metadata)
+    assert mock_get_granule_metadata_for_job.call_count == 200
+
+    assert len(received) == 600
+    for job, job_granule_metadata in received:
+        job_granules = get_granules([job])
+        expected = [granule for granule in granule_metadata if granule['name'] in job_granules]
+        assert job_granule_metadata == expected
+    for i in range(0, 600, 3):
+        assert received[i][1] is received[i + 1][1] is received[i + 2][1]
+
+
+@pytest.mark.benchmark
+def test_benchmark_validate_jobs_granule_metadata():
+    jobs, granule_metadata = _multi_burst_jobs(200)
+
+    start = time.perf_counter()
+    expected = []
+    for job in jobs:
+        for _ in range(3):
+            job_granules = get_granules([job])
+            expected.append([granule for granule in granule_metadata if granule['name'] in job_granules])
+    scan_seconds = time.perf_counter() - start
+
+    received = []
+
+    def record_job_granules(job, job_granule_metadata):
+        received.append(job_granule_metadata)
+
+    with (
+        mock.patch.object(validation, '_get_cmr_metadata', return_value=granule_metadata),
+        mock.patch.dict(validation.JOB_VALIDATORS, {'INSAR_ISCE_MULTI_BURST': [record_job_granules] * 3}),
+    ):
+        start = time.perf_counter()
+        validation.validate_jobs(jobs)
+        index_seconds = time.perf_counter() - start
+
+    print(f'Scan per validator: {scan_seconds:.3f}s, index per request: {index_seconds:.3f}s')
+    assert received == expected
+
+
+def test_job_validators():
+    assert validation.JOB_VALIDATORS.keys() == validation.JOB_VALIDATION_MAP.keys()
+    assert validation.JOB_VALIDATORS['RTC_GAMMA'] == [validation.check_dem_coverage]
+    for job_type, validator_names in validation.JOB_VALIDATION_MAP.items():
+        assert [validator.__name__ for validator in validation.JOB_VALIDATORS[job_type]] == validator_names
+
+
 def test_all_validators_have_correct_signature():
     validators = [getattr(validation, attr) for attr in dir(validation) if attr.startswith('check_')]
 
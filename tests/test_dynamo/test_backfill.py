@@ -0,0 +1,130 @@
+import unittest.mock
+from decimal import Decimal
+
+import dynamo.backfill
+import dynamo.job_names
+import dynamo.jobs
+
+
+def test_backfill_index_keys(tables):
+    table_items: list[dict] = [
+        {
+            'job_id': 'job1',
+            'user_id': 'user1',
+            'name': 'name1',
+            'job_type': 'RTC_GAMMA',
+            'status_code': 'RUNNING',
+            'request_time': '2000-01-01T00:00:00+00:00',
+        },
+        {'job_id': 'job2', 'user_id': 'user1', 'status_code': 'FAILED', 'request_time': '2000-01-02T00:00:00+00:00'},
+    ]
+    table_items.append(
+        {
+            'job_id': 'job3',
+            'user_id': 'user1',
+            'status_code': 'PENDING',
+            'execution_started': False,
+            'priority': 5,
+            'request_time': '2000-01-03T00:00:00+00:00',
+        }
+    )
+    tables.jobs_table.put_item(Item=table_items[0])
+    tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(table_items[1]))
+    tables.jobs_table.put_item(Item=table_items[2])
+    dynamo.jobs.BACKFILL_STATUS.clear()
+    assert dynamo.jobs.query_jobs('user1', status_code='RUNNING')[0] == [table_items[0]]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [table_items[2]]
+
+    dynamo.backfill.backfill_index_keys()
+
+    assert not dynamo.jobs.is_backfill_complete()
+    dynamo.jobs.BACKFILL_STATUS.clear()
+    assert dynamo.jobs.is_backfill_complete()
+    marker = tables.jobs_table.get_item(Key={'job_id': dynamo.jobs.BACKFILL_MARKER_JOB_ID})['Item']
+    assert tables.jobs_table.scan()['Items'] == [marker] + [dynamo.jobs._add_index_keys(item) for item in table_items]
+    assert 'dispatch_priority' in tables.jobs_table.get_item(Key={'job_id': 'job3'})['Item']
+    assert dynamo.jobs.query_jobs('user1', status_code='RUNNING')[0] == [table_items[0]]
+    assert dynamo.jobs.query_jobs('user1', name='name1', job_type='RTC_GAMMA')[0] == [table_items[0]]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [table_items[2]]
+
+
+def test_backfill_index_keys_skips_changed_jobs(tables):
+    job = {'job_id': 'job1', 'user_id': 'user1', 'status_code': 'RUNNING', 'request_time': '2000-01-01T00:00:00+00:00'}
+    tables.jobs_table.put_item(Item=job)
+
+    scan = tables.jobs_table.meta.client.scan
+
+    def scan_then_update(**kwargs):
+        response = scan(**kwargs)
+        dynamo.jobs.update_job({'job_id': 'job1', 'status_code': 'SUCCEEDED'})
+        return response
+
+    with unittest.mock.patch.object(tables.jobs_table.meta.client, 'scan', side_effect=scan_then_update):
+        dynamo.backfill.backfill_index_keys()
+
+    assert tables.jobs_table.get_item(Key={'job_id': 'job1'})['Item']['user_id_status_code'] == 'user1#SUCCEEDED'
+
+
+def test_backfill_index_keys_skips_started_jobs(tables):
+    job = {
+        'job_id': 'job1',
+        'user_id': 'user1',
+        'status_code': 'PENDING',
+        'execution_started': False,
+        'priority': 5,
+        'request_time': '2000-01-01T00:00:00+00:00',
+    }
+    tables.jobs_table.put_item(Item=job)
+
+    scan = tables.jobs_table.meta.client.scan
+
+    def scan_then_start(**kwargs):
+        response = scan(**kwargs)
+        dynamo.jobs.update_job({'job_id': 'job1', 'execution_started': True})
+        return response
+
+    with unittest.mock.patch.object(tables.jobs_table.meta.client, 'scan', side_effect=scan_then_start):
+        dynamo.backfill.backfill_index_keys()
+
+    assert 'dispatch_priority' not in tables.jobs_table.get_item(Key={'job_id': 'job1'})['Item']
+
+
+def test_backfill_index_keys_partially_keyed_jobs(tables):
+    # The status key is added by any status update, but the name and job type keys only by the backfill
+    job = {
+        'job_id': 'job1',
+        'user_id': 'user1',
+        'name': 'name1',
+        'job_type': 'RTC_GAMMA',
+        'status_code': 'RUNNING',
+        'request_time': '2000-01-01T00:00:00+00:00',
+    }
+    tables.jobs_table.put_item(Item=job)
+    dynamo.jobs.update_job({'job_id': 'job1', 'status_code': 'SUCCEEDED'})
+
+    dynamo.backfill.backfill_index_keys()
+    dynamo.backfill.backfill_index_keys()
+
+    job['status_code'] = 'SUCCEEDED'
+    assert tables.jobs_table.get_item(Key={'job_id': 'job1'})['Item'] == dynamo.jobs._add_index_keys(job)
+    assert dynamo.jobs.query_jobs('user1', name='name1', job_type='RTC_GAMMA')[0] == [job]
+
+
+def test_backfill_index_keys_counts_job_names(tables):
+    old_jobs = [
+        {'job_id': f'job{i}', 'user_id': 'user1', 'name': name, 'status_code': 'SUCCEEDED', 'request_time': 'x'}
+        for i, name in enumerate(['a', 'a', 'b', 'c'])
+    ]
+    for job in old_jobs:
+        tables.jobs_table.put_item(Item=job)
+    # Counted while the backfill was pending, and kept by it
+    tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys({**old_jobs[0], 'job_id': 'job4'}))
+    tables.job_names_table.put_item(Item={'user_id': 'user1', 'name': 'a', 'job_count': 1})
+    dynamo.jobs.update_job_for_user('job3', 'b', 'user1')
+
+    dynamo.backfill.backfill_index_keys()
+    dynamo.backfill.backfill_index_keys()
+
+    assert dynamo.job_names.get_job_names('user1') == ['a', 'b']
+    assert tables.job_names_table.get_item(Key={'user_id': 'user1', 'name': 'a'})['Item']['job_count'] == Decimal(3)
+    assert tables.job_names_table.get_item(Key={'user_id': 'user1', 'name': 'b'})['Item']['job_count'] == Decimal(2)
@@ -0,0 +1,74 @@
+import json
+
+import responses
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
+
+import dynamo
+
+
+@responses.activate
+def test_http_session(monkeypatch):
+    monkeypatch.setattr(dynamo.http_session, 'HTTP_LATENCY_BY_HOST', {})
+    session = dynamo.http_session.get_http_session()
+
+    responses.get('https://example.com/foo', json={'foo': 'bar'})
+    responses.get('https://example.com/bar', status=503)
+    responses.get('https://example.com/bar', json={})
+
+    assert session.get('https://example.com/foo').json() == {'foo': 'bar'}
+    request_kwargs = responses.calls[0].request.req_kwargs  # type: ignore[attr-defined]
+    assert request_kwargs['timeout'] == dynamo.http_session.HTTP_TIMEOUT_SECONDS
+
+    assert session.get('https://example.com/bar', timeout=1).status_code == 200
+    request_kwargs = responses.calls[-1].request.req_kwargs  # type: ignore[attr-defined]
+    assert request_kwargs['timeout'] == 1
+    assert len(responses.calls) == 3
+
+    assert dynamo.http_session.HTTP_LATENCY_BY_HOST.keys() == {'example.com'}
+    assert dynamo.http_session.HTTP_LATENCY_BY_HOST['example.com']['count'] == 2
+
+
+def test_http_session_fits_api_gateway_timeout():
+    session = dynamo.http_session.get_http_session()
+    adapter = session.get_adapter('https://example.com')
+    assert isinstance(adapter, HTTPAdapter)
+    retry = adapter.max_retries
+    attempt_seconds = sum(dynamo.http_session.HTTP_TIMEOUT_SECONDS)
+
+    worst_case_seconds = attempt_seconds
+    while True:
+        try:
+            retry = retry.increment(method='POST', url='/', error=ConnectTimeoutError())
+        except MaxRetryError:
+            break
+        worst_case_seconds += retry.get_backoff_time() + attempt_seconds
+
+    assert worst_case_seconds < dynamo.http_session.API_GATEWAY_TIMEOUT_SECONDS
+
+
+def test_log_http_latency_metrics(monkeypatch, capsys):
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'test-function')
+    monkeypatch.setattr(
+        dynamo.http_session,
+        'HTTP_LATENCY_BY_HOST',
+        {'example.com': {'count': 2, 'total_seconds': 3.0, 'max_seconds': 2.0}},
+    )
+
+    dynamo.http_session.log_http_latency_metrics()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    metrics = json.loads(lines[0])
+    assert metrics['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['FunctionName', 'Host']]
+    assert {key: metrics[key] for key in metrics if key != '_aws'} == {
+        'FunctionName': 'test-function',
+        'Host': 'example.com',
+        'HttpRequests': 2,
+        'HttpLatencyAverage': 1.5,
+        'HttpLatencyMax': 2.0,
+    }
+    assert dynamo.http_session.HTTP_LATENCY_BY_HOST == {}
+
+    dynamo.http_session.log_http_latency_metrics()
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,74 @@
+import unittest.mock
+from decimal import Decimal
+
+import pytest
+
+import dynamo.idempotency
+from dynamo.exceptions import IdempotencyKeyInProgressError, IdempotencyKeyReusedError
+
+
+def test_get_request_hash():
+    assert dynamo.idempotency.get_request_hash({'a': 1, 'b': [2]}) == dynamo.idempotency.get_request_hash(
+        {'b': [2], 'a': 1}
+    )
+    assert dynamo.idempotency.get_request_hash({'a': 1}) != dynamo.idempotency.get_request_hash({'a': 2})
+
+
+def test_get_job_id():
+    assert dynamo.idempotency.get_job_id('user1', 'key1', 0) == dynamo.idempotency.get_job_id('user1', 'key1', 0)
+    assert dynamo.idempotency.get_job_id('user1', 'key1', 0) != dynamo.idempotency.get_job_id('user1', 'key1', 1)
+    assert dynamo.idempotency.get_job_id('user1', 'key1', 0) != dynamo.idempotency.get_job_id('user1', 'key2', 0)
+    assert dynamo.idempotency.get_job_id('user1', 'key1', 0) != dynamo.idempotency.get_job_id('user2', 'key1', 0)
+
+
+def test_start_and_complete_request(tables):
+    assert dynamo.idempotency.start_request('user1', 'key1', 'hash1') is None
+
+    with pytest.raises(IdempotencyKeyInProgressError, match=r'^A request with idempotency key key1 is still'):
+        dynamo.idempotency.start_request('user1', 'key1', 'hash1')
+
+    with pytest.raises(IdempotencyKeyReusedError, match=r'^Idempotency key key1 has already been used'):
+        dynamo.idempotency.start_request('user1', 'key1', 'hash2')
+
+    response = {'jobs': [{'job_id': 'job1', 'credit_cost': Decimal('1.5'), 'priority': Decimal(3)}]}
+    dynamo.idempotency.complete_request('user1', 'key1', response)
+
+    assert dynamo.idempotency.start_request('user1', 'key1', 'hash1') == {
+        'jobs': [{'job_id': 'job1', 'credit_cost': 1.5, 'priority': 3}]
+    }
+    with pytest.raises(IdempotencyKeyReusedError):
+        dynamo.idempotency.start_request('user1', 'key1', 'hash2')
+
+    assert dynamo.idempotency.start_request('user2', 'key1', 'hash2') is None
+    assert dynamo.idempotency.start_request('user1', 'key2', 'hash1') is None
+
+
+def test_start_request_expired_key(tables):
+    with unittest.mock.patch('time.time', return_value=1000):
+        assert dynamo.idempotency.start_request('user1', 'key1', 'hash1') is None
+        dynamo.idempotency.complete_request('user1', 'key1', {'jobs': []})
+
+    expiration_time = 1000 + dynamo.idempotency.COMPLETED_SECONDS
+    with unittest.mock.patch('time.time', return_value=expiration_time):
+        assert dynamo.idempotency.start_request('user1', 'key1', 'hash1') == {'jobs': []}
+
+    with unittest.mock.patch('time.time', return_value=expiration_time + 1):
+        assert dynamo.idempotency.start_request('user1', 'key1', 'hash2') is None
+
+    item = tables.idempotency_keys_table.get_item(Key={'user_id': 'user1', 'idempotency_key': 'key1'})['Item']
+    assert item['status'] == dynamo.idempotency.IN_PROGRESS
+    assert item['request_hash'] == 'hash2'
+    assert item['expiration_time'] == expiration_time + 1 + dynamo.idempotency.IN_PROGRESS_SECONDS
+
+
+def test_cancel_request(tables):
+    dynamo.idempotency.start_request('user1', 'key1', 'hash1')
+    dynamo.idempotency.cancel_request('user1', 'key1')
+    assert tables.idempotency_keys_table.scan()['Items'] == []
+    assert dynamo.idempotency.start_request('user1', 'key1', 'hash2') is None
+
+    dynamo.idempotency.complete_request('user1', 'key1', {'jobs': []})
+    dynamo.idempotency.cancel_request('user1', 'key1')
+    assert dynamo.idempotency.start_request('user1', 'key1', 'hash2') == {'jobs': []}
+
+    dynamo.idempotency.cancel_request('user1', 'does-not-exist')
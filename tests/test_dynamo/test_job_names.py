@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+import dynamo.job_names
+from dynamo.util import DYNAMODB_RESOURCE
+
+
+def test_get_add_job_names_items(tables):
+    assert dynamo.job_names.get_add_job_names_items('user1', []) == []
+
+    items = dynamo.job_names.get_add_job_names_items('user1', ['b', 'a', 'b'])
+    assert len(items) == 2
+    DYNAMODB_RESOURCE.meta.client.transact_write_items(TransactItems=items)
+    DYNAMODB_RESOURCE.meta.client.transact_write_items(
+        TransactItems=dynamo.job_names.get_add_job_names_items('user1', ['c', 'b'])
+        + dynamo.job_names.get_add_job_names_items('user2', ['d'])
+    )
+
+    assert dynamo.job_names.get_job_names('user1') == ['a', 'b', 'c']
+    assert dynamo.job_names.get_job_names('user2') == ['d']
+    assert tables.job_names_table.get_item(Key={'user_id': 'user1', 'name': 'b'})['Item']['job_count'] == Decimal(3)
+
+
+def test_rename_job(tables):
+    tables.job_names_table.put_item(Item={'user_id': 'user1', 'name': 'a', 'job_count': 2})
+    tables.job_names_table.put_item(Item={'user_id': 'user1', 'name': 'b', 'job_count': 1})
+
+    dynamo.job_names.rename_job('user1', 'b', 'c')
+    assert dynamo.job_names.get_job_names('user1') == ['a', 'c']
+
+    dynamo.job_names.rename_job('user1', 'a', None)
+    assert dynamo.job_names.get_job_names('user1') == ['a', 'c']
+
+    dynamo.job_names.rename_job('user1', 'a', None)
+    assert dynamo.job_names.get_job_names('user1') == ['c']
+
+    dynamo.job_names.rename_job('user1', None, 'd')
+    dynamo.job_names.rename_job('user1', 'd', 'd')
+    assert dynamo.job_names.get_job_names('user1') == ['c', 'd']
+    assert tables.job_names_table.get_item(Key={'user_id': 'user1', 'name': 'd'})['Item']['job_count'] == Decimal(1)
+
+
+def test_get_job_names_pagination(tables):
+    names = [f'name{i:04d}-{"x" * 200}' for i in range(6000)]
+    with tables.job_names_table.batch_writer() as batch:
+        for name in names:
+            batch.put_item(Item={'user_id': 'user1', 'name': name, 'job_count': 1})
+
+    assert dynamo.job_names.get_job_names('user1') == names
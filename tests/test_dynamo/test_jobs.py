@@ -1,17 +1,23 @@
 import os
 import unittest.mock
+from collections import Counter
+from datetime import UTC, datetime, timedelta
 from decimal import Decimal
 from unittest.mock import MagicMock, NonCallableMagicMock
 
 import botocore.exceptions
 import pytest
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer
 
 import dynamo
 from conftest import list_have_same_elements
 from dynamo.exceptions import (
     InsufficientCreditsError,
     InvalidApplicationStatusError,
+    JobIdInUseError,
     NotStartedApplicationError,
+    PartialJobSubmissionError,
     PendingApplicationError,
     RejectedApplicationError,
     UpdateJobForDifferentUserError,
@@ -121,7 +127,7 @@ def test_query_jobs_by_status(tables):
         },
     ]
     for item in table_items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     response, _ = dynamo.jobs.query_jobs('user1', status_code='status1')
     assert len(response) == 2
@@ -153,7 +159,7 @@ def test_query_jobs_by_name(tables):
         },
     ]
     for item in table_items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     response, _ = dynamo.jobs.query_jobs('user1', name='name1')
     assert len(response) == 2
@@ -188,13 +194,193 @@ def test_query_jobs_by_type(tables):
         },
     ]
     for item in table_items:
-        tables.jobs_table.put_item(Item=item)
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
 
     response, _ = dynamo.jobs.query_jobs('user1', job_type='RTC_GAMMA')
     assert len(response) == 2
     assert list_have_same_elements(response, table_items[:2])
 
 
+def test_query_jobs_by_multiple_filters(tables):
+    table_items = []
+    for i in range(24):
+        table_items.append(
+            {
+                'job_id': f'job{i:02d}',
+                'name': f'name{i % 2}',
+                'job_type': f'type{i % 3}',
+                'user_id': f'user{i % 4 // 2}',
+                'status_code': 'RUNNING' if i < 12 else 'SUCCEEDED',
+                'request_time': f'2000-01-{i + 1:02d}T00:00:00+00:00',
+            }
+        )
+    for item in table_items:
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+
+    filter_combinations = [
+        {},
+        {'name': 'name0'},
+        {'status_code': 'RUNNING'},
+        {'job_type': 'type1'},
+        {'status_code': 'SUCCEEDED', 'job_type': 'type2'},
+        {'name': 'name1', 'status_code': 'RUNNING', 'job_type': 'type0'},
+    ]
+    time_ranges = [
+        (None, None),
+        ('2000-01-05T00:00:00+00:00', None),
+        (None, '2000-01-20T00:00:00+00:00'),
+        ('2000-01-05T00:00:00+00:00', '2000-01-20T00:00:00+00:00'),
+    ]
+    for user in ('user0', 'user1'):
+        for filters in filter_combinations:
+            for start, end in time_ranges:
+                expected = [
+                    item
+                    for item in reversed(table_items)
+                    if item['user_id'] == user
+                    and all(item[key] == value for key, value in filters.items())
+                    and (start is None or item['request_time'] >= start)
+                    and (end is None or item['request_time'] <= end)
+                ]
+                response, _ = dynamo.jobs.query_jobs(
+                    user,
+                    start,
+                    end,
+                    status_code=filters.get('status_code'),
+                    name=filters.get('name'),
+                    job_type=filters.get('job_type'),
+                )
+                assert response == expected
+
+
+def test_query_jobs_reads_only_matching_jobs(tables):
+    with tables.jobs_table.batch_writer() as batch:
+        for i in range(1000):
+            job = {
+                'job_id': f'job{i:04d}',
+                'name': f'name{i % 100}',
+                'job_type': 'INSAR_GAMMA' if i % 50 == 0 else 'RTC_GAMMA',
+                'user_id': 'user1',
+                'status_code': 'FAILED' if i % 20 == 0 else 'SUCCEEDED',
+                'request_time': f'2000-01-01T00:00:00.{i:04d}+00:00',
+            }
+            batch.put_item(Item=dynamo.jobs._add_index_keys(job))
+
+    for filters in ({'name': 'name7'}, {'status_code': 'FAILED'}, {'job_type': 'INSAR_GAMMA'}):
+        unplanned_params = {
+            'IndexName': 'user_id',
+            'KeyConditionExpression': Key('user_id').eq('user1'),
+            'FilterExpression': Attr(*filters.keys()).eq(*filters.values()),
+        }
+        unplanned = tables.jobs_table.query(**unplanned_params)
+
+        params = dynamo.jobs._get_query_params('user1', **filters)
+        planned = tables.jobs_table.query(**params)
+
+        assert planned['Count'] == unplanned['Count'] > 0
+        assert planned['ScannedCount'] == planned['Count']
+        assert unplanned['ScannedCount'] == 1000
+
+
+def test_query_jobs_page_size(tables, monkeypatch):
+    # Large items keep each DynamoDB query well under the 1 MB page limit, so pages must be filled across queries
+    padding = 'x' * 100_000
+    table_items = [
+        {
+            'job_id': f'job{i:02d}',
+            'user_id': 'user1',
+            'status_code': 'FAILED' if i % 4 == 0 else 'SUCCEEDED',
+            'request_time': f'2000-01-01T00:00:{i:02d}+00:00',
+            'padding': padding,
+        }
+        for i in range(60)
+    ]
+    for item in table_items:
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    expected = list(reversed(table_items))
+
+    response, next_key = dynamo.jobs.query_jobs('user1')
+    assert 0 < len(response) < 25
+    assert next_key is not None
+
+    jobs: list[dict] = []
+    next_key = None
+    while True:
+        response, next_key = dynamo.jobs.query_jobs('user1', start_key=next_key, page_size=25)
+        jobs.extend(response)
+        if next_key is None:
+            break
+        assert len(response) == 25
+    assert jobs == expected
+
+    response, next_key = dynamo.jobs.query_jobs('user1', status_code='SUCCEEDED', page_size=30)
+    assert response == [item for item in expected if item['status_code'] == 'SUCCEEDED'][:30]
+    response, next_key = dynamo.jobs.query_jobs('user1', status_code='SUCCEEDED', start_key=next_key, page_size=30)
+    assert response == [item for item in expected if item['status_code'] == 'SUCCEEDED'][30:]
+
+    monkeypatch.setattr(dynamo.jobs, 'QUERY_JOBS_TIME_BUDGET_SECONDS', 0)
+    response, next_key = dynamo.jobs.query_jobs('user1', page_size=25)
+    assert response == dynamo.jobs.query_jobs('user1')[0]
+    assert next_key is not None
+
+
+def test_query_jobs_before_filter_indexes_are_deployed(tables, monkeypatch):
+    # Jobs submitted before the filter indexes existed have no index keys until they are backfilled
+    table_items = [
+        {
+            'job_id': f'job{i}',
+            'user_id': 'user1',
+            'name': f'name{i % 2}',
+            'job_type': 'RTC_GAMMA',
+            'status_code': 'FAILED' if i % 3 == 0 else 'SUCCEEDED',
+            'request_time': f'2000-01-01T00:00:{i:02d}+00:00',
+        }
+        for i in range(6)
+    ]
+    for item in table_items:
+        tables.jobs_table.put_item(Item=item)
+
+    monkeypatch.setenv('JOBS_TABLE_INDEXES', '1')
+    assert dynamo.jobs._get_query_params('user1', status_code='FAILED', name='name0')['IndexName'] == 'user_id'
+    response, _ = dynamo.jobs.query_jobs('user1', status_code='FAILED', name='name0')
+    assert response == [table_items[0]]
+
+    monkeypatch.setenv('JOBS_TABLE_INDEXES', '2')
+    assert dynamo.jobs._get_query_params('user1', status_code='FAILED', name='name0')['IndexName'] == (
+        'user_id_status_code'
+    )
+    assert dynamo.jobs._get_query_params('user1', name='name0')['IndexName'] == 'user_id'
+    response, _ = dynamo.jobs.query_jobs('user1', name='name1', start='2000-01-01T00:00:02+00:00')
+    assert response == [table_items[5], table_items[3]]
+
+    monkeypatch.setenv('JOBS_TABLE_INDEXES', '4')
+    assert dynamo.jobs._get_query_params('user1', status_code='FAILED', name='name0')['IndexName'] == 'user_id_name'
+    assert dynamo.jobs._get_query_params('user1', job_type='RTC_GAMMA')['IndexName'] == 'user_id_job_type'
+
+
+def test_query_jobs_before_backfill(tables, monkeypatch):
+    dynamo.jobs.BACKFILL_STATUS.clear()
+    assert dynamo.jobs._get_query_params('user1', status_code='FAILED')['IndexName'] == 'user_id'
+
+    monkeypatch.delenv('JOBS_TABLE_INDEXES')
+    dynamo.jobs.BACKFILL_STATUS['complete'] = True
+    assert dynamo.jobs._get_query_params('user1', status_code='FAILED')['IndexName'] == 'user_id'
+
+
+def test_is_backfill_complete(tables):
+    dynamo.jobs.BACKFILL_STATUS.clear()
+    assert not dynamo.jobs.is_backfill_complete()
+
+    tables.jobs_table.put_item(Item={'job_id': dynamo.jobs.BACKFILL_MARKER_JOB_ID})
+    assert not dynamo.jobs.is_backfill_complete()
+
+    dynamo.jobs.BACKFILL_STATUS['next_check_time'] = 0
+    assert dynamo.jobs.is_backfill_complete()
+
+    tables.jobs_table.delete_item(Key={'job_id': dynamo.jobs.BACKFILL_MARKER_JOB_ID})
+    assert dynamo.jobs.is_backfill_complete()
+
+
 def test_get_credit_cost():
     costs: dict = {
         'RTC_GAMMA': {
@@ -359,7 +545,11 @@ def test_put_jobs(tables, monkeypatch, approved_user):
             assert job['bucket'] == 'test-bucket'
             assert job['bucket_prefix'] == job['job_id']
 
-    assert tables.jobs_table.scan()['Items'] == sorted(jobs, key=lambda item: item['job_id'])
+    assert dynamo.job_names.get_job_names(approved_user) == ['name1', 'name2', 'name3', 'name4']
+
+    assert tables.jobs_table.scan()['Items'] == [
+        dynamo.jobs._add_index_keys(job) for job in sorted(jobs, key=lambda item: item['job_id'])
+    ]
 
     assert tables.users_table.scan()['Items'] == [
         {
@@ -367,8 +557,10 @@ def test_put_jobs(tables, monkeypatch, approved_user):
             'remaining_credits': Decimal(5),
             '_month_of_last_credit_reset': '2024-02',
             'application_status': APPLICATION_APPROVED,
+            '_dispatch_registration_time': unittest.mock.ANY,
         }
     ]
+    assert list(dynamo.user.get_dispatch_registrations()) == [approved_user]
 
 
 def test_put_jobs_application_status(tables):
@@ -463,7 +655,9 @@ def test_put_jobs_default_params(tables, approved_user):
     assert jobs[10]['job_parameters'] == {'c1': 'foo'}
     assert jobs[11]['job_parameters'] == {'n1': 'foo'}
 
-    assert tables.jobs_table.scan()['Items'] == sorted(jobs, key=lambda item: item['job_id'])
+    assert tables.jobs_table.scan()['Items'] == [
+        dynamo.jobs._add_index_keys(job) for job in sorted(jobs, key=lambda item: item['job_id'])
+    ]
 
 
 def test_put_jobs_costs(tables, monkeypatch, approved_user):
@@ -527,7 +721,9 @@ def test_put_jobs_costs(tables, monkeypatch, approved_user):
     assert jobs[6]['credit_cost'] == Decimal('5.0')
     assert jobs[7]['credit_cost'] == Decimal('0.4')
 
-    assert tables.jobs_table.scan()['Items'] == sorted(jobs, key=lambda item: item['job_id'])
+    assert tables.jobs_table.scan()['Items'] == [
+        dynamo.jobs._add_index_keys(job) for job in sorted(jobs, key=lambda item: item['job_id'])
+    ]
     assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal('11.7')
 
 
@@ -539,7 +735,20 @@ def test_put_jobs_insufficient_credits(tables, monkeypatch, approved_user):
         dynamo.jobs.put_jobs(approved_user, payload)
 
     assert tables.jobs_table.scan()['Items'] == []
-    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == 1
+    assert dynamo.user.get_or_create_user(approved_user)['remaining_credits'] == 1
+
+
+def test_put_jobs_job_id_in_use(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    dynamo.jobs.put_jobs(approved_user, [{'name': 'name1'}], job_ids=['job1'])
+
+    with pytest.raises(JobIdInUseError, match=r'^Job IDs already in use: job1$') as e:
+        dynamo.jobs.put_jobs(approved_user, [{'name': 'name2'}, {'name': 'name1'}], job_ids=['job2', 'job1'])
+
+    assert e.value.job_ids == ['job1']
+    assert [item['job_id'] for item in tables.jobs_table.scan()['Items']] == ['job1']
+    assert dynamo.user.get_or_create_user(approved_user)['remaining_credits'] == 9
+    assert dynamo.job_names.get_job_names(approved_user) == ['name1']
 
 
 def test_put_jobs_infinite_credits(tables, monkeypatch):
@@ -621,13 +830,250 @@ def test_put_jobs_priority_extra_credits(tables, monkeypatch, approved_user):
     assert jobs[7]['priority'] == 9996
 
 
-def test_put_jobs_decrement_credits_failure(tables, approved_user):
-    with unittest.mock.patch('dynamo.user.decrement_credits') as mock_decrement_credits:
-        mock_decrement_credits.side_effect = Exception('test error')
+def test_put_jobs_transaction_failure(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    with unittest.mock.patch('dynamo.jobs._transact_write_items') as mock_transact_write_items:
+        mock_transact_write_items.side_effect = Exception('test error')
         with pytest.raises(Exception, match=r'^test error$'):
             dynamo.jobs.put_jobs(approved_user, [{'name': 'job1'}])
 
     assert tables.jobs_table.scan()['Items'] == []
+    assert dynamo.user.get_or_create_user(approved_user)['remaining_credits'] == Decimal(10)
+    assert dynamo.job_names.get_job_names(approved_user) == []
+
+
+def test_put_jobs_credits_spent_concurrently(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    user = dynamo.user.get_or_create_user(approved_user)
+    tables.users_table.update_item(
+        Key={'user_id': approved_user},
+        UpdateExpression='SET remaining_credits = :credits',
+        ExpressionAttributeValues={':credits': Decimal(1)},
+    )
+
+    with unittest.mock.patch('dynamo.user.get_user_for_submission', return_value=(user, False)):
+        with pytest.raises(InsufficientCreditsError):
+            dynamo.jobs.put_jobs(approved_user, [{'name': 'job1'}, {'name': 'job2'}])
+
+    assert tables.jobs_table.scan()['Items'] == []
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(1)
+
+
+def test_put_jobs_credit_reset(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+
+    with (
+        unittest.mock.patch('dynamo.user._get_current_month', return_value='2024-02'),
+        unittest.mock.patch(
+            'dynamo.jobs._transact_write_items', side_effect=dynamo.jobs._transact_write_items
+        ) as mock_transact_write_items,
+    ):
+        jobs = dynamo.jobs.put_jobs(approved_user, [{'name': 'job1'}, {'name': 'job2'}])
+
+    assert [job['priority'] for job in jobs] == [10, 9]
+    assert len(mock_transact_write_items.mock_calls) == 1
+    assert tables.users_table.scan()['Items'] == [
+        {
+            'user_id': approved_user,
+            'remaining_credits': Decimal(8),
+            'application_status': APPLICATION_APPROVED,
+            '_month_of_last_credit_reset': '2024-02',
+            '_dispatch_registration_time': unittest.mock.ANY,
+        }
+    ]
+
+    with unittest.mock.patch('dynamo.user._get_current_month', return_value='2024-02'):
+        jobs = dynamo.jobs.put_jobs(approved_user, [{'name': 'job3'}])
+
+    assert [job['priority'] for job in jobs] == [8]
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(7)
+
+
+def test_put_jobs_cached_user_out_of_date(tables, monkeypatch):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '10')
+    tables.users_table.put_item(
+        Item={
+            'user_id': 'user1',
+            'remaining_credits': Decimal(10),
+            'application_status': APPLICATION_APPROVED,
+            'priority_override': 100,
+            '_month_of_last_credit_reset': '2024-01',
+        }
+    )
+    assert dynamo.user.get_user_for_submission('user1')[1] is False
+
+    # Another request performs the monthly credit reset and spends most of the credits
+    tables.users_table.update_item(
+        Key={'user_id': 'user1'},
+        UpdateExpression='SET remaining_credits = :credits, #month = :month',
+        ExpressionAttributeNames={'#month': '_month_of_last_credit_reset'},
+        ExpressionAttributeValues={':credits': Decimal(1), ':month': '2024-02'},
+    )
+
+    with unittest.mock.patch('dynamo.user._get_current_month', return_value='2024-02'):
+        with pytest.raises(InsufficientCreditsError, match=r'but you have only 1 remaining'):
+            dynamo.jobs.put_jobs('user1', [{'name': 'job1'}, {'name': 'job2'}])
+
+        assert tables.jobs_table.scan()['Items'] == []
+        assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(1)
+
+        jobs = dynamo.jobs.put_jobs('user1', [{'name': 'job1'}])
+
+    assert [job['priority'] for job in jobs] == [100]
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(0)
+
+
+def test_put_jobs_chunks(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1000')
+    payload = [{'name': f'job{i}'} for i in range(250)]
+
+    with unittest.mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=dynamo.jobs._transact_write_items
+    ) as mock_transact_write_items:
+        jobs = dynamo.jobs.put_jobs(approved_user, payload)
+
+    # Each transaction holds an item per job and per distinct job name, plus the debit in the first
+    assert [len(call.args[0]) for call in mock_transact_write_items.mock_calls] == [99, 100, 100, 100, 100, 2]
+    assert 'Update' in mock_transact_write_items.mock_calls[0].args[0][0]
+    assert len(tables.jobs_table.scan()['Items']) == 250
+    assert dynamo.job_names.get_job_names(approved_user) == sorted(f'job{i}' for i in range(250))
+    assert {job['job_id'] for job in jobs} == {item['job_id'] for item in tables.jobs_table.scan()['Items']}
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(750)
+
+
+def test_put_jobs_chunks_repeated_names(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1000')
+    payload = [{'name': f'job{i % 3}'} for i in range(150)] + [{}] * 10
+
+    with unittest.mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=dynamo.jobs._transact_write_items
+    ) as mock_transact_write_items:
+        dynamo.jobs.put_jobs(approved_user, payload)
+
+    assert [len(call.args[0]) for call in mock_transact_write_items.mock_calls] == [100, 67]
+    assert dynamo.job_names.get_job_names(approved_user) == ['job0', 'job1', 'job2']
+    assert tables.job_names_table.get_item(Key={'user_id': approved_user, 'name': 'job0'})['Item']['job_count'] == 50
+
+
+def test_put_jobs_infinite_credits_chunks(tables):
+    tables.users_table.put_item(
+        Item={'user_id': 'user1', 'remaining_credits': None, 'application_status': APPLICATION_APPROVED}
+    )
+
+    with unittest.mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=dynamo.jobs._transact_write_items
+    ) as mock_transact_write_items:
+        dynamo.jobs.put_jobs('user1', [{}] * 200)
+
+    # Registering the user for dispatch takes the place of a job in the first transaction
+    assert [len(call.args[0]) for call in mock_transact_write_items.mock_calls] == [100, 100, 1]
+    assert mock_transact_write_items.mock_calls[0].args[0][0]['Update']['Key'] == {'user_id': 'user1'}
+    assert 'user1' in dynamo.user.get_dispatch_registrations()
+    assert len(tables.jobs_table.scan()['Items']) == 200
+
+
+def test_put_jobs_partial_failure(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1000')
+    payload = [{'name': f'job{i}'} for i in range(150)]
+    transact_write_items = dynamo.jobs._transact_write_items
+
+    def fail_second_transaction(items):
+        if mock_transact_write_items.call_count > 1:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InternalServerError'}}, 'TransactWriteItems')
+        transact_write_items(items)
+
+    with unittest.mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=fail_second_transaction
+    ) as mock_transact_write_items:
+        with pytest.raises(PartialJobSubmissionError, match=r'^Only 49 of 150 jobs were submitted') as e:
+            dynamo.jobs.put_jobs(approved_user, payload)
+
+    assert len(e.value.submitted_jobs) == 49
+    assert len(e.value.failed_jobs) == 101
+    assert {job['job_id'] for job in e.value.submitted_jobs} == {
+        item['job_id'] for item in tables.jobs_table.scan()['Items']
+    }
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(951)
+    assert dynamo.job_names.get_job_names(approved_user) == sorted(f'job{i}' for i in range(49))
+
+
+def test_put_jobs_failed_transaction_applied(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1000')
+    transact_write_items = dynamo.jobs._transact_write_items
+
+    def time_out_second_transaction(items):
+        transact_write_items(items)
+        if mock_transact_write_items.call_count == 2:
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url='https://dynamodb')
+
+    with unittest.mock.patch(
+        'dynamo.jobs._transact_write_items', side_effect=time_out_second_transaction
+    ) as mock_transact_write_items:
+        jobs = dynamo.jobs.put_jobs(approved_user, [{}] * 250)
+
+    assert mock_transact_write_items.call_count == 3
+    assert {job['job_id'] for job in jobs} == {item['job_id'] for item in tables.jobs_table.scan()['Items']}
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(750)
+
+
+def test_put_jobs_failed_transaction_lookup_fails(tables, monkeypatch, approved_user):
+    monkeypatch.setenv('DEFAULT_CREDITS_PER_USER', '1000')
+    transact_write_items = dynamo.jobs._transact_write_items
+
+    def fail_second_transaction(items):
+        if mock_transact_write_items.call_count > 1:
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url='https://dynamodb')
+        transact_write_items(items)
+
+    with (
+        unittest.mock.patch(
+            'dynamo.jobs._transact_write_items', side_effect=fail_second_transaction
+        ) as mock_transact_write_items,
+        unittest.mock.patch(
+            'dynamo.jobs.get_existing_job_ids',
+            side_effect=botocore.exceptions.ReadTimeoutError(endpoint_url='https://dynamodb'),
+        ),
+    ):
+        with pytest.raises(botocore.exceptions.ReadTimeoutError):
+            dynamo.jobs.put_jobs(approved_user, [{}] * 150)
+
+    # The second transaction's outcome is unknown, so its jobs are not refunded
+    assert len(tables.jobs_table.scan()['Items']) == 99
+    assert tables.users_table.scan()['Items'][0]['remaining_credits'] == Decimal(850)
+
+
+def test_transact_write_items_retries(tables):
+    def cancelled(*reasons):
+        return botocore.exceptions.ClientError(
+            {
+                'Error': {'Code': 'TransactionCanceledException'},
+                'CancellationReasons': [{'Code': reason} for reason in reasons],
+            },
+            'TransactWriteItems',
+        )
+
+    items = [{'Put': {'TableName': os.environ['JOBS_TABLE_NAME'], 'Item': {'job_id': 'job1'}}}]
+    with (
+        unittest.mock.patch('dynamo.util.DYNAMODB_RESOURCE.meta.client.transact_write_items') as mock_transact,
+        unittest.mock.patch('time.sleep'),
+    ):
+        mock_transact.side_effect = [cancelled('TransactionConflict'), cancelled('None', 'ThrottlingError'), {}]
+        dynamo.jobs._transact_write_items(items)
+        assert mock_transact.call_count == 3
+        tokens = {call.kwargs['ClientRequestToken'] for call in mock_transact.mock_calls}
+        assert len(tokens) == 1
+
+        mock_transact.reset_mock()
+        mock_transact.side_effect = [cancelled('TransactionConflict')] * 3
+        with pytest.raises(botocore.exceptions.ClientError):
+            dynamo.jobs._transact_write_items(items)
+        assert mock_transact.call_count == 3
+
+        mock_transact.reset_mock()
+        mock_transact.side_effect = [cancelled('ConditionalCheckFailed', 'TransactionConflict')]
+        with pytest.raises(botocore.exceptions.ClientError):
+            dynamo.jobs._transact_write_items(items)
+        assert mock_transact.call_count == 1
 
 
 def test_get_job(tables):
@@ -663,6 +1109,22 @@ def test_get_job(tables):
     assert dynamo.jobs.get_job('foo') is None
 
 
+def test_get_jobs_by_id(tables):
+    table_items = [
+        {'job_id': 'job1', 'user_id': 'user1', 'status_code': 'PENDING', 'dispatch_priority': '9999#2000'},
+        {'job_id': 'job2', 'user_id': 'user1', 'status_code': 'SUCCEEDED'},
+    ]
+    for item in table_items:
+        tables.jobs_table.put_item(Item=item)
+
+    assert dynamo.jobs.get_jobs_by_id(['job1', 'job2', 'job3']) == {
+        'job1': {'job_id': 'job1', 'user_id': 'user1', 'status_code': 'PENDING'},
+        'job2': table_items[1],
+    }
+    assert dynamo.jobs.get_existing_job_ids(['job1', 'job2', 'job3']) == {'job1', 'job2'}
+    assert dynamo.jobs.get_jobs_by_id([]) == {}
+
+
 def test_query_jobs_sort_order(tables):
     table_items = [
         {
@@ -720,12 +1182,22 @@ def test_update_job(tables):
             'name': 'name1',
             'user_id': 'user1',
             'status_code': 'status2',
+            'user_id_status_code': 'user1#status2',
             'request_time': '2000-01-01T00:00:00+00:00',
             'processing_time_in_seconds': Decimal('1.23'),
         },
     ]
     assert response['Items'] == expected_response
 
+    with unittest.mock.patch.object(tables.jobs_table.meta.client, 'get_item') as mock_get_item:
+        dynamo.jobs.update_job({'job_id': 'job1', 'user_id': 'user1', 'status_code': 'status3'})
+        mock_get_item.assert_not_called()
+    expected_response[0].update({'status_code': 'status3', 'user_id_status_code': 'user1#status3'})
+    assert tables.jobs_table.scan()['Items'] == expected_response
+    assert dynamo.jobs.query_jobs('user1', status_code='status3')[0] == [
+        {key: value for key, value in expected_response[0].items() if key != 'user_id_status_code'}
+    ]
+
 
 def test_update_job_for_user(tables):
     table_items = [
@@ -755,6 +1227,7 @@ def test_update_job_for_user(tables):
         {
             'job_id': 'job1',
             'name': 'newname',
+            'user_id_name': 'user1#newname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
@@ -795,6 +1268,7 @@ def test_update_job_for_user(tables):
         {
             'job_id': 'job1',
             'name': 'anothernewname',
+            'user_id_name': 'user1#anothernewname',
             'somefield': 'somevalue',
             'user_id': 'user1',
         },
@@ -805,6 +1279,7 @@ def test_update_job_for_user(tables):
             'user_id': 'user2',
         },
     ]
+    assert dynamo.job_names.get_job_names('user1') == ['anothernewname']
 
 
 def test_update_job_for_user_job_not_found(tables):
@@ -893,26 +1368,236 @@ def test_update_job_for_user_exception():
 
 def test_get_jobs_waiting_for_execution(tables):
     items = [
-        {'job_id': 'job0', 'status_code': 'PENDING', 'execution_started': False},
-        {'job_id': 'job1', 'status_code': 'PENDING'},
-        {'job_id': 'job2', 'status_code': 'RUNNING', 'execution_started': True},
-        {'job_id': 'job3', 'status_code': 'PENDING', 'execution_started': True},
-        {'job_id': 'job4', 'status_code': 'PENDING', 'execution_started': False},
-        {'job_id': 'job5', 'status_code': 'PENDING', 'execution_started': True},
-        {'job_id': 'job6', 'status_code': 'PENDING', 'execution_started': False},
-        {'job_id': 'job7', 'status_code': 'PENDING', 'execution_started': True},
-        {'job_id': 'job8', 'status_code': 'RUNNING'},
-        {'job_id': 'job9', 'status_code': 'PENDING'},
+        {'job_id': 'job0', 'status_code': 'PENDING', 'execution_started': False, 'priority': 10},
+        {'job_id': 'job1', 'status_code': 'PENDING', 'priority': 20},
+        {'job_id': 'job2', 'status_code': 'RUNNING', 'execution_started': True, 'priority': 30},
+        {'job_id': 'job3', 'status_code': 'PENDING', 'execution_started': True, 'priority': 40},
+        {'job_id': 'job4', 'status_code': 'PENDING', 'execution_started': False, 'priority': 10},
+        {'job_id': 'job5', 'status_code': 'PENDING', 'execution_started': True, 'priority': 50},
+        {'job_id': 'job6', 'status_code': 'PENDING', 'execution_started': False, 'priority': 0},
+        {'job_id': 'job7', 'status_code': 'PENDING', 'execution_started': True, 'priority': 60},
+        {'job_id': 'job8', 'status_code': 'RUNNING', 'priority': 70},
+        {'job_id': 'job9', 'status_code': 'PENDING', 'priority': 9999},
+    ]
+    for i, item in enumerate(items):
+        item.update({'user_id': 'user1', 'request_time': f'2000-01-01T00:00:{10 - i:02d}+00:00'})
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    dynamo.user.register_for_dispatch({'user_id': 'user1'})
+
+    # Highest priority first, then oldest first
+    expected = [items[9], items[1], items[4], items[0], items[6]]
+    for limit in range(1, 7):
+        assert dynamo.jobs.get_jobs_waiting_for_execution(limit=limit) == expected[:limit]
+
+    dynamo.jobs.update_job({'job_id': 'job1', 'execution_started': True})
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [items[9], items[4], items[0], items[6]]
+    assert 'dispatch_priority' not in tables.jobs_table.get_item(Key={'job_id': 'job1'})['Item']
+
+
+def test_get_jobs_waiting_for_execution_per_user(tables):
+    # user1's jobs all have a higher priority than user2's, but are limited per user so that user2's are also read
+    items = [
+        {
+            'job_id': f'user1-job{i}',
+            'user_id': 'user1',
+            'priority': 100 - i,
+            'request_time': '2000-01-01T00:00:00+00:00',
+        }
+        for i in range(10)
+    ]
+    items += [
+        {'job_id': f'user2-job{i}', 'user_id': 'user2', 'priority': 10 - i, 'request_time': '2000-01-01T00:00:00+00:00'}
+        for i in range(2)
+    ]
+    for item in items:
+        item.update({'status_code': 'PENDING', 'execution_started': False})
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    for user_id in ('user1', 'user2'):
+        dynamo.user.register_for_dispatch({'user_id': user_id})
+
+    # Each user is read half of the limit, and user1 is then read the capacity that user2 left
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=6) == items[:4] + items[10:]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=2) == [items[0], items[10]]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=20) == items
+
+
+def test_get_jobs_waiting_for_execution_items_read(tables):
+    items = [
+        {
+            'job_id': f'user{i}-job{j}',
+            'user_id': f'user{i}',
+            'status_code': 'PENDING',
+            'execution_started': False,
+            'priority': 0,
+            'request_time': f'2000-01-01T00:00:{j:02d}+00:00',
+        }
+        for i in range(20)
+        for j in range(30 if i < 2 else 2)
+    ]
+    with tables.jobs_table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=dynamo.jobs._add_index_keys(item))
+    for i in range(20):
+        dynamo.user.register_for_dispatch({'user_id': f'user{i}'})
+
+    query_dispatch_index = dynamo.jobs._query_dispatch_index
+    items_read = []
+
+    def count_items_read(*args):
+        user_jobs, start_key = query_dispatch_index(*args)
+        items_read.extend(user_jobs)
+        return user_jobs, start_key
+
+    with unittest.mock.patch('dynamo.jobs._query_dispatch_index', side_effect=count_items_read):
+        jobs = dynamo.jobs.get_jobs_waiting_for_execution(limit=50)
+
+    # Each user is read 2 jobs, and the users with more jobs then share the remaining capacity
+    assert len(items_read) == len(jobs) == 50
+    assert Counter(job['user_id'] for job in jobs) == {'user0': 7, 'user1': 7, **{f'user{i}': 2 for i in range(2, 20)}}
+
+
+def test_get_jobs_waiting_for_execution_unregisters_users(tables):
+    now = datetime(2000, 1, 1, 1, tzinfo=UTC)
+    job = {
+        'job_id': 'job0',
+        'user_id': 'claimed',
+        'status_code': 'PENDING',
+        'execution_started': False,
+        'priority': 0,
+        'request_time': '2000-01-01T00:00:00+00:00',
+    }
+    tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(job))
+    dynamo.jobs.claim_jobs([job], now=now)
+    for user_id in ('claimed', 'finished'):
+        dynamo.user.register_for_dispatch({'user_id': user_id}, now=now - timedelta(minutes=10))
+    dynamo.user.register_for_dispatch({'user_id': 'submitting'}, now=now - timedelta(minutes=1))
+
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10, now=now) == []
+
+    # Users with claimed jobs, or whose jobs may still be being written, remain registered
+    assert list_have_same_elements(dynamo.user.get_dispatch_registrations(), ['claimed', 'submitting'])
+
+
+def test_get_jobs_waiting_for_execution_before_dispatch_index_is_deployed(tables, monkeypatch):
+    monkeypatch.setenv('JOBS_TABLE_INDEXES', '0')
+    items = [
+        {'job_id': f'job{i}', 'user_id': 'user1', 'status_code': 'PENDING', 'execution_started': False, 'priority': i}
+        for i in range(4)
+    ]
+    for item in items:
+        item['request_time'] = '2000-01-01T00:00:00+00:00'
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    dynamo.jobs.update_job({'job_id': 'job3', 'execution_started': True})
+
+    assert list_have_same_elements(dynamo.jobs.get_jobs_waiting_for_execution(limit=10), items[:3])
+    assert len(dynamo.jobs.get_jobs_waiting_for_execution(limit=2)) == 2
+
+    now = datetime(2000, 1, 1, 0, 1, tzinfo=UTC)
+    assert dynamo.jobs.claim_jobs(items[:2], now=now) == items[:2]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [items[2]]
+
+    assert dynamo.jobs.release_expired_claims(now=now + timedelta(minutes=6)) == 2
+    assert list_have_same_elements(dynamo.jobs.get_jobs_waiting_for_execution(limit=10), items[:3])
+
+
+def test_get_jobs_waiting_for_execution_without_dispatch_keys(tables, monkeypatch):
+    # Jobs submitted before dispatch keys existed are dispatched until the backfill adds their keys
+    monkeypatch.setenv('JOBS_TABLE_INDEXES', '0')
+    items = [
+        {
+            'job_id': f'job{i}',
+            'user_id': 'user1',
+            'status_code': 'PENDING',
+            'execution_started': False,
+            'priority': i,
+            'request_time': '2000-01-01T00:00:00+00:00',
+        }
+        for i in range(3)
     ]
     for item in items:
         tables.jobs_table.put_item(Item=item)
+    dynamo.jobs.update_job({'job_id': 'job2', 'execution_started': True})
+
+    assert list_have_same_elements(dynamo.jobs.get_jobs_waiting_for_execution(limit=10), items[:2])
+
+    now = datetime(2000, 1, 1, 0, 1, tzinfo=UTC)
+    assert dynamo.jobs.claim_jobs(items, now=now) == items[:2]
+    assert dynamo.jobs.claim_jobs(items, now=now) == []
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == []
+
+    dynamo.jobs.release_jobs(items[:1])
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == items[:1]
+
+
+def test_claim_jobs(tables):
+    items = [
+        {'job_id': f'job{i}', 'user_id': 'user1', 'status_code': 'PENDING', 'execution_started': False, 'priority': i}
+        for i in range(4)
+    ]
+    for item in items:
+        item['request_time'] = '2000-01-01T00:00:00+00:00'
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    dynamo.user.register_for_dispatch({'user_id': 'user1'})
+    dynamo.jobs.update_job({'job_id': 'job3', 'execution_started': True})
+
+    now = datetime(2000, 1, 1, 0, 1, tzinfo=UTC)
+    assert dynamo.jobs.claim_jobs(items[:2], now=now) == items[:2]
+    assert tables.jobs_table.get_item(Key={'job_id': 'job0'})['Item']['dispatch_priority'] == (
+        'CLAIMED#2000-01-01T00:06:00+00:00'
+    )
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [items[2]]
+
+    # Jobs already claimed, or whose execution already started, cannot be claimed again
+    assert dynamo.jobs.claim_jobs(items, now=now) == [items[2]]
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == []
+
+    dynamo.jobs.release_jobs(items)
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == list(reversed(items[:3]))
+    assert 'dispatch_priority' not in tables.jobs_table.get_item(Key={'job_id': 'job3'})['Item']
+
+
+def test_release_expired_claims(tables):
+    items = [
+        {'job_id': f'job{i}', 'user_id': 'user1', 'status_code': 'PENDING', 'execution_started': False, 'priority': i}
+        for i in range(4)
+    ]
+    for item in items:
+        item['request_time'] = '2000-01-01T00:00:00+00:00'
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    dynamo.user.register_for_dispatch({'user_id': 'user1'})
+
+    now = datetime(2000, 1, 1, 0, 1, tzinfo=UTC)
+    assert dynamo.jobs.claim_jobs(items[:3], now=now) == items[:3]
+    assert dynamo.jobs.claim_jobs(items[3:], now=now + timedelta(minutes=10)) == items[3:]
+    dynamo.jobs.update_job({'job_id': 'job2', 'execution_started': True})
+
+    assert dynamo.jobs.release_expired_claims(now=now + timedelta(minutes=4)) == 0
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == []
+
+    assert dynamo.jobs.release_expired_claims(now=now + timedelta(minutes=6)) == 2
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [items[1], items[0]]
+
+    assert dynamo.jobs.release_expired_claims(now=now + timedelta(minutes=60)) == 1
+    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=10) == [items[3], items[1], items[0]]
+
+
+def test_get_jobs_from_stream_records():
+    serializer = TypeSerializer()
+    jobs: list[dict] = [
+        {'job_id': 'job0', 'status_code': 'PENDING', 'execution_started': False, 'priority': Decimal(10)},
+        {'job_id': 'job1', 'status_code': 'PENDING', 'execution_started': True},
+        {'job_id': 'job2', 'status_code': 'RUNNING'},
+        {'job_id': 'job3', 'status_code': 'PENDING', 'user_id_status_code': 'foo', 'dispatch_priority': 'bar'},
+    ]
+    records: list[dict] = [
+        {'eventName': 'INSERT', 'dynamodb': {'NewImage': {k: serializer.serialize(v) for k, v in job.items()}}}
+        for job in jobs
+    ]
+    records.append({'eventName': 'MODIFY', 'dynamodb': records[0]['dynamodb']})
+    records.append({'eventName': 'REMOVE', 'dynamodb': {}})
 
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=1) == [items[0]]
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=2) == [items[0], items[1]]
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=3) == [items[0], items[1], items[4]]
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=4) == [items[0], items[1], items[4], items[6]]
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=5) == [items[0], items[1], items[4], items[6], items[9]]
-    assert dynamo.jobs.get_jobs_waiting_for_execution(limit=6) == [items[0], items[1], items[4], items[6], items[9]]
+    assert dynamo.jobs.get_jobs_from_stream_records(records) == [jobs[0], {'job_id': 'job3', 'status_code': 'PENDING'}]
+    assert dynamo.jobs.get_jobs_from_stream_records([]) == []
 
 
 def test_decimal_conversion(tables):
@@ -0,0 +1,124 @@
+import unittest.mock
+from decimal import Decimal
+
+import botocore.exceptions
+import pytest
+
+import dynamo.submissions
+
+
+def test_put_submission(tables, monkeypatch):
+    monkeypatch.setattr(dynamo.submissions, 'SUBMISSION_CHUNK_SIZE', 2)
+    jobs = [{'name': f'job{i}'} for i in range(5)]
+
+    submission = dynamo.submissions.put_submission('user1', jobs)
+
+    assert submission['user_id'] == 'user1'
+    assert submission['status_code'] == 'PENDING'
+    assert submission['job_count'] == 5
+    assert submission['errors'] == []
+    assert not set(dynamo.submissions.INTERNAL_ATTRIBUTES) & submission.keys()
+
+    submission_id = submission['submission_id']
+    assert dynamo.submissions.get_submission(submission_id) == submission
+
+    item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+    assert item['chunk_count'] == 3
+    assert item['next_chunk'] == 0
+
+    assert dynamo.submissions.get_submission_chunk(submission_id, 0) == jobs[0:2]
+    assert dynamo.submissions.get_submission_chunk(submission_id, 1) == jobs[2:4]
+    assert dynamo.submissions.get_submission_chunk(submission_id, 2) == jobs[4:]
+
+
+def test_get_submission_does_not_exist(tables):
+    assert dynamo.submissions.get_submission('does-not-exist') is None
+
+
+def test_process_submission_lifecycle(tables):
+    submission_id = dynamo.submissions.put_submission('user1', [{}, {}, {}])['submission_id']
+
+    submission = dynamo.submissions.start_processing(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'RUNNING'
+    assert dynamo.submissions.start_processing(submission_id) is None
+
+    errors = [{'line': 2, 'detail': 'bad job'}]
+    dynamo.submissions.record_chunk(submission_id, 0, job_count=3, submitted_count=2, errors=errors)
+    with pytest.raises(botocore.exceptions.ClientError, match=r'ConditionalCheckFailedException'):
+        dynamo.submissions.record_chunk(submission_id, 0, job_count=3, submitted_count=2, errors=errors)
+
+    dynamo.submissions.release_submission(submission_id, failed_attempt=True)
+    item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+    assert item['status_code'] == 'PENDING'
+    assert item['attempts'] == 1
+    assert item['next_chunk'] == 1
+    assert 'lease_expiration_time' not in item
+
+    dynamo.submissions.start_processing(submission_id)
+    dynamo.submissions.finish_submission(submission_id, dynamo.submissions.SUCCEEDED)
+    item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+    assert 'lease_expiration_time' not in item
+
+    assert dynamo.submissions.get_submission(submission_id) == {
+        'submission_id': submission_id,
+        'user_id': 'user1',
+        'request_time': submission['request_time'],
+        'status_code': 'SUCCEEDED',
+        'job_count': 3,
+        'processed_count': 3,
+        'submitted_count': 2,
+        'failed_count': 1,
+        'errors': [{'line': Decimal(2), 'detail': 'bad job'}],
+    }
+
+
+def test_finish_submission_with_detail(tables):
+    submission_id = dynamo.submissions.put_submission('user1', [{}])['submission_id']
+
+    with pytest.raises(botocore.exceptions.ClientError, match=r'ConditionalCheckFailedException'):
+        dynamo.submissions.finish_submission(submission_id, dynamo.submissions.FAILED)
+
+    dynamo.submissions.start_processing(submission_id)
+    dynamo.submissions.finish_submission(submission_id, dynamo.submissions.FAILED, 'something went wrong')
+
+    submission = dynamo.submissions.get_submission(submission_id)
+    assert submission is not None
+    assert submission['status_code'] == 'FAILED'
+    assert submission['detail'] == 'something went wrong'
+
+
+def test_get_job_id():
+    submission_id = '27836b79-e5b2-4d8f-932f-659724ea02c3'
+    assert dynamo.submissions.get_job_id(submission_id, 1) == dynamo.submissions.get_job_id(submission_id, 1)
+    assert dynamo.submissions.get_job_id(submission_id, 1) != dynamo.submissions.get_job_id(submission_id, 2)
+    assert dynamo.submissions.get_job_id(submission_id, 1) != dynamo.submissions.get_job_id(
+        'f1f5a0b0-8a3e-4a2c-9c1d-2b6f3c4d5e6f', 1
+    )
+
+
+def test_reclaim_expired_leases(tables):
+    lease = dynamo.submissions.SUBMISSION_LEASE_SECONDS
+    running_id, renewed_id, pending_id = (
+        dynamo.submissions.put_submission('user1', [{}, {}])['submission_id'] for _ in range(3)
+    )
+    with unittest.mock.patch('time.time', return_value=1000):
+        dynamo.submissions.start_processing(running_id)
+        dynamo.submissions.start_processing(renewed_id)
+    with unittest.mock.patch('time.time', return_value=1000 + lease):
+        dynamo.submissions.record_chunk(renewed_id, 0, job_count=1, submitted_count=1, errors=[])
+
+    assert dynamo.submissions.reclaim_expired_leases(now=1000 + lease) == 0
+    assert dynamo.submissions.reclaim_expired_leases(now=1001 + lease) == 1
+
+    item = tables.submissions_table.get_item(Key={'submission_id': running_id})['Item']
+    assert item['status_code'] == 'PENDING'
+    assert item['attempts'] == 1
+    assert 'lease_expiration_time' not in item
+    assert tables.submissions_table.scan(IndexName='lease_expiration')['Items'] == [
+        {'submission_id': renewed_id, 'status_code': 'RUNNING', 'lease_expiration_time': 1000 + 2 * lease}
+    ]
+    for submission_id, status_code in ((renewed_id, 'RUNNING'), (pending_id, 'PENDING')):
+        item = tables.submissions_table.get_item(Key={'submission_id': submission_id})['Item']
+        assert item['status_code'] == status_code
+        assert item['attempts'] == 0
@@ -1,9 +1,13 @@
 import os
+from collections import Counter
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 from unittest.mock import patch
 
+import boto3
 import pytest
 from botocore.stub import Stubber
+from moto import mock_aws
 
 import get_files
 
@@ -14,9 +18,16 @@ def setup_env(monkeypatch):
     monkeypatch.setenv('AWS_REGION', 'myRegion')
 
 
+@pytest.fixture(autouse=True)
+def clear_bucket_caches():
+    get_files.get_bucket_region.cache_clear()
+    get_files.LIFECYCLE_RULES_BY_BUCKET.clear()
+
+
 @pytest.fixture
 def s3_stubber():
-    with Stubber(get_files.S3_CLIENT) as stubber:
+    # Stubbed responses are returned in order, so the requests must be made one at a time
+    with Stubber(get_files.S3_CLIENT) as stubber, patch('get_files.MAX_CONCURRENT_REQUESTS', 1):
         yield stubber
         stubber.assert_no_pending_responses()
 
@@ -33,7 +44,6 @@ def test_get_download_url(monkeypatch, s3_stubber: Stubber):
     assert get_files.get_download_url('myBucket', 'myKey') == 'https://myBucket.s3.myRegion.amazonaws.com/myKey'
 
     monkeypatch.setenv('DISTRIBUTION_URL', '')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     assert get_files.get_download_url('myBucket', 'myKey') == 'https://myBucket.s3.myRegion.amazonaws.com/myKey'
 
     monkeypatch.setenv('DISTRIBUTION_URL', 'https://foo.com/')
@@ -46,7 +56,6 @@ def test_get_download_url(monkeypatch, s3_stubber: Stubber):
     assert get_files.get_download_url('userBucket', 'myKey') == 'https://userBucket.s3.userRegion.amazonaws.com/myKey'
 
     monkeypatch.delenv('DISTRIBUTION_URL')
-    stub_bucket_head(s3_stubber, 'userBucket', 'userRegion')
     assert get_files.get_download_url('userBucket', 'myKey') == 'https://userBucket.s3.userRegion.amazonaws.com/myKey'
 
 
@@ -58,7 +67,7 @@ def stub_expiration(s3_stubber: Stubber, bucket, key, expires=True):
             'expiry-date="Wed, 01 Jan 2020 00:00:00 UTC", rule-id="MDQxMzRmZTgtNDFlMi00Y2UwLWIyZjEtMTEzYTllNDNjYjJk"'
         )
 
-    s3_stubber.add_response(method='get_object', expected_params=params, service_response=s3_response)
+    s3_stubber.add_response(method='head_object', expected_params=params, service_response=s3_response)
 
 
 def test_get_expiration(s3_stubber: Stubber):
@@ -77,10 +86,91 @@ def stub_get_object_tagging(s3_stubber: Stubber, bucket, key, file_type):
     s3_stubber.add_response(method='get_object_tagging', expected_params=params, service_response=s3_response)
 
 
-def test_get_file_type(s3_stubber: Stubber):
+def test_get_object_tags(s3_stubber: Stubber):
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myKey', file_type='product')
-    response = get_files.get_object_file_type('myBucket', 'myKey')
-    assert response == 'product'
+    response = get_files.get_object_tags('myBucket', 'myKey')
+    assert response == {'file_type': 'product'}
+
+
+def stub_lifecycle_rules(s3_stubber: Stubber, bucket, rules=None, error_code=None):
+    params = {'Bucket': bucket}
+    if error_code is not None:
+        s3_stubber.add_client_error(
+            method='get_bucket_lifecycle_configuration', service_error_code=error_code, expected_params=params
+        )
+    else:
+        s3_stubber.add_response(
+            method='get_bucket_lifecycle_configuration', expected_params=params, service_response={'Rules': rules}
+        )
+
+
+def test_get_lifecycle_rules(s3_stubber: Stubber):
+    rules = [{'Status': 'Enabled', 'Filter': {'Prefix': 'foo/'}, 'Expiration': {'Days': 14}}]
+    stub_lifecycle_rules(s3_stubber, 'myBucket', rules)
+    stub_lifecycle_rules(s3_stubber, 'userBucket', error_code='AccessDenied')
+    stub_lifecycle_rules(s3_stubber, 'otherBucket', error_code='NoSuchLifecycleConfiguration')
+
+    assert get_files.get_lifecycle_rules('myBucket') == rules
+    assert get_files.get_lifecycle_rules('userBucket') is None
+    assert get_files.get_lifecycle_rules('otherBucket') == []
+
+    # Cached until the cache expires
+    assert get_files.get_lifecycle_rules('myBucket') == rules
+    with patch('get_files.LIFECYCLE_CACHE_SECONDS', 0):
+        stub_lifecycle_rules(s3_stubber, 'myBucket', [])
+        assert get_files.get_lifecycle_rules('myBucket') == []
+
+
+def test_get_lifecycle_expiration_time():
+    s3_object = {'Key': 'myJobId/myProduct.zip', 'Size': 50, 'LastModified': datetime(2020, 1, 15, 10, 30, tzinfo=UTC)}
+    tags = {'file_type': 'product'}
+
+    def rule(lifecycle_filter, expiration=None, status='Enabled'):
+        return {'Status': status, 'Filter': lifecycle_filter, 'Expiration': expiration or {'Days': 3}}
+
+    assert get_files.get_lifecycle_expiration_time([], s3_object, tags) == '2120-10-21T00:00:00+00:00'
+
+    # Rounded up to the next midnight UTC
+    product_rule = rule({'Tag': {'Key': 'file_type', 'Value': 'product'}})
+    assert get_files.get_lifecycle_expiration_time([product_rule], s3_object, tags) == '2020-01-19T00:00:00+00:00'
+
+    log_rule = rule({'Tag': {'Key': 'file_type', 'Value': 'log'}}, {'Days': 1})
+    assert get_files.get_lifecycle_expiration_time([log_rule], s3_object, tags) == '2120-10-21T00:00:00+00:00'
+
+    # The earliest expiration of the matching rules
+    rules = [
+        product_rule,
+        log_rule,
+        rule({'Prefix': 'myJobId/'}, {'Days': 2}),
+        rule({'Prefix': 'myJobId/'}, {'Days': 1}, status='Disabled'),
+        rule({}, {'ExpiredObjectDeleteMarker': True}),
+    ]
+    assert get_files.get_lifecycle_expiration_time(rules, s3_object, tags) == '2020-01-18T00:00:00+00:00'
+
+    date_rule = rule({}, {'Date': datetime(2020, 2, 1, tzinfo=UTC)})
+    assert get_files.get_lifecycle_expiration_time([date_rule], s3_object, tags) == '2020-02-01T00:00:00+00:00'
+
+    legacy_rule = {'Status': 'Enabled', 'Prefix': 'otherJobId/', 'Expiration': {'Days': 1}}
+    assert get_files.get_lifecycle_expiration_time([legacy_rule], s3_object, tags) == '2120-10-21T00:00:00+00:00'
+
+    and_rule = rule(
+        {
+            'And': {
+                'Prefix': 'myJobId/',
+                'Tags': [{'Key': 'file_type', 'Value': 'product'}],
+                'ObjectSizeGreaterThan': 10,
+                'ObjectSizeLessThan': 100,
+            }
+        }
+    )
+    assert get_files.get_lifecycle_expiration_time([and_rule], s3_object, tags) == '2020-01-19T00:00:00+00:00'
+    assert get_files.get_lifecycle_expiration_time([and_rule], {**s3_object, 'Size': 100}, tags) == (
+        '2120-10-21T00:00:00+00:00'
+    )
+
+    # Filters that can't be evaluated from the listing and tags
+    unknown_rule = rule({'ObjectTagsAreUnknown': True})
+    assert get_files.get_lifecycle_expiration_time([product_rule, unknown_rule], s3_object, tags) is None
 
 
 def test_visible_product():
@@ -97,13 +187,21 @@ def test_visible_product():
     assert get_files.visible_product(Path('myFile.nc'))
 
 
+LAST_MODIFIED = datetime(2019, 12, 17, 12, tzinfo=UTC)
+
+PRODUCT_LIFECYCLE_RULES = [
+    {'Status': 'Enabled', 'Filter': {'Tag': {'Key': 'file_type', 'Value': 'product'}}, 'Expiration': {'Days': 14}},
+    {'Status': 'Enabled', 'Filter': {'Tag': {'Key': 'file_type', 'Value': 'log'}}, 'Expiration': {'Days': 14}},
+]
+
+
 def stub_list_files(s3_stubber: Stubber, job_id, bucket, contents):
     params = {
         'Bucket': bucket,
         'Prefix': job_id,
     }
     s3_response = {
-        'Contents': contents,
+        'Contents': [{'LastModified': LAST_MODIFIED, **item} for item in contents],
     }
     s3_stubber.add_response('list_objects_v2', expected_params=params, service_response=s3_response)
 
@@ -132,17 +230,13 @@ def test_get_files_zipped_product(s3_stubber: Stubber):
         },
     ]
     stub_list_files(s3_stubber, 'myJobId', 'myBucket', files)
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myProduct.zip', 'product')
-    stub_expiration(s3_stubber, 'myBucket', 'myJobId/myProduct.zip')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myProduct.tif', 'product')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myThumbnail.png', 'amp_thumbnail')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myBrowse.png', 'amp_browse')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myBrowse_rgb.png', 'rgb_browse')
+    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
+    stub_lifecycle_rules(s3_stubber, 'myBucket', PRODUCT_LIFECYCLE_RULES)
 
     event = {'job_id': 'myJobId', 'bucket': 'myBucket', 'bucket_prefix': 'myJobId'}
     with patch('dynamo.jobs.get_job') as mock_get_job:
@@ -194,13 +288,12 @@ def test_get_files_netcdf_product(s3_stubber: Stubber):
         },
     ]
     stub_list_files(s3_stubber, 'myJobId', 'myBucket', files)
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myProduct.nc', 'product')
-    stub_expiration(s3_stubber, 'myBucket', 'myJobId/myProduct.nc')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myThumbnail.png', 'amp_thumbnail')
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myBrowse.png', 'amp_browse')
+    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
+    stub_lifecycle_rules(s3_stubber, 'myBucket', error_code='AccessDenied')
+    stub_expiration(s3_stubber, 'myBucket', 'myJobId/myProduct.nc')
 
     event = {'job_id': 'myJobId', 'bucket': 'myBucket', 'bucket_prefix': 'myJobId'}
     with patch('dynamo.jobs.get_job') as mock_get_job:
@@ -243,9 +336,9 @@ def test_get_files_failed_job(s3_stubber: Stubber):
         },
     ]
     stub_list_files(s3_stubber, 'myJobId', 'myBucket', files)
-    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
     stub_get_object_tagging(s3_stubber, 'myBucket', 'myJobId/myJobId.log', 'log')
-    stub_expiration(s3_stubber, 'myBucket', 'myJobId/myJobId.log')
+    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
+    stub_lifecycle_rules(s3_stubber, 'myBucket', PRODUCT_LIFECYCLE_RULES)
 
     event = {'job_id': 'myJobId', 'bucket': 'myBucket', 'bucket_prefix': 'myJobId'}
     with patch('dynamo.jobs.get_job') as mock_get_job:
@@ -266,3 +359,51 @@ def test_get_files_failed_job(s3_stubber: Stubber):
                     'logs': ['https://myBucket.s3.myRegion.amazonaws.com/myJobId/myJobId.log'],
                 }
             )
+
+
+def test_get_bucket_region(s3_stubber: Stubber):
+    stub_bucket_head(s3_stubber, 'myBucket', 'myRegion')
+    stub_bucket_head(s3_stubber, 'userBucket', 'userRegion')
+
+    assert get_files.get_bucket_region('myBucket') == 'myRegion'
+    assert get_files.get_bucket_region('userBucket') == 'userRegion'
+    assert get_files.get_bucket_region('myBucket') == 'myRegion'
+
+
+@pytest.mark.benchmark
+@mock_aws
+def test_get_files_many_objects():
+    s3 = boto3.client('s3', region_name='us-west-2')
+    s3.create_bucket(Bucket='myBucket', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+    keys = [f'myJobId/myProduct{i:04d}.zip' for i in range(2000)]
+    for key in keys:
+        s3.put_object(Bucket='myBucket', Key=key, Body=b'', Tagging='file_type=product')
+    s3.put_object(Bucket='myBucket', Key='myJobId/myJobId.log', Body=b'', Tagging='file_type=log')
+    s3.put_object(Bucket='myBucket', Key='otherJobId/myProduct.zip', Body=b'', Tagging='file_type=product')
+    s3.put_bucket_lifecycle_configuration(Bucket='myBucket', LifecycleConfiguration={'Rules': PRODUCT_LIFECYCLE_RULES})
+    last_modified = s3.head_object(Bucket='myBucket', Key=keys[0])['LastModified']
+
+    requests: Counter = Counter()
+    get_files.S3_CLIENT.meta.events.register('before-call.s3', lambda model, **kwargs: requests.update([model.name]))
+    event = {'job_id': 'myJobId', 'bucket': 'myBucket', 'bucket_prefix': 'myJobId'}
+    try:
+        with patch('dynamo.jobs.update_job') as mock_update_job:
+            get_files.lambda_handler(event, None)
+    finally:
+        get_files.S3_CLIENT.meta.events.unregister('before-call.s3')
+
+    job = mock_update_job.call_args.args[0]
+    assert [file['s3']['key'] for file in job['files']] == keys
+    assert job['files'][0]['url'] == 'https://myBucket.s3.us-west-2.amazonaws.com/myJobId/myProduct0000.zip'
+    assert job['logs'] == ['https://myBucket.s3.us-west-2.amazonaws.com/myJobId/myJobId.log']
+
+    expiration_date = (last_modified + timedelta(days=15)).date()
+    assert job['expiration_time'] == f'{expiration_date.isoformat()}T00:00:00+00:00'
+
+    # One request per listing page, one tagging request per object, and one each for the region and lifecycle rules
+    assert requests == {
+        'ListObjectsV2': 3,
+        'GetObjectTagging': 2001,
+        'HeadBucket': 1,
+        'GetBucketLifecycleConfiguration': 1,
+    }
@@ -13,12 +13,12 @@ def test_lambda_handler(mock_get_job: MagicMock, mock_update_job: MagicMock):
         'detail-type': 'Batch Job State Change',
         'detail': {'status': 'RUNNING', 'jobName': 'fooJob'},
     }
-    mock_get_job.return_value = {'job_id': 'fooJob', 'status_code': 'PENDING'}
+    mock_get_job.return_value = {'job_id': 'fooJob', 'user_id': 'fooUser', 'status_code': 'PENDING'}
 
     handle_batch_event.lambda_handler(event, None)
 
     mock_get_job.assert_called_once_with('fooJob')
-    mock_update_job.assert_called_once_with({'job_id': 'fooJob', 'status_code': 'RUNNING'})
+    mock_update_job.assert_called_once_with({'job_id': 'fooJob', 'user_id': 'fooUser', 'status_code': 'RUNNING'})
 
 
 @patch('dynamo.jobs.update_job')
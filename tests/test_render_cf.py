@@ -1,3 +1,4 @@
+import json
 from pathlib import Path
 
 import pytest
@@ -112,6 +113,35 @@ def test_get_compute_environments(tmp_path):
         render_cf.get_compute_environments_for_deployment(job_types, compute_env_file)
 
 
+def test_render_openapi_spec(tmp_path):
+    spec = {
+        'openapi': '3.0.4',
+        'info': {'title': 'test', 'version': '1.0.0'},
+        'paths': {
+            '/jobs': {
+                'get': {
+                    'responses': {
+                        '200': {
+                            'description': 'jobs',
+                            'content': {'application/json': {'schema': {'$ref': './schemas.yml#/job'}}},
+                        }
+                    }
+                }
+            }
+        },
+    }
+    (tmp_path / 'openapi-spec.yml').write_text(yaml.safe_dump(spec))
+    (tmp_path / 'schemas.yml').write_text(yaml.safe_dump({'job': {'type': 'object'}}))
+
+    render_cf.render_openapi_spec(tmp_path)
+
+    rendered = (tmp_path / 'openapi-spec.json').read_text()
+    assert '\n' not in rendered
+    assert json.loads(rendered)['paths']['/jobs']['get']['responses']['200']['content'] == {
+        'application/json': {'schema': {'type': 'object'}}
+    }
+
+
 def test_validate_job_spec():
     job_type = 'FOO'
     job_spec = {
@@ -0,0 +1,22 @@
+import boto3
+from moto import mock_aws
+
+import s3_objects
+
+
+def test_get_file_type_tagging():
+    assert s3_objects.get_file_type_tagging('product') == 'file_type=product'
+    assert s3_objects.get_file_type_tagging('rgb browse&more') == 'file_type=rgb+browse%26more'
+
+
+@mock_aws
+def test_put_object_with_file_type():
+    s3 = boto3.client('s3', region_name='us-west-2')
+    s3.create_bucket(Bucket='myBucket', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+
+    s3_objects.put_object_with_file_type(s3, 'myBucket', 'myKey', b'myContent', 'log', ContentType='text/plain')
+
+    assert s3.get_object_tagging(Bucket='myBucket', Key='myKey')['TagSet'] == [{'Key': 'file_type', 'Value': 'log'}]
+    s3_object = s3.get_object(Bucket='myBucket', Key='myKey')
+    assert s3_object['Body'].read() == b'myContent'
+    assert s3_object['ContentType'] == 'text/plain'
@@ -59,6 +59,7 @@ def test_aria_s1_gunw_exists(tables):
         {
             'job_id': 'test-job',
             'status_code': 'SUCCEEDED',
+            'user_id_status_code': 'test-user#SUCCEEDED',
             'processing_times': [Decimal(0)],
             'credit_cost': Decimal(0),
             'browse_images': ['test-browse.png'],
@@ -128,6 +129,7 @@ def test_aria_s1_gunw_exists_infinite_credits(tables):
         {
             'job_id': 'test-job',
             'status_code': 'SUCCEEDED',
+            'user_id_status_code': 'test-user#SUCCEEDED',
             'processing_times': [Decimal(0)],
             'credit_cost': Decimal(0),
             'browse_images': ['test-browse.png'],
@@ -1,7 +1,14 @@
 import json
 import os
+import threading
+import time
+from decimal import Decimal
 from unittest.mock import call, patch
 
+import boto3
+import botocore.exceptions
+
+import dynamo
 import start_execution
 
 
@@ -160,38 +167,296 @@ def test_submit_jobs():
         patch.dict(os.environ, {'STEP_FUNCTION_ARN': 'test-state-machine-arn'}, clear=True),
         patch('start_execution.BATCH_PARAMS_BY_JOB_TYPE', batch_params_by_job_type),
     ):
-        start_execution.submit_jobs(jobs)
-
-        assert mock_start_execution.mock_calls == [
-            call(
-                stateMachineArn='test-state-machine-arn',
-                input=expected_input_job0,
-                name='job0',
-            ),
-            call(
-                stateMachineArn='test-state-machine-arn',
-                input=expected_input_job1,
-                name='job1',
-            ),
-            call(
-                stateMachineArn='test-state-machine-arn',
-                input=expected_input_job2,
-                name='job2',
-            ),
-        ]
+        assert start_execution.submit_jobs(jobs) == {'submitted': 3, 'failed': 0, 'throttled': 0, 'unsubmitted': 0}
+
+        assert mock_start_execution.call_count == 3
+        mock_start_execution.assert_has_calls(
+            [
+                call(
+                    stateMachineArn='test-state-machine-arn',
+                    input=expected_input_job0,
+                    name='job0',
+                ),
+                call(
+                    stateMachineArn='test-state-machine-arn',
+                    input=expected_input_job1,
+                    name='job1',
+                ),
+                call(
+                    stateMachineArn='test-state-machine-arn',
+                    input=expected_input_job2,
+                    name='job2',
+                ),
+            ],
+            any_order=True,
+        )
+
+
+def _client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': ''}}, 'StartExecution')
+
+
+def test_submit_jobs_isolates_failures():
+    jobs = [{'job_id': f'job{i}', 'job_type': 'JOB', 'job_parameters': {}} for i in range(10)]
+
+    def start_execution_side_effect(stateMachineArn, input, name):
+        if name == 'job3':
+            raise _client_error('ExecutionAlreadyExists')
+        if name == 'job7':
+            raise ValueError('unexpected')
+
+    with (
+        patch('start_execution.STEP_FUNCTION.start_execution', side_effect=start_execution_side_effect) as mock_start,
+        patch.dict(os.environ, {'STEP_FUNCTION_ARN': 'test-state-machine-arn'}, clear=True),
+        patch('start_execution.BATCH_PARAMS_BY_JOB_TYPE', {'JOB': []}),
+        patch('dynamo.jobs.release_jobs') as mock_release_jobs,
+        patch('start_execution.refund_dispatch_tokens') as mock_refund_dispatch_tokens,
+    ):
+        assert start_execution.submit_jobs(jobs) == {'submitted': 8, 'failed': 2, 'throttled': 0, 'unsubmitted': 0}
+        assert sorted(c.kwargs['name'] for c in mock_start.mock_calls) == [f'job{i}' for i in range(10)]
+        mock_release_jobs.assert_called_once_with([jobs[3], jobs[7]])
+        mock_refund_dispatch_tokens.assert_called_once_with([jobs[3], jobs[7]])
+
+
+def test_submit_jobs_adapts_to_throttling():
+    jobs = [{'job_id': f'job{i}', 'job_type': 'JOB', 'job_parameters': {}} for i in range(100)]
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight_by_call: list[int] = []
+    throttled_calls = 0
+
+    # Step Functions throttles this mock whenever more than 6 requests are in flight
+    def start_execution_side_effect(stateMachineArn, input, name):
+        nonlocal in_flight, throttled_calls
+        with lock:
+            in_flight += 1
+            max_in_flight_by_call.append(in_flight)
+            throttled = in_flight > 6
+            throttled_calls += throttled
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        if throttled:
+            raise _client_error('ThrottlingException')
+
+    with (
+        patch('start_execution.STEP_FUNCTION.start_execution', side_effect=start_execution_side_effect),
+        patch.dict(os.environ, {'STEP_FUNCTION_ARN': 'test-state-machine-arn'}, clear=True),
+        patch('start_execution.BATCH_PARAMS_BY_JOB_TYPE', {'JOB': []}),
+        patch('start_execution.THROTTLING_BACKOFF_SECONDS', 0),
+    ):
+        counts = start_execution.submit_jobs(jobs)
+
+    assert counts['submitted'] == 100
+    assert counts['failed'] == counts['unsubmitted'] == 0
+    assert counts['throttled'] == throttled_calls > 0
+    assert max(max_in_flight_by_call) <= start_execution.MAX_CONCURRENCY
+
+
+def test_submit_jobs_time_budget():
+    jobs = [{'job_id': f'job{i}', 'job_type': 'JOB', 'job_parameters': {}} for i in range(10)]
+    with (
+        patch('start_execution.STEP_FUNCTION.start_execution') as mock_start_execution,
+        patch.dict(os.environ, {'STEP_FUNCTION_ARN': 'test-state-machine-arn'}, clear=True),
+        patch('dynamo.jobs.release_jobs') as mock_release_jobs,
+        patch('start_execution.refund_dispatch_tokens') as mock_refund_dispatch_tokens,
+    ):
+        counts = start_execution.submit_jobs(jobs, time_budget_seconds=0)
+        assert counts == {'submitted': 0, 'failed': 0, 'throttled': 0, 'unsubmitted': 10}
+        mock_start_execution.assert_not_called()
+        mock_release_jobs.assert_called_once_with(jobs)
+        mock_refund_dispatch_tokens.assert_called_once_with(jobs)
+
+
+def test_log_metrics(capsys):
+    start_execution._log_metrics({'submitted': 10, 'failed': 1, 'throttled': 2, 'unsubmitted': 3}, 2.0)
+    metrics = json.loads(capsys.readouterr().out)
+    assert metrics['JobsSubmitted'] == 10
+    assert metrics['JobsFailed'] == 1
+    assert metrics['JobsThrottled'] == 2
+    assert metrics['JobsUnsubmitted'] == 3
+    assert metrics['SubmissionThroughput'] == 5.0
+    assert [metric['Name'] for metric in metrics['_aws']['CloudWatchMetrics'][0]['Metrics']] == [
+        'JobsSubmitted',
+        'JobsFailed',
+        'JobsThrottled',
+        'JobsUnsubmitted',
+        'SubmissionThroughput',
+    ]
 
 
 def test_lambda_handler():
     with (
+        patch('dynamo.jobs.release_expired_claims') as mock_release_expired_claims,
         patch('dynamo.jobs.get_jobs_waiting_for_execution') as mock_get_jobs_waiting_for_execution,
         patch('dynamo.util.convert_decimals_to_numbers') as mock_convert_decimals_to_numbers,
+        patch('start_execution.dispatch_jobs') as mock_dispatch_jobs,
         patch('start_execution.submit_jobs') as mock_submit_jobs,
     ):
+        mock_release_expired_claims.return_value = 0
         mock_get_jobs_waiting_for_execution.return_value = 'mock_jobs'
         mock_convert_decimals_to_numbers.return_value = 'converted_jobs'
+        mock_dispatch_jobs.return_value = ('claimed_jobs', {})
 
         start_execution.lambda_handler({}, None)
 
+        mock_release_expired_claims.assert_called_once_with()
         mock_get_jobs_waiting_for_execution.assert_called_once_with(limit=500)
         mock_convert_decimals_to_numbers.assert_called_once_with('mock_jobs')
-        mock_submit_jobs.assert_called_once_with('converted_jobs')
+        mock_dispatch_jobs.assert_called_once_with('converted_jobs')
+        mock_submit_jobs.assert_called_once_with('claimed_jobs')
+
+
+def test_get_available_tokens():
+    limit = {'_dispatch_jobs_per_minute': Decimal(60)}
+    assert start_execution.get_available_tokens(limit, now=1000.0) == 60
+
+    limit = {'_dispatch_jobs_per_minute': Decimal(60), '_dispatch_burst': Decimal(100)}
+    assert start_execution.get_available_tokens(limit, now=1000.0) == 100
+
+    limit['_dispatch_tokens'] = Decimal('2.5')
+    limit['_dispatch_tokens_time'] = Decimal(990)
+    assert start_execution.get_available_tokens(limit, now=1000.0) == 12.5
+    assert start_execution.get_available_tokens(limit, now=980.0) == 2.5
+    assert start_execution.get_available_tokens(limit, now=2000.0) == 100
+
+
+def test_select_jobs():
+    jobs = (
+        [{'job_id': f'a{i}', 'user_id': 'a'} for i in range(6)]
+        + [{'job_id': f'b{i}', 'user_id': 'b'} for i in range(2)]
+        + [{'job_id': f'c{i}', 'user_id': 'c'} for i in range(3)]
+    )
+
+    def job_ids(selected_jobs):
+        return [job['job_id'] for job in selected_jobs]
+
+    assert job_ids(start_execution.select_jobs(jobs, {}, limit=100)) == [
+        'a0', 'b0', 'c0', 'a1', 'b1', 'c1', 'a2', 'c2', 'a3', 'a4', 'a5',
+    ]  # fmt: skip
+    assert job_ids(start_execution.select_jobs(jobs, {}, limit=5)) == ['a0', 'b0', 'c0', 'a1', 'b1']
+    assert job_ids(start_execution.select_jobs(jobs, {'a': 2, 'c': 0}, limit=100)) == ['a0', 'b0', 'a1', 'b1']
+    assert start_execution.select_jobs([], {}, limit=100) == []
+    assert start_execution.select_jobs(jobs, {}, limit=0) == []
+
+
+def put_pending_jobs(table, jobs):
+    for job in jobs:
+        job.update({'status_code': 'PENDING', 'execution_started': False, 'priority': 0})
+        job['request_time'] = '2000-01-01T00:00:00+00:00'
+        table.put_item(Item=dynamo.jobs._add_index_keys(job))
+
+
+def test_dispatch_jobs(tables):
+    tables.users_table.put_item(Item={'user_id': 'limited', '_dispatch_jobs_per_minute': 3})
+    tables.users_table.put_item(Item={'user_id': 'unlimited', 'remaining_credits': 10})
+    jobs = [{'job_id': f'limited{i}', 'user_id': 'limited'} for i in range(10)]
+    jobs += [{'job_id': f'unlimited{i}', 'user_id': 'unlimited'} for i in range(5)]
+    jobs += [{'job_id': 'new0', 'user_id': 'new'}]
+    put_pending_jobs(tables.jobs_table, jobs)
+
+    claimed_jobs, counts = start_execution.dispatch_jobs(jobs, now=1000.0)
+    assert [job['job_id'] for job in claimed_jobs] == [
+        'limited0', 'unlimited0', 'new0', 'limited1', 'unlimited1', 'limited2', 'unlimited2', 'unlimited3', 'unlimited4',
+    ]  # fmt: skip
+    assert counts == {'limited': 3, 'unlimited': 5, 'new': 1}
+    user = tables.users_table.get_item(Key={'user_id': 'limited'})['Item']
+    assert user['_dispatch_tokens'] == 0
+    assert user['_dispatch_tokens_time'] == 1000
+
+    # 20 seconds refills one token
+    claimed_jobs, counts = start_execution.dispatch_jobs(jobs[3:10], now=1020.0)
+    assert [job['job_id'] for job in claimed_jobs] == ['limited3']
+    assert counts == {'limited': 1}
+
+    claimed_jobs, counts = start_execution.dispatch_jobs(jobs[4:10], now=1020.0)
+    assert claimed_jobs == []
+    assert counts == {}
+
+
+def test_dispatch_jobs_spends_tokens_for_claimed_jobs_only(tables):
+    tables.users_table.put_item(Item={'user_id': 'limited', '_dispatch_jobs_per_minute': 60})
+    jobs = [{'job_id': f'limited{i}', 'user_id': 'limited'} for i in range(4)]
+    put_pending_jobs(tables.jobs_table, jobs)
+    # Claimed by an overlapping invocation
+    dynamo.jobs.claim_jobs(jobs[:3])
+
+    claimed_jobs, counts = start_execution.dispatch_jobs(jobs, now=1000.0)
+
+    assert claimed_jobs == [jobs[3]]
+    assert counts == {'limited': 1}
+    assert tables.users_table.get_item(Key={'user_id': 'limited'})['Item']['_dispatch_tokens'] == 59
+
+
+def test_dispatch_jobs_claim_conflict(tables):
+    tables.users_table.put_item(Item={'user_id': 'limited', '_dispatch_jobs_per_minute': 60})
+    jobs = [{'job_id': 'limited0', 'user_id': 'limited'}, {'job_id': 'other0', 'user_id': 'other'}]
+    put_pending_jobs(tables.jobs_table, jobs)
+
+    with patch('dynamo.user.update_dispatch_tokens', return_value=False) as mock_update_dispatch_tokens:
+        claimed_jobs, counts = start_execution.dispatch_jobs(jobs, limit=10, now=1000.0)
+
+    mock_update_dispatch_tokens.assert_called_once_with(
+        'limited', tokens=Decimal('59.000'), tokens_time=Decimal('1000.000'), previous_tokens_time=None
+    )
+    assert claimed_jobs == [jobs[1]]
+    assert counts == {'other': 1}
+    # The job whose tokens could not be spent is released for the next invocation
+    assert 'CLAIMED#' not in tables.jobs_table.get_item(Key={'job_id': 'limited0'})['Item']['dispatch_priority']
+
+
+def test_refund_dispatch_tokens(tables):
+    tables.users_table.put_item(
+        Item={'user_id': 'limited', '_dispatch_jobs_per_minute': 60, '_dispatch_tokens': Decimal('1.5')}
+    )
+    tables.users_table.put_item(Item={'user_id': 'unlimited', 'remaining_credits': 10})
+    jobs = [{'job_id': 'limited0', 'user_id': 'limited'}, {'job_id': 'limited1', 'user_id': 'limited'}]
+    jobs += [{'job_id': 'unlimited0', 'user_id': 'unlimited'}]
+
+    start_execution.refund_dispatch_tokens(jobs)
+
+    assert tables.users_table.get_item(Key={'user_id': 'limited'})['Item']['_dispatch_tokens'] == Decimal('3.5')
+    assert tables.users_table.get_item(Key={'user_id': 'unlimited'})['Item'] == {
+        'user_id': 'unlimited',
+        'remaining_credits': 10,
+    }
+
+
+def get_stream_records(table):
+    """Read every record from a mocked table's stream, in the shape of a DynamoDB stream Lambda event."""
+    streams = boto3.client('dynamodbstreams')
+    shards = streams.describe_stream(StreamArn=table.latest_stream_arn)['StreamDescription']['Shards']
+    records = []
+    for shard in shards:
+        shard_iterator = streams.get_shard_iterator(
+            StreamArn=table.latest_stream_arn, ShardId=shard['ShardId'], ShardIteratorType='TRIM_HORIZON'
+        )['ShardIterator']
+        records.extend(streams.get_records(ShardIterator=shard_iterator)['Records'])
+    return records
+
+
+def test_lambda_handler_stream(tables):
+    items = [
+        {'job_id': 'job0', 'user_id': 'user1', 'status_code': 'PENDING', 'execution_started': False, 'priority': 1},
+        {'job_id': 'job1', 'user_id': 'user1', 'status_code': 'PENDING', 'execution_started': False, 'priority': 2},
+        {'job_id': 'job2', 'user_id': 'user1', 'status_code': 'SUCCEEDED', 'execution_started': True, 'priority': 3},
+    ]
+    for item in items:
+        item['request_time'] = '2000-01-01T00:00:00+00:00'
+        tables.jobs_table.put_item(Item=dynamo.jobs._add_index_keys(item))
+    dynamo.jobs.update_job({'job_id': 'job0', 'execution_started': True})
+
+    event = {'Records': get_stream_records(tables.jobs_table)}
+    assert [record['eventName'] for record in event['Records']] == ['INSERT', 'INSERT', 'INSERT', 'MODIFY']
+
+    with (
+        patch('dynamo.jobs.release_expired_claims') as mock_release_expired_claims,
+        patch('dynamo.jobs.get_jobs_waiting_for_execution') as mock_get_jobs_waiting_for_execution,
+        patch('start_execution.submit_jobs') as mock_submit_jobs,
+    ):
+        start_execution.lambda_handler(event, None)
+
+        mock_release_expired_claims.assert_not_called()
+        mock_get_jobs_waiting_for_execution.assert_not_called()
+        # The stream still has job0 as newly submitted, but its execution has since started, so it cannot be claimed
+        mock_submit_jobs.assert_called_once_with(items[1:2])
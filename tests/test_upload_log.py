@@ -1,5 +1,7 @@
-import os
-from unittest.mock import MagicMock, patch
+import hashlib
+import json
+import threading
+from unittest.mock import patch
 
 import pytest
 from botocore.stub import Stubber
@@ -21,28 +23,40 @@ def s3_stubber():
         stubber.assert_no_pending_responses()
 
 
-def test_get_log_stream():
-    result: dict = {
-        'Container': {
-            'LogStreamName': 'mySucceededLogStream',
-        },
-    }
-    assert upload_log.get_log_stream(result) == 'mySucceededLogStream'
+def test_get_log_streams():
+    result: dict = {'Container': {'LogStreamName': 'mySucceededLogStream'}}
+    assert upload_log.get_log_streams(result) == [(None, 'mySucceededLogStream')]
 
     result = {
         'Error': 'States.TaskFailed',
         'Cause': '{"Container": {"LogStreamName": "myFailedLogStream"}}',
     }
-    assert upload_log.get_log_stream(result) == 'myFailedLogStream'
+    assert upload_log.get_log_streams(result) == [(None, 'myFailedLogStream')]
+
+    result = {'Error': 'States.TaskFailed', 'Cause': '{"Container": {}}'}
+    assert upload_log.get_log_streams(result) == [(None, None)]
 
     result = {
         'Error': 'States.TaskFailed',
-        'Cause': '{"Container": {}}',
+        'Cause': json.dumps(
+            {
+                'Container': {'LogStreamName': 'myStream2'},
+                'Attempts': [
+                    {'Container': {'LogStreamName': 'myStream1'}},
+                    {'Container': {'Reason': 'CannotPullContainerError'}},
+                    {'Container': {'LogStreamName': 'myStream2'}},
+                ],
+            }
+        ),
     }
-    assert upload_log.get_log_stream(result) is None
+    assert upload_log.get_log_streams(result) == [
+        ('attempt 1 of 3', 'myStream1'),
+        ('attempt 2 of 3', None),
+        ('attempt 3 of 3', 'myStream2'),
+    ]
 
 
-def test_get_log_content(cloudwatch_stubber):
+def test_read_log_streams_one_stream(cloudwatch_stubber):
     expected_params = {'logGroupName': 'myLogGroup', 'logStreamName': 'myLogStream', 'startFromHead': True}
     service_response = {
         'events': [
@@ -66,7 +80,98 @@ def test_get_log_content(cloudwatch_stubber):
         method='get_log_events', expected_params=expected_params, service_response=service_response
     )
 
-    assert upload_log.get_log_content('myLogGroup', 'myLogStream') == 'foo\nbar'
+    with upload_log.read_log_streams('myLogGroup', [(None, 'myLogStream')]) as (messages, missing):
+        assert list(messages) == ['foo', 'bar']
+        assert missing == set()
+
+
+def _missing_log_stream_error():
+    return upload_log.CLOUDWATCH.exceptions.ResourceNotFoundException(
+        {'Error': {'Message': 'The specified log stream does not exist.'}}, 'GetLogEvents'
+    )
+
+
+def test_read_log_streams():
+    lock = threading.Lock()
+    requests: list[tuple[str, int]] = []
+
+    # Each stream has 10 pages of 2 events, and the events of the last stream fall between those of the first
+    def get_log_events(logStreamName, nextToken=None, **kwargs):  # noqa: N803
+        page = int(nextToken or 0)
+        with lock:
+            requests.append((logStreamName, page))
+        if logStreamName == 'missing':
+            raise _missing_log_stream_error()
+        if page == 10:
+            return {'events': [], 'nextForwardToken': nextToken}
+        offset = 5 if logStreamName == 'last' else 0
+        events = [
+            {'message': f'{logStreamName} {page}.{i}', 'timestamp': page * 20 + i * 10 + offset} for i in range(2)
+        ]
+        return {'events': events, 'nextForwardToken': str(page + 1)}
+
+    log_streams = [('attempt 1', 'first'), ('attempt 2', 'missing'), ('attempt 3', 'last')]
+    with patch('upload_log.CLOUDWATCH.get_log_events', get_log_events):
+        with upload_log.read_log_streams('myLogGroup', log_streams) as (messages, missing):
+            assert missing == {'missing'}
+
+            # Every stream is read before the first message is consumed, but only a few pages ahead
+            with lock:
+                assert {log_stream for log_stream, _ in requests} == {'first', 'missing', 'last'}
+                assert max(page for _, page in requests) <= upload_log.LOG_PAGES_READ_AHEAD + 1
+
+            assert list(messages) == [
+                f'[attempt {attempt}] {log_stream} {page}.{i}'
+                for page in range(10)
+                for i in range(2)
+                for attempt, log_stream in ((1, 'first'), (3, 'last'))
+            ]
+
+
+def test_read_log_streams_missing_streams():
+    def get_log_events(**kwargs):
+        raise _missing_log_stream_error()
+
+    with patch('upload_log.CLOUDWATCH.get_log_events', get_log_events):
+        with upload_log.read_log_streams('myLogGroup', [('a', 'missing1'), ('b', 'missing2')]) as (messages, missing):
+            assert list(messages) == []
+            assert missing == {'missing1', 'missing2'}
+
+
+def test_read_log_streams_error():
+    def get_log_events(logStreamName, nextToken=None, **kwargs):  # noqa: N803
+        if logStreamName == 'broken' and nextToken == '3':
+            raise RuntimeError('failed to read log')
+        return {
+            'events': [{'message': f'{logStreamName} {nextToken}', 'timestamp': int(nextToken or 0)}],
+            'nextForwardToken': str(int(nextToken or 0) + 1),
+        }
+
+    with patch('upload_log.CLOUDWATCH.get_log_events', get_log_events):
+        with pytest.raises(RuntimeError, match='failed to read log'):
+            with upload_log.read_log_streams('myLogGroup', [('attempt 1', 'broken'), ('attempt 2', 'endless')]) as (
+                messages,
+                _,
+            ):
+                list(messages)
+
+
+def test_read_log_streams_stops_readers():
+    def get_log_events(logStreamName, nextToken=None, **kwargs):  # noqa: N803
+        return {
+            'events': [{'message': f'{logStreamName} {nextToken}', 'timestamp': int(nextToken or 0)}],
+            'nextForwardToken': str(int(nextToken or 0) + 1),
+        }
+
+    with patch('upload_log.CLOUDWATCH.get_log_events', get_log_events):
+        with pytest.raises(RuntimeError, match='upload failed'):
+            with upload_log.read_log_streams('myLogGroup', [('attempt 1', 'endless1'), ('attempt 2', 'endless2')]):
+                reader_threads = [
+                    thread for thread in threading.enumerate() if thread is not threading.current_thread()
+                ]
+                raise RuntimeError('upload failed')
+
+    assert not any(thread.is_alive() for thread in reader_threads)
 
 
 def test_get_log_content_from_failed_attempts():
@@ -91,101 +196,225 @@ def test_get_log_content_from_failed_attempts_no_attempts():
 
 def test_upload_log_to_s3(s3_stubber):
     expected_params = {
-        'Body': 'myContent',
+        'Body': b'myContent',
         'Bucket': 'myBucket',
         'Key': 'myJobId/myJobId.log',
         'ContentType': 'text/plain',
-    }
-    tag_params = {
-        'Bucket': 'myBucket',
-        'Key': 'myJobId/myJobId.log',
-        'Tagging': {'TagSet': [{'Key': 'file_type', 'Value': 'log'}]},
+        'Tagging': 'file_type=log',
     }
     s3_stubber.add_response(method='put_object', expected_params=expected_params, service_response={})
-    s3_stubber.add_response(method='put_object_tagging', expected_params=tag_params, service_response={})
 
-    upload_log.write_log_to_s3('myJobId', 'myBucket', 'myJobId', 'myContent')
+    upload_log.write_log_to_s3('myJobId', 'myBucket', 'myJobId', ['myContent'])
 
 
-@patch('upload_log.write_log_to_s3')
-@patch('upload_log.get_log_content')
-@patch.dict(os.environ, {'BUCKET': 'test-bucket'}, clear=True)
-def test_lambda_handler(mock_get_log_content: MagicMock, mock_write_log_to_s3: MagicMock):
-    mock_get_log_content.return_value = 'here is some test log content'
-    event = {
-        'job_id': 'job-id',
-        'bucket': 'test-bucket',
-        'bucket_prefix': 'test-prefix',
-        'log_group': 'test-log-group',
-        'processing_results': {'step_0': {'Container': {'LogStreamName': 'test-log-stream'}}},
-    }
+class FakeMultipartUpload:
+    """Records the parts uploaded to S3 without keeping more than one of them."""
 
-    upload_log.lambda_handler(event, None)
+    def __init__(self):
+        self.part_sizes: list[int] = []
+        self.content = hashlib.sha256()
+        self.completed = False
 
-    mock_get_log_content.assert_called_once_with('test-log-group', 'test-log-stream')
-    mock_write_log_to_s3.assert_called_once_with(
-        'job-id', 'test-bucket', 'test-prefix', mock_get_log_content.return_value
-    )
+    def create_multipart_upload(self, Tagging, **kwargs):  # noqa: N803
+        assert Tagging == 'file_type=log'
+        return {'UploadId': 'myUploadId'}
 
+    def upload_part(self, Body, PartNumber, **kwargs):  # noqa: N803
+        assert PartNumber == len(self.part_sizes) + 1
+        self.part_sizes.append(len(Body))
+        self.content.update(Body)
+        return {'ETag': f'etag{PartNumber}'}
 
-@patch('upload_log.write_log_to_s3')
-@patch.dict(os.environ, {'BUCKET': 'test-bucket'}, clear=True)
-def test_lambda_handler_no_log_stream(mock_write_log_to_s3: MagicMock):
-    event = {
-        'job_id': 'job-id',
-        'bucket': 'test-bucket',
-        'bucket_prefix': 'test-prefix',
-        'log_group': 'test-log-group',
-        'processing_results': {
-            'step_0': {
-                'Error': '',
-                'Cause': '{"Container": {},"Status": "FAILED","StatusReason": "foo reason","Attempts": []}',
-            }
-        },
-    }
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):  # noqa: N803
+        assert MultipartUpload['Parts'] == [
+            {'ETag': f'etag{i}', 'PartNumber': i} for i in range(1, len(self.part_sizes) + 1)
+        ]
+        self.completed = True
 
-    upload_log.lambda_handler(event, None)
 
-    mock_write_log_to_s3.assert_called_once_with('job-id', 'test-bucket', 'test-prefix', 'foo reason')
+def test_upload_lines_streams_millions_of_events():
+    def get_log_events(nextToken=None, **kwargs):  # noqa: N803
+        page = int(nextToken or 0)
+        if page == 200:
+            return {'events': [], 'nextForwardToken': nextToken}
+        events = [{'message': f'page {page:03d} event {i:05d} {"x" * 40}', 'timestamp': page} for i in range(10_000)]
+        return {'events': events, 'nextForwardToken': str(page + 1)}
 
+    expected_content = hashlib.sha256()
+    for page in range(200):
+        for i in range(10_000):
+            prefix = '' if page == i == 0 else '\n'
+            expected_content.update(f'{prefix}page {page:03d} event {i:05d} {"x" * 40}'.encode())
 
-def test_lambda_handler_log_stream_does_not_exist():
-    def mock_get_log_events(**kwargs):
-        assert kwargs['logGroupName'] == 'test-log-group'
-        assert kwargs['logStreamName'] == 'test-log-stream'
-        raise upload_log.CLOUDWATCH.exceptions.ResourceNotFoundException(
-            {'Error': {'Message': 'The specified log stream does not exist.'}}, 'operation_name'
-        )
+    upload = FakeMultipartUpload()
+    with (
+        patch('upload_log.CLOUDWATCH.get_log_events', get_log_events),
+        patch('upload_log.S3.create_multipart_upload', upload.create_multipart_upload),
+        patch('upload_log.S3.upload_part', upload.upload_part),
+        patch('upload_log.S3.complete_multipart_upload', upload.complete_multipart_upload),
+    ):
+        with upload_log.read_log_streams('myGroup', [(None, 'myStream')]) as (messages, _):
+            upload_log.upload_lines('myBucket', 'myKey', messages, 'log')
+
+    # Two million lines of 62 bytes each, uploaded in parts of at most one part size plus one line
+    assert sum(upload.part_sizes) == 2_000_000 * 62 - 1
+    assert len(upload.part_sizes) == 15
+    assert max(upload.part_sizes) < upload_log.UPLOAD_PART_SIZE + 62
+    assert upload.completed
+    assert upload.content.digest() == expected_content.digest()
+
+
+def test_upload_lines_aborts_on_error():
+    def lines():
+        yield 'x' * 2048
+        raise RuntimeError('failed to read log')
+
+    with (
+        patch('upload_log.UPLOAD_PART_SIZE', 1024),
+        patch('upload_log.S3.create_multipart_upload', return_value={'UploadId': 'myUploadId'}),
+        patch('upload_log.S3.upload_part', return_value={'ETag': 'etag1'}),
+        patch('upload_log.S3.abort_multipart_upload') as mock_abort,
+    ):
+        with pytest.raises(RuntimeError, match='failed to read log'):
+            upload_log.upload_lines('myBucket', 'myKey', lines(), 'log')
+
+        mock_abort.assert_called_once_with(Bucket='myBucket', Key='myKey', UploadId='myUploadId')
 
-    event = {
+
+def run_lambda_handler(event: dict) -> list[str]:
+    """Run the handler and return the log messages it uploads."""
+    uploaded: list[str] = []
+
+    def write_log_to_s3(job_id, bucket, prefix, messages):
+        assert (job_id, bucket, prefix) == ('job-id', 'test-bucket', 'test-prefix')
+        uploaded.extend(messages)
+
+    with patch('upload_log.write_log_to_s3', write_log_to_s3):
+        upload_log.lambda_handler(event, None)
+    return uploaded
+
+
+def make_event(processing_results: dict) -> dict:
+    return {
         'job_id': 'job-id',
         'bucket': 'test-bucket',
         'bucket_prefix': 'test-prefix',
         'log_group': 'test-log-group',
-        'processing_results': {
-            'step_0': {
-                'Error': '',
-                'Cause': '{"Container": {"LogStreamName": "test-log-stream"},'
-                '"Status": "FAILED",'
-                '"StatusReason": "Task failed to start",'
-                '"Attempts": ['
-                '{"Container": {"Reason": "error message 1"}},'
-                '{"Container": {"Reason": "error message 2"}},'
-                '{"Container": {"Reason": "error message 3"}}]}',
-            }
-        },
+        'processing_results': processing_results,
     }
 
-    with (
-        patch('upload_log.CLOUDWATCH.get_log_events', mock_get_log_events),
-        patch('upload_log.write_log_to_s3') as mock_write_log_to_s3,
-        patch.dict(os.environ, {'BUCKET': 'test-bucket'}, clear=True),
-    ):
-        upload_log.lambda_handler(event, None)
 
-        mock_write_log_to_s3.assert_called_once_with(
-            'job-id', 'test-bucket', 'test-prefix', 'error message 1\nerror message 2\nerror message 3'
-        )
+def make_failed_result(cause: dict) -> dict:
+    return {'Error': 'States.TaskFailed', 'Cause': json.dumps({'Container': {}, 'Status': 'FAILED', **cause})}
+
+
+def get_log_events(logGroupName, logStreamName, nextToken=None, **kwargs):  # noqa: N803
+    assert logGroupName == 'test-log-group'
+    if logStreamName.startswith('missing'):
+        raise _missing_log_stream_error()
+    if nextToken is not None:
+        return {'events': [], 'nextForwardToken': nextToken}
+    return {'events': [{'message': f'{logStreamName} log', 'timestamp': 0}], 'nextForwardToken': 'token'}
+
+
+@patch('upload_log.CLOUDWATCH.get_log_events', get_log_events)
+def test_lambda_handler():
+    event = make_event({'step_0': {'Container': {'LogStreamName': 'test-log-stream'}}})
+    assert run_lambda_handler(event) == ['test-log-stream log']
+
+
+@patch('upload_log.CLOUDWATCH.get_log_events', get_log_events)
+def test_lambda_handler_attempts():
+    event = make_event(
+        {
+            'step_0': {'Container': {'LogStreamName': 'step0-log-stream'}},
+            'step_1': {
+                'Container': {'LogStreamName': 'attempt2-log-stream'},
+                'Attempts': [
+                    {'Container': {'LogStreamName': 'attempt1-log-stream'}},
+                    {'Container': {'LogStreamName': 'attempt2-log-stream'}},
+                ],
+            },
+        }
+    )
+    assert run_lambda_handler(event) == [
+        '[attempt 1 of 2] attempt1-log-stream log',
+        '[attempt 2 of 2] attempt2-log-stream log',
+    ]
+
+
+@patch('upload_log.CLOUDWATCH.get_log_events', get_log_events)
+def test_lambda_handler_last_attempt_has_no_log_stream():
+    event = make_event(
+        {
+            'step_0': make_failed_result(
+                {
+                    'StatusReason': 'foo reason',
+                    'Attempts': [
+                        {'Container': {'LogStreamName': 'attempt1-log-stream', 'Reason': 'error message 1'}},
+                        {'Container': {'Reason': 'CannotPullContainerError'}},
+                    ],
+                }
+            )
+        }
+    )
+    assert run_lambda_handler(event) == [
+        '[attempt 1 of 2] attempt1-log-stream log',
+        'error message 1\nCannotPullContainerError',
+    ]
+
+
+@patch('upload_log.CLOUDWATCH.get_log_events', get_log_events)
+def test_lambda_handler_last_log_stream_does_not_exist():
+    event = make_event(
+        {
+            'step_0': make_failed_result(
+                {
+                    'StatusReason': 'foo reason',
+                    'Attempts': [
+                        {'Container': {'LogStreamName': 'attempt1-log-stream', 'Reason': 'error message 1'}},
+                        {'Container': {'LogStreamName': 'missing-log-stream', 'Reason': 'error message 2'}},
+                    ],
+                }
+            )
+        }
+    )
+    assert run_lambda_handler(event) == [
+        '[attempt 1 of 2] attempt1-log-stream log',
+        'error message 1\nerror message 2',
+    ]
+
+
+def test_lambda_handler_no_log_stream():
+    event = make_event({'step_0': make_failed_result({'StatusReason': 'foo reason', 'Attempts': []})})
+    assert run_lambda_handler(event) == ['foo reason']
+
+
+def test_lambda_handler_last_step():
+    event = make_event(
+        {f'step_{i}': make_failed_result({'StatusReason': f'reason {i}', 'Attempts': []}) for i in (2, 10)}
+    )
+    assert run_lambda_handler(event) == ['reason 10']
+
+
+def test_lambda_handler_log_stream_does_not_exist():
+    event = make_event(
+        {
+            'step_0': make_failed_result(
+                {
+                    'Container': {'LogStreamName': 'missing-log-stream'},
+                    'StatusReason': 'Task failed to start',
+                    'Attempts': [
+                        {'Container': {'Reason': 'error message 1'}},
+                        {'Container': {'Reason': 'error message 2'}},
+                        {'Container': {'Reason': 'error message 3'}},
+                    ],
+                }
+            )
+        }
+    )
+    with patch('upload_log.CLOUDWATCH.get_log_events', get_log_events):
+        assert run_lambda_handler(event) == ['error message 1\nerror message 2\nerror message 3']
 
 
 def test_lambda_handler_resource_not_found():
@@ -196,25 +425,17 @@ def test_lambda_handler_resource_not_found():
             {'Error': {'Message': 'foo message'}}, 'operation_name'
         )
 
-    event = {
-        'job_id': 'job-id',
-        'bucket': 'test-bucket',
-        'bucket_prefix': 'test-prefix',
-        'log_group': 'test-log-group',
-        'processing_results': {
-            'step_0': {
-                'Error': '',
-                'Cause': '{"Container": {"LogStreamName": "test-log-stream"},'
-                '"Status": "FAILED",'
-                '"StatusReason": "Task failed to start",'
-                '"Attempts": ['
-                '{"Container": {"Reason": "error message 1"}},'
-                '{"Container": {"Reason": "error message 2"}},'
-                '{"Container": {"Reason": "error message 3"}}]}',
-            }
-        },
-    }
-
+    event = make_event(
+        {
+            'step_0': make_failed_result(
+                {
+                    'Container': {'LogStreamName': 'test-log-stream'},
+                    'StatusReason': 'Task failed to start',
+                    'Attempts': [],
+                }
+            )
+        }
+    )
     with patch('upload_log.CLOUDWATCH.get_log_events', mock_get_log_events):
         with pytest.raises(upload_log.CLOUDWATCH.exceptions.ResourceNotFoundException, match=r'.*foo message.*'):
             upload_log.lambda_handler(event, None)